@@ -17,11 +17,11 @@ import futurist
 import github
 import jira as jiraclient
 import munch
-from oslo_serialization import msgpackutils as mu
 from oslo_utils import excutils
 from oslo_utils import importutils
 from oslo_utils import netutils
 from oslo_utils import reflection
+from oslo_utils import timeutils
 import pytz
 import six
 import slackclient
@@ -36,6 +36,7 @@ from apscheduler import schedulers
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers import cron
 
+from padre import brain_utils as bu
 from padre import channel as c
 from padre import date_utils as du
 from padre import event
@@ -45,11 +46,15 @@ from padre import handler_utils as hu
 from padre import ldap_utils
 from padre import maintenance_utils as mau
 from padre import message as m
+from padre import metrics
 from padre import periodics
+from padre import spool_utils as spu
 from padre import utils
+from padre import wsgi_utils as wu
 
 from padre.handlers import jenkins as jenkins_handlers
 
+from padre.watchers import bulk as bulk_watcher
 from padre.watchers import gerrit as gerrit_watcher
 from padre.watchers import slack as slack_watcher
 from padre.watchers import telnet as telnet_watcher
@@ -91,6 +96,12 @@ def _submitted_listener(scheduler, event):
         job_name = job.name.splitlines()[0]
     LOG.debug("Job '%s' [%s] has been submitted, hopefully it runs soon",
               job_id, job_name)
+    scheduled_run_times = getattr(event, 'scheduled_run_times', None)
+    if scheduled_run_times:
+        now = du.get_now(tz=scheduler.timezone)
+        for scheduled_run_time in scheduled_run_times:
+            lag = (now - scheduled_run_time).total_seconds()
+            metrics.SCHEDULER_JOB_LAG.observe(max(0, lag))
 
 
 def _done_listener(scheduler, event):
@@ -148,7 +159,9 @@ def _fetch_ldap_client(config, secrets):
                   'user_dn', 'service_user_dn', 'group_dn'):
             ldap_config[k] = config.ldap[k]
         # These are optional.
-        for k in ('cache_size', 'cache_ttl'):
+        for k in ('cache_size', 'cache_ttl', 'pool_size',
+                  'pool_idle_timeout', 'pool_check_interval',
+                  'page_size', 'group_batch_size', 'transitive_groups'):
             try:
                 ldap_config[k] = config.ldap[k]
             except (AttributeError, KeyError):
@@ -322,10 +335,6 @@ class Bot(object):
         self.active_handlers = set()
         self.dead = event.Event()
         self.locks = munch.Munch({
-            # Used for any interaction with the bots brain to ensure
-            # that it isn't being mutated by many threads at the same
-            # time.
-            'brain': threading.Lock(),
             # Used for any interaction with the channel statistics;
             # to ensure that multiple threads aren't messing with it
             # at the same time (so that we get accurate counts).
@@ -352,6 +361,7 @@ class Bot(object):
         self.sent_birth_message = False
         self.quiescing = False
         self.brain = None
+        self.spool = None
 
     @property
     def hostname(self):
@@ -458,11 +468,20 @@ class Bot(object):
                          " to FINISH (they process %s messages)", k)
             executor.shutdown()
             del self.executors[k]
+        ldap_client = self.clients.get("ldap_client")
+        if ldap_client is not None:
+            LOG.info("Closing pooled ldap connections")
+            ldap_client.close()
         if self.brain is not None:
-            LOG.info("Syncing and closing brain")
-            self.brain.sync()
-            self.brain.close()
+            LOG.info("Flushing and closing brain")
+            num_flushed = self.brain.close()
+            LOG.debug("Flushed %s pending brain writes", num_flushed)
             self.brain = None
+        if self.spool is not None:
+            LOG.info("Closing spool (with %s entries left to"
+                     " replay)", self.spool.pending)
+            self.spool.close()
+            self.spool = None
         print("Goodbye :)")
 
     def submit_message(self, message, desired_channel, executor=None):
@@ -489,10 +508,36 @@ class Bot(object):
                 executor = self.executors['primary']
         if message.kind in PRE_PROCESSABLE_KINDS:
             message = self._preprocess(message)
-        fut = executor.submit(processing_func, desired_channel, message)
+        fut = executor.submit(self._dispatch, processing_func,
+                              timeutils.now(), desired_channel, message)
         fut.message = message
+        metrics.MESSAGES.inc(kind=message.kind, sub_kind=message.sub_kind,
+                             channel=desired_channel.name.lower())
         return fut
 
+    @staticmethod
+    def _dispatch(processing_func, submitted_at, channel, message):
+        metrics.DISPATCH_LATENCY.observe(timeutils.now() - submitted_at,
+                                         channel=channel.name.lower())
+        return processing_func(channel, message)
+
+    @staticmethod
+    def _capture_run(h_cls, h, failed=False):
+        h_cls_stats = h_cls.stats
+        h_cls_name = reflection.get_class_name(h_cls)
+        if failed:
+            h_cls_stats.failed += 1
+            metrics.HANDLER_RUNS.inc(handler=h_cls_name, outcome='failed')
+        else:
+            metrics.HANDLER_RUNS.inc(handler=h_cls_name, outcome='ok')
+        try:
+            h_elapsed = h.watch.elapsed()
+        except RuntimeError:
+            pass
+        else:
+            h_cls_stats.total_run_time += h_elapsed
+            metrics.HANDLER_LATENCY.observe(h_elapsed, handler=h_cls_name)
+
     def _capture_occurrence(self, channel, message):
         target_channel_stats = self.channel_stats[channel]
         with self.locks.channel_stats:
@@ -520,24 +565,16 @@ class Bot(object):
                 continue
             h = h_cls(self, message)
             with self._capture_for_record(channel, message, h):
-                h_cls_stats = h_cls.stats
-                h_cls_stats.ran += 1
+                h_cls.stats.ran += 1
                 try:
                     h.run(h_match)
                 except Exception:
                     LOG.exception(
                         "Processing %s with '%s' failed", message,
                         reflection.get_class_name(h_cls))
-                    h_cls_stats.failed += 1
-                    try:
-                        h_cls_stats.total_run_time += h.watch.elapsed()
-                    except RuntimeError:
-                        pass
+                    self._capture_run(h_cls, h, failed=True)
                 else:
-                    try:
-                        h_cls_stats.total_run_time += h.watch.elapsed()
-                    except RuntimeError:
-                        pass
+                    self._capture_run(h_cls, h)
 
     @contextlib.contextmanager
     def _capture_for_record(self, channel, message, handler):
@@ -594,8 +631,8 @@ class Bot(object):
         if from_who:
             from_who = "user:%s" % from_who
             try:
-                with self.locks.brain:
-                    text_aliases = dict(self.brain[from_who]['aliases'])
+                text_aliases = dict(
+                    self.brain.get_field(from_who, 'aliases'))
             except KeyError:
                 pass
             else:
@@ -614,22 +651,14 @@ class Bot(object):
                 continue
             h = h_cls(self, message)
             with self._capture_for_record(channel, message, h):
-                h_cls_stats = h_cls.stats
-                h_cls_stats.ran += 1
+                h_cls.stats.ran += 1
                 try:
                     result = h.run(h_match)
                 except Exception:
                     with excutils.save_and_reraise_exception():
-                        h_cls_stats.failed += 1
-                        try:
-                            h_cls_stats.total_run_time += h.watch.elapsed()
-                        except RuntimeError:
-                            pass
+                        self._capture_run(h_cls, h, failed=True)
                 else:
-                    try:
-                        h_cls_stats.total_run_time += h.watch.elapsed()
-                    except RuntimeError:
-                        pass
+                    self._capture_run(h_cls, h)
                     return result
         if message.headers.get(m.TO_ME_HEADER, False):
             if message.kind in SUGGESTABLE_KINDS:
@@ -658,11 +687,56 @@ class Bot(object):
 
         brain_path = os.path.join(
             self.config.persistent_working_dir, 'brain.sqlite')
-        LOG.info("Opening (or creating) brain at '%s'", brain_path)
-        self.brain = sqlitedict.SqliteDict(
-            filename=brain_path, tablename='padre',
-            autocommit=True, flag='c',
-            encode=mu.dumps, decode=mu.loads)
+        try:
+            brain_config = dict(self.config.brain)
+        except AttributeError:
+            brain_config = {}
+        brain_backend = utils.only_one_of(
+            bu.BACKENDS, brain_config.get("backend", bu.WAL))
+        LOG.info("Opening (or creating) %s brain at '%s'",
+                 brain_backend, brain_path)
+        brain_durability = brain_config.get("durability", bu.BATCHED)
+        brain_codec = bu.RecordCodec(
+            schema_versions=brain_config.get("schema_versions"))
+        if brain_backend == bu.WAL:
+            if brain_durability == bu.SYNC:
+                brain_synchronous = 'FULL'
+            else:
+                brain_synchronous = 'NORMAL'
+            brain = bu.SqliteBrain(
+                brain_path, tablename='padre', codec=brain_codec,
+                lock_stripes=brain_config.get("lock_stripes", 64),
+                synchronous=brain_synchronous)
+        else:
+            brain = sqlitedict.SqliteDict(
+                filename=brain_path, tablename='padre',
+                autocommit=False, flag='c',
+                encode=brain_codec.dumps, decode=brain_codec.loads)
+        self.brain = bu.WriteBehindBrain(
+            brain,
+            durability=brain_durability,
+            batch_size=brain_config.get("batch_size", 64),
+            flush_delay=brain_config.get("flush_delay", 1.0))
+        self.brain.start()
+
+        spooled = []
+        try:
+            spool_config = dict(self.config.spool)
+        except AttributeError:
+            pass
+        else:
+            spool_path = spool_config.get("path")
+            if not spool_path:
+                spool_path = os.path.join(
+                    self.config.persistent_working_dir, 'spool')
+            LOG.info("Opening (or creating) spool at '%s'", spool_path)
+            self.spool = spu.Spool.from_config(spool_path, spool_config)
+            try:
+                spooled = self.spool.open()
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self.spool = None
+                    self._shutdown()
 
         LOG.info("Building calendars")
         try:
@@ -779,6 +853,15 @@ class Bot(object):
                 'telnet': telnet_watcher.Watcher(self, telnet_conf),
             })
 
+        try:
+            bulk_conf = self.config.bulk
+        except AttributeError:
+            self.watchers.pop("bulk", None)
+        else:
+            self.watchers.update({
+                'bulk': bulk_watcher.Watcher(self, bulk_conf),
+            })
+
         LOG.info("Building wsgi mini-servers")
         try:
             max_wsgi_workers = max(1, self.config.max_wsgi_workers)
@@ -953,6 +1036,14 @@ class Bot(object):
                 with excutils.save_and_reraise_exception():
                     self._shutdown()
 
+        if spooled:
+            LOG.info("Replaying %s unfinished spool entries", len(spooled))
+            try:
+                wu.replay_hook_messages(self, spooled, log=LOG)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._shutdown()
+
         print("Main thread idling...")
         self.started_at = self.date_wrangler.get_now()
         try:
@@ -0,0 +1,588 @@
+import logging
+import sqlite3
+import threading
+import weakref
+import zlib
+
+import msgpack
+from oslo_serialization import msgpackutils as mu
+from oslo_utils import timeutils
+import six
+
+from padre import utils
+
+LOG = logging.getLogger(__name__)
+
+# Every mutation (and call to sync()) commits right away.
+SYNC = 'sync'
+
+# Calls to sync() only request a commit; writes are grouped and committed
+# by a background flusher after a short delay (or once enough have piled
+# up), so that bursts of writes cost one commit instead of many.
+BATCHED = 'batched'
+
+DURABILITIES = (SYNC, BATCHED)
+
+# Brain backends that can be selected (via config).
+SQLITEDICT = 'sqlitedict'
+WAL = 'wal'
+
+BACKENDS = (SQLITEDICT, WAL)
+
+# Allowed sqlite synchronous levels (for the writer connection).
+SYNCHRONOUS_LEVELS = ('NORMAL', 'FULL')
+
+_DELETED = object()
+
+# First byte of blobs written by the record codec; this byte is never
+# used by msgpack itself, so it can be told apart from older (plain
+# msgpack) blobs, which are still decoded as-is.
+_RECORD_MAGIC = b"\xc1"
+
+# Kinds of (tagged) payloads the record codec writes.
+_RECORD = 'r'
+_VALUE = 'v'
+
+
+class RecordCodec(object):
+    """Encodes brain values as schema-tagged (and field split) records.
+
+    Dict values are stored as a map of field name to (individually)
+    encoded field value, so that a single field can be decoded or
+    replaced without decoding (or re-encoding) the rest of the record;
+    other values are stored as a single encoded value. Each blob is
+    tagged with a schema name and version (the schema name is the part
+    of the key before the first ``:``, for example ``user``) so that
+    records can be migrated in the future.
+    """
+
+    def __init__(self, schema_versions=None,
+                 field_dumps=mu.dumps, field_loads=mu.loads):
+        if schema_versions is None:
+            schema_versions = {}
+        self._schema_versions = dict(schema_versions)
+        self._field_dumps = field_dumps
+        self._field_loads = field_loads
+
+    @staticmethod
+    def schema_for(key):
+        if not key:
+            return ''
+        schema, sep, _rest = key.partition(":")
+        if not sep:
+            return ''
+        return schema
+
+    def _pack(self, schema, kind, payload):
+        envelope = [schema, self._schema_versions.get(schema, 1),
+                    kind, payload]
+        return _RECORD_MAGIC + msgpack.packb(envelope, use_bin_type=True)
+
+    def _unpack(self, blob):
+        blob = bytes(blob)
+        if blob[0:1] != _RECORD_MAGIC:
+            return None, _VALUE, self._field_loads(blob), False
+        schema, _version, kind, payload = msgpack.unpackb(
+            blob[1:], raw=False)
+        return schema, kind, payload, True
+
+    def dumps(self, value, schema=''):
+        if isinstance(value, dict):
+            fields = {}
+            for field, field_value in six.iteritems(value):
+                fields[field] = self._field_dumps(field_value)
+            return self._pack(schema, _RECORD, fields)
+        return self._pack(schema, _VALUE, self._field_dumps(value))
+
+    def loads(self, blob):
+        _schema, kind, payload, tagged = self._unpack(blob)
+        if not tagged:
+            return payload
+        if kind == _RECORD:
+            record = {}
+            for field, field_blob in six.iteritems(payload):
+                record[field] = self._field_loads(field_blob)
+            return record
+        return self._field_loads(payload)
+
+    def load_field(self, blob, field):
+        """Decodes (only) the given field of a encoded record."""
+        _schema, kind, payload, tagged = self._unpack(blob)
+        if not tagged:
+            return payload[field]
+        if kind != _RECORD:
+            raise TypeError("Can not extract field '%s' from"
+                            " non-record value" % field)
+        return self._field_loads(payload[field])
+
+    def _load_fields(self, blob):
+        _schema, kind, payload, tagged = self._unpack(blob)
+        if not tagged:
+            if not isinstance(payload, dict):
+                raise TypeError("Can not alter fields of non-record value")
+            fields = {}
+            for field, field_value in six.iteritems(payload):
+                fields[field] = self._field_dumps(field_value)
+            return fields
+        if kind != _RECORD:
+            raise TypeError("Can not alter fields of non-record value")
+        return payload
+
+    def dump_field(self, blob, field, value, schema=''):
+        """Returns a new encoded record with one field replaced.
+
+        Other fields are carried over as-is (without being decoded).
+        """
+        if blob is None:
+            fields = {}
+        else:
+            fields = self._load_fields(blob)
+        fields[field] = self._field_dumps(value)
+        return self._pack(schema, _RECORD, fields)
+
+    def drop_field(self, blob, field, schema=''):
+        """Returns (field value, new encoded record without that field)."""
+        fields = self._load_fields(blob)
+        field_blob = fields.pop(field)
+        return (self._field_loads(field_blob),
+                self._pack(schema, _RECORD, fields))
+
+
+class SqliteBrain(object):
+    """Dict-like brain backed by sqlite running in WAL mode.
+
+    Readers each get their own (per-thread) connection so they do not
+    queue up behind writers; writes are buffered in memory (and visible
+    to readers right away) until ``commit`` writes them all out in one
+    transaction over a single writer connection.
+
+    The on-disk table layout is the same one that ``sqlitedict`` uses, so
+    an existing brain file can be opened by either.
+
+    Callers doing read-modify-write cycles should hold the (striped)
+    lock for the key they are mutating, see ``lock_for``.
+    """
+
+    def __init__(self, filename, tablename='padre', codec=None,
+                 lock_stripes=64, timeout=5.0, synchronous='NORMAL'):
+        self.filename = filename
+        self.tablename = tablename
+        if codec is None:
+            codec = RecordCodec()
+        self._codec = codec
+        self._timeout = timeout
+        # Thread ident -> (weakref to thread, reader connection).
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self._dirty = {}
+        self._dirty_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._key_locks = [threading.RLock()
+                           for _i in range(0, max(1, lock_stripes))]
+        # NOTE: in WAL mode a synchronous level of NORMAL does not fsync
+        # on every commit (only at checkpoints); use FULL to get commits
+        # that are fsynced before they return.
+        self._writer = sqlite3.connect(filename, timeout=timeout,
+                                       check_same_thread=False)
+        self._writer.execute("PRAGMA synchronous=%s" % utils.only_one_of(
+            SYNCHRONOUS_LEVELS, synchronous.upper()))
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute(
+            'CREATE TABLE IF NOT EXISTS "%s"'
+            ' (key TEXT PRIMARY KEY, value BLOB)' % tablename)
+        self._writer.commit()
+
+    def _get_reader(self):
+        me = threading.current_thread()
+        with self._readers_lock:
+            try:
+                me_ref, conn = self._readers[me.ident]
+            except KeyError:
+                conn = None
+            else:
+                # Thread idents can be reused once a thread exits...
+                if me_ref() is not me:
+                    conn = None
+            if conn is None:
+                # NOTE: only the owning thread uses it, but it gets closed
+                # from whichever thread notices the owner went away.
+                conn = sqlite3.connect(self.filename, timeout=self._timeout,
+                                       check_same_thread=False)
+                self._readers[me.ident] = (weakref.ref(me), conn)
+                # Drop (and close) the connection once the thread that
+                # owns it goes away, so that short lived threads do not
+                # leak connections.
+                weakref.finalize(me, self._drop_reader, me.ident, conn)
+            return conn
+
+    def _drop_reader(self, ident, conn):
+        with self._readers_lock:
+            try:
+                _me_ref, me_conn = self._readers[ident]
+            except KeyError:
+                pass
+            else:
+                if me_conn is conn:
+                    self._readers.pop(ident)
+        conn.close()
+
+    @property
+    def reader_count(self):
+        with self._readers_lock:
+            return len(self._readers)
+
+    def lock_for(self, key):
+        """Returns the lock that guards mutations of the given key."""
+        if isinstance(key, six.text_type):
+            key_hash = zlib.crc32(key.encode("utf8"))
+        else:
+            key_hash = zlib.crc32(key)
+        return self._key_locks[key_hash % len(self._key_locks)]
+
+    def _fetch_blob(self, key):
+        with self._dirty_lock:
+            blob = self._dirty.get(key)
+        if blob is _DELETED:
+            raise KeyError(key)
+        if blob is None:
+            row = self._get_reader().execute(
+                'SELECT value FROM "%s" WHERE key = ?' % self.tablename,
+                (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            blob = row[0]
+        return blob
+
+    def _iter_committed(self, what):
+        cursor = self._get_reader().execute(
+            'SELECT %s FROM "%s" ORDER BY rowid' % (what, self.tablename))
+        for row in cursor:
+            yield row
+
+    def __getitem__(self, key):
+        return self._codec.loads(self._fetch_blob(key))
+
+    def __setitem__(self, key, value):
+        blob = self._codec.dumps(value, schema=self._codec.schema_for(key))
+        with self._dirty_lock:
+            self._dirty[key] = sqlite3.Binary(blob)
+
+    def get_field(self, key, field):
+        """Returns one field of a record (only decoding that field)."""
+        return self._codec.load_field(self._fetch_blob(key), field)
+
+    def set_field(self, key, field, value):
+        """Sets one field of a record (creating the record if needed).
+
+        Callers should hold the lock for the key (see ``lock_for``).
+        """
+        try:
+            blob = self._fetch_blob(key)
+        except KeyError:
+            blob = None
+        blob = self._codec.dump_field(blob, field, value,
+                                      schema=self._codec.schema_for(key))
+        with self._dirty_lock:
+            self._dirty[key] = sqlite3.Binary(blob)
+
+    def pop_field(self, key, field):
+        """Removes (and returns) one field of a record.
+
+        Callers should hold the lock for the key (see ``lock_for``).
+        """
+        value, blob = self._codec.drop_field(
+            self._fetch_blob(key), field,
+            schema=self._codec.schema_for(key))
+        with self._dirty_lock:
+            self._dirty[key] = sqlite3.Binary(blob)
+        return value
+
+    def __delitem__(self, key):
+        # Ensure it exists (or raise the expected key error).
+        self._fetch_blob(key)
+        with self._dirty_lock:
+            self._dirty[key] = _DELETED
+
+    def __contains__(self, key):
+        try:
+            self._fetch_blob(key)
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self._dirty_lock:
+            dirty = dict(self._dirty)
+        keys = []
+        for (key,) in self._iter_committed("key"):
+            if dirty.get(key) is not _DELETED:
+                keys.append(key)
+            dirty.pop(key, None)
+        for key, blob in six.iteritems(dirty):
+            if blob is not _DELETED:
+                keys.append(key)
+        return keys
+
+    def values(self):
+        return [value for _key, value in self.items()]
+
+    def items(self):
+        items = []
+        for key in self.keys():
+            try:
+                items.append((key, self[key]))
+            except KeyError:
+                pass
+        return items
+
+    def commit(self):
+        """Writes out all buffered writes in a single transaction."""
+        with self._commit_lock:
+            with self._dirty_lock:
+                dirty = dict(self._dirty)
+            if not dirty:
+                return 0
+            removals = []
+            updates = []
+            for key, blob in six.iteritems(dirty):
+                if blob is _DELETED:
+                    removals.append((key,))
+                else:
+                    updates.append((key, blob))
+            with self._writer:
+                if updates:
+                    self._writer.executemany(
+                        'REPLACE INTO "%s" (key, value)'
+                        ' VALUES (?, ?)' % self.tablename, updates)
+                if removals:
+                    self._writer.executemany(
+                        'DELETE FROM "%s" WHERE key = ?' % self.tablename,
+                        removals)
+            with self._dirty_lock:
+                for key, blob in six.iteritems(dirty):
+                    # Only drop it if it wasn't written (again) while
+                    # the transaction was happening.
+                    if self._dirty.get(key) is blob:
+                        self._dirty.pop(key)
+            return len(dirty)
+
+    def close(self):
+        self.commit()
+        with self._readers_lock:
+            readers = list(self._readers.values())
+            self._readers.clear()
+        for _me_ref, conn in readers:
+            conn.close()
+        self._writer.close()
+
+
+class WriteBehindBrain(object):
+    """Brain wrapper that groups writes into fewer (larger) commits.
+
+    The wrapped brain must **not** be autocommitting and must provide
+    a ``commit`` method (a ``sqlitedict.SqliteDict`` opened with
+    ``autocommit=False`` or a ``SqliteBrain`` works); reads see
+    uncommitted writes since they go through the same wrapped brain.
+    """
+
+    def __init__(self, brain, durability=BATCHED,
+                 batch_size=64, flush_delay=1.0):
+        self._brain = brain
+        self._durability = utils.only_one_of(DURABILITIES, durability)
+        self._batch_size = max(1, int(batch_size))
+        self._flush_delay = max(0.0, float(flush_delay))
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        # Used for backends that don't have finer grained locks.
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._closed = False
+        self._flusher = None
+        self.commits = 0
+
+    @property
+    def durability(self):
+        return self._durability
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def lock_for(self, key):
+        """Returns the lock that guards mutations of the given key."""
+        try:
+            return self._brain.lock_for(key)
+        except AttributeError:
+            return self._lock
+
+    def start(self):
+        if self._durability != BATCHED or self._flusher is not None:
+            return
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name="brain-flusher")
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                # Give other writers a little while to pile on (so that
+                # they all get committed together).
+                with timeutils.StopWatch(duration=self._flush_delay) as w:
+                    while (self._pending < self._batch_size and
+                           not self._closed and not w.expired()):
+                        self._cond.wait(w.leftover())
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Failed flushing %s pending brain writes",
+                              self._pending)
+                # Back off a little before retrying them.
+                with self._cond:
+                    if not self._closed:
+                        self._cond.wait(max(self._flush_delay, 0.1))
+
+    def _note_write(self):
+        with self._cond:
+            self._pending += 1
+            if self._pending >= self._batch_size:
+                self._cond.notify_all()
+        if self._durability == SYNC:
+            self.flush()
+
+    def __getitem__(self, key):
+        return self._brain[key]
+
+    def __setitem__(self, key, value):
+        self._brain[key] = value
+        self._note_write()
+
+    def __delitem__(self, key):
+        del self._brain[key]
+        self._note_write()
+
+    def __contains__(self, key):
+        return key in self._brain
+
+    def __iter__(self):
+        return iter(self._brain)
+
+    def __len__(self):
+        return len(self._brain)
+
+    def get(self, key, default=None):
+        try:
+            return self._brain[key]
+        except KeyError:
+            return default
+
+    def get_field(self, key, field):
+        """Returns one field of a record stored in the brain."""
+        try:
+            getter = self._brain.get_field
+        except AttributeError:
+            return self._brain[key][field]
+        else:
+            return getter(key, field)
+
+    def set_field(self, key, field, value):
+        """Sets one field of a record stored in the brain.
+
+        Callers should hold the lock for the key (see ``lock_for``).
+        """
+        try:
+            setter = self._brain.set_field
+        except AttributeError:
+            try:
+                record = self._brain[key]
+            except KeyError:
+                record = {}
+            record[field] = value
+            self._brain[key] = record
+        else:
+            setter(key, field, value)
+        self._note_write()
+
+    def pop_field(self, key, field):
+        """Removes (and returns) one field of a record in the brain.
+
+        Callers should hold the lock for the key (see ``lock_for``).
+        """
+        try:
+            popper = self._brain.pop_field
+        except AttributeError:
+            record = self._brain[key]
+            value = record.pop(field)
+            self._brain[key] = record
+        else:
+            value = popper(key, field)
+        self._note_write()
+        return value
+
+    def keys(self):
+        return self._brain.keys()
+
+    def values(self):
+        return self._brain.values()
+
+    def items(self):
+        return self._brain.items()
+
+    def sync(self):
+        """Requests that prior writes become durable.
+
+        With ``sync`` durability this commits before returning, with
+        ``batched`` durability the commit happens (shortly) afterwards
+        from the flusher thread.
+        """
+        if self._durability == SYNC or self._flusher is None:
+            self.flush()
+        else:
+            with self._cond:
+                if self._pending:
+                    self._cond.notify_all()
+
+    def flush(self):
+        """Commits any pending writes (blocking until done)."""
+        with self._flush_lock:
+            with self._cond:
+                pending = self._pending
+                self._pending = 0
+            if pending:
+                try:
+                    self._brain.commit()
+                except Exception:
+                    # Not committed, so they are still pending (and will
+                    # get retried on the next flush).
+                    with self._cond:
+                        self._pending += pending
+                    raise
+                self.commits += 1
+            return pending
+
+    def close(self):
+        """Stops the flusher, commits pending writes and closes.
+
+        Returns how many pending writes were committed while closing.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        pending = self.flush()
+        self._brain.close()
+        return pending
@@ -35,18 +35,15 @@ class ClearHandler(handler.TriggeredHandler):
         if not from_who:
             return
         from_who = "user:%s" % from_who
-        with self.bot.locks.brain:
+        with self.bot.brain.lock_for(from_who):
             try:
-                user_info = self.bot.brain[from_who]
+                user_aliases = self.bot.brain.get_field(from_who, 'aliases')
             except KeyError:
-                user_info = {}
-            if 'aliases' in user_info:
-                num_aliases = len(user_info['aliases'])
-                user_info['aliases'] = {}
-                self.bot.brain[from_who] = user_info
-                self.bot.brain.sync()
-            else:
                 num_aliases = 0
+            else:
+                num_aliases = len(user_aliases)
+                self.bot.brain.set_field(from_who, 'aliases', {})
+                self.bot.brain.sync()
         replier = self.message.reply_text
         replier("Removed %s aliases." % num_aliases,
                 threaded=True, prefixed=False)
@@ -83,15 +80,14 @@ class RemoveHandler(handler.TriggeredHandler):
             return
         from_who = "user:%s" % from_who
         lines = []
-        with self.bot.locks.brain:
+        with self.bot.brain.lock_for(from_who):
             try:
-                user_info = self.bot.brain[from_who]
+                user_aliases = self.bot.brain.get_field(from_who, 'aliases')
             except KeyError:
-                user_info = {}
-            user_aliases = user_info.get('aliases', {})
+                user_aliases = {}
             try:
                 long = user_aliases.pop(short)
-                self.bot.brain[from_who] = user_info
+                self.bot.brain.set_field(from_who, 'aliases', user_aliases)
                 self.bot.brain.sync()
                 lines = [
                     ("Alias of `%s` to `%s` has"
@@ -139,14 +135,13 @@ class AddHandler(handler.TriggeredHandler):
         if not from_who:
             return
         from_who = "user:%s" % from_who
-        with self.bot.locks.brain:
+        with self.bot.brain.lock_for(from_who):
             try:
-                user_info = self.bot.brain[from_who]
+                user_aliases = self.bot.brain.get_field(from_who, 'aliases')
             except KeyError:
-                user_info = {}
-            user_aliases = user_info.setdefault('aliases', {})
+                user_aliases = {}
             user_aliases[short] = long
-            self.bot.brain[from_who] = user_info
+            self.bot.brain.set_field(from_who, 'aliases', user_aliases)
             self.bot.brain.sync()
             lines = [
                 "Alias of `%s` to `%s` has been recorded." % (short, long),
@@ -83,12 +83,12 @@ class DumpHandler(handler.TriggeredHandler):
 
     def _fetch_known(self, real_user):
         user_memory = {}
-        with self.bot.locks.brain:
-            alias_key = "user:%s" % real_user.id
-            try:
-                user_memory['aliases'] = dict(self.bot.brain[alias_key])
-            except KeyError:
-                pass
+        alias_key = "user:%s" % real_user.id
+        try:
+            user_memory['aliases'] = dict(
+                self.bot.brain.get_field(alias_key, 'aliases'))
+        except KeyError:
+            pass
         return user_memory
 
     def _run(self, user=''):
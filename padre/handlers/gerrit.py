@@ -1,7 +1,11 @@
+import collections
 import json
 import logging
 import re
+import threading
 
+import cachetools
+import futurist
 import munch
 from oslo_utils import reflection
 import requests
@@ -14,21 +18,6 @@ from padre import utils
 LOG = logging.getLogger(__name__)
 
 
-def _filter_by_project(ok_projects, event):
-    in_projects = [
-        event.change.project,
-    ]
-    send_message = False
-    for project in ok_projects:
-        if project in in_projects:
-            send_message = True
-            break
-        if project == "*":
-            send_message = True
-            break
-    return send_message
-
-
 def _filter_by_email(known_emails, email_suffixes, event):
     incoming_emails = []
     incoming_emails.append(event.change.owner.email)
@@ -54,6 +43,44 @@ def _filter_by_email(known_emails, email_suffixes, event):
     return send_message
 
 
+class ChannelRoutes(object):
+    """Index of the configured channel targets (keyed by project)."""
+
+    def __init__(self, targets):
+        self._by_project = collections.defaultdict(list)
+        self._any_project = []
+        for i, target in enumerate(targets):
+            email_suffixes = tuple(
+                e.strip() for e in target.get("email_suffixes", [])
+                if e.strip())
+            branch_pats = tuple(
+                re.compile(r"(?:%s)\Z" % pat)
+                for pat in target.get("branches", []))
+            route = (i, target, frozenset(target.get("emails", [])),
+                     email_suffixes, branch_pats)
+            projects = set(target.get("projects", []))
+            if "*" in projects:
+                self._any_project.append(route)
+            else:
+                for project in projects:
+                    self._by_project[project].append(route)
+
+    def find_targets(self, event):
+        routes = self._by_project.get(event.change.project, [])
+        if self._any_project:
+            # Keep the order they were configured in.
+            routes = sorted(routes + self._any_project, key=lambda r: r[0])
+        targets = []
+        for _i, target, emails, email_suffixes, branch_pats in routes:
+            if branch_pats and not any(pat.match(event.change.branch)
+                                       for pat in branch_pats):
+                continue
+            if not _filter_by_email(emails, email_suffixes, event):
+                continue
+            targets.append(target)
+        return targets
+
+
 class Unfurler(handler.TriggeredHandler):
     handles_what = {
         'channel_matcher': matchers.match_channel(c.BROADCAST),
@@ -68,6 +95,68 @@ class Unfurler(handler.TriggeredHandler):
                       " project `{{ change.project }}`"
                       " ({{ change.insertions }}|{{ change.deletions }}).")
 
+    # Change details are cached (keyed by (host, change id)) so that
+    # popular reviews that get linked over and over are not refetched
+    # every time; this gets (re)made during setup_class from the
+    # configured size and ttl.
+    cache = cachetools.TTLCache(maxsize=256, ttl=300)
+    cache_lock = threading.Lock()
+
+    # Shared (bounded) pool that changes get fetched with; this gets
+    # (re)made during setup_class from the configured worker count.
+    executor = None
+    executor_lock = threading.Lock()
+
+    # Each fetching thread gets its own session (they are not safe to
+    # share across threads) so that its connections get reused.
+    _local = threading.local()
+
+    # Compiled (combined) pattern for each set of hosts to expand for.
+    _host_pats = cachetools.LRUCache(maxsize=32)
+    _host_pats_lock = threading.Lock()
+
+    @classmethod
+    def setup_class(cls, bot):
+        try:
+            unfurl_config = cls.fetch_config(bot).unfurl
+        except AttributeError:
+            unfurl_config = {}
+        with cls.cache_lock:
+            cls.cache = cachetools.TTLCache(
+                maxsize=int(unfurl_config.get("cache_size", 256)),
+                ttl=float(unfurl_config.get("cache_ttl", 300)))
+        max_workers = max(1, int(unfurl_config.get("max_fetch_workers", 4)))
+        with cls.executor_lock:
+            if cls.executor is not None:
+                cls.executor.shutdown(wait=False)
+            cls.executor = futurist.ThreadPoolExecutor(
+                max_workers=max_workers)
+
+    @classmethod
+    def _get_session(cls):
+        try:
+            return cls._local.session
+        except AttributeError:
+            session = requests.Session()
+            cls._local.session = session
+            return session
+
+    @classmethod
+    def _find_host_pat(cls, hosts):
+        hosts = tuple(hosts)
+        with cls._host_pats_lock:
+            try:
+                return cls._host_pats[hosts]
+            except KeyError:
+                pass
+        pat = re.compile(
+            r"(https://|http://)(" +
+            "|".join("(?:%s)" % re.escape(host) for host in hosts) +
+            r")/(?:#/c/)?(\d+)[/]?")
+        with cls._host_pats_lock:
+            cls._host_pats[hosts] = pat
+        return pat
+
     @classmethod
     def _find_matches(cls, message_text, config):
         matches = []
@@ -76,23 +165,20 @@ class Unfurler(handler.TriggeredHandler):
             expand_for = list(config.unfurl.expand_for)
         except AttributeError:
             pass
-        for tmp_host in expand_for:
-            pats = [
-                r"(https://|http://)" + tmp_host + r"/#/c/(\d+)[/]?",
-                r"(https://|http://)" + tmp_host + r"/(\d+)[/]?",
-            ]
-            for pat in pats:
-                for m in re.finditer(pat, message_text):
-                    match = munch.Munch({
-                        'host': tmp_host,
-                        'change_id': int(m.group(2)),
-                        'url': m.group(0),
-                    })
-                    if m.group(1) == "https://":
-                        match.is_secure = True
-                    else:
-                        match.is_secure = False
-                    matches.append(match)
+        if not expand_for:
+            return matches
+        pat = cls._find_host_pat(expand_for)
+        for m in pat.finditer(message_text):
+            match = munch.Munch({
+                'host': m.group(2),
+                'change_id': int(m.group(3)),
+                'url': m.group(0),
+            })
+            if m.group(1) == "https://":
+                match.is_secure = True
+            else:
+                match.is_secure = False
+            matches.append(match)
         return matches
 
     def _fetch_change(self, match, call_timeout):
@@ -106,7 +192,7 @@ class Unfurler(handler.TriggeredHandler):
         }
         change = None
         try:
-            req = requests.get(change_url, timeout=call_timeout)
+            req = self._get_session().get(change_url, timeout=call_timeout)
             req.raise_for_status()
         except requests.RequestException:
             LOG.warning("Failed fetch of change %s from '%s'",
@@ -169,22 +255,55 @@ class Unfurler(handler.TriggeredHandler):
                 break
         return author
 
+    def _fetch_changes(self, matches, call_timeout):
+        changes = {}
+        to_fetch = []
+        with self.cache_lock:
+            for m in matches:
+                m_ident = (m.host, m.change_id)
+                try:
+                    changes[m_ident] = self.cache[m_ident]
+                except KeyError:
+                    to_fetch.append(m)
+        if not to_fetch:
+            return changes
+        executor = self.executor
+        if executor is None or len(to_fetch) == 1:
+            fetched = [(m, self._fetch_change(m, call_timeout))
+                       for m in to_fetch]
+        else:
+            futs = [(m, executor.submit(self._fetch_change, m, call_timeout))
+                    for m in to_fetch]
+            fetched = [(m, fut.result()) for m, fut in futs]
+        with self.cache_lock:
+            for m, change in fetched:
+                if change is not None:
+                    m_ident = (m.host, m.change_id)
+                    self.cache[m_ident] = change
+                    changes[m_ident] = change
+        return changes
+
     def _run(self, matches=None):
         if not matches:
             matches = []
         seen_changes = set()
-        replier = self.message.reply_attachments
+        uniq_matches = []
         for m in matches:
-            if self.dead.is_set():
-                break
             if m.change_id <= 0:
                 continue
             m_ident = (m.host, m.change_id)
             if m_ident in seen_changes:
                 continue
             seen_changes.add(m_ident)
-            LOG.debug("Trying to unfurl '%s'", m.url)
-            change = self._fetch_change(m, self.config.unfurl.call_timeout)
+            uniq_matches.append(m)
+        LOG.debug("Trying to unfurl %s", [m.url for m in uniq_matches])
+        changes = self._fetch_changes(uniq_matches,
+                                      self.config.unfurl.call_timeout)
+        replier = self.message.reply_attachments
+        for m in uniq_matches:
+            if self.dead.is_set():
+                break
+            change = changes.get((m.host, m.change_id))
             if change is not None:
                 attachment = {
                     'fallback': change.subject,
@@ -221,24 +340,25 @@ class PatchSetCreatedHandler(handler.Handler):
     }
     requires_slack_sender = True
 
-    @staticmethod
-    def _passes_filters(target, what):
-        passes = _filter_by_email(target.get("emails", []),
-                                  target.get("email_suffixes", []),
-                                  what)
-        if not passes:
-            return False
-        passes = _filter_by_project(target.get("projects", []), what)
-        if not passes:
-            return False
-        return True
+    # This will be filled in during setup_class call (and rebuilt each
+    # time the bot starts up).
+    routes = None
+
+    @classmethod
+    def setup_class(cls, bot):
+        config = cls.fetch_config(bot)
+        if config:
+            channels = config.get('channels', [])
+        else:
+            channels = []
+        cls.routes = ChannelRoutes(channels)
 
     def _run(self):
         what = self.message.body
-        targets = []
-        for target in self.config.get('channels', []):
-            if self._passes_filters(target, what):
-                targets.append(target)
+        routes = self.routes
+        if routes is None:
+            routes = ChannelRoutes(self.config.get('channels', []))
+        targets = routes.find_targets(what)
         if targets:
             attachment = {
                 'pretext': self.render_template("change", what),
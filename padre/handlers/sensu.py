@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 
+import collections
 import datetime
 import logging
+import threading
 
+import cachetools
 import pytz
 
 from padre import channel as c
@@ -49,6 +52,36 @@ def _get_deep_attr(target, attr_name):
     return (value_found, value)
 
 
+class EventDigest(object):
+    """Collapsed (repeated) events of one check (in one status)."""
+
+    def __init__(self, channel, check_name, status, first_seen):
+        self.channel = channel
+        self.check_name = check_name
+        self.status = status
+        self.first_seen = first_seen
+        self.last_seen = first_seen
+        self.count = 0
+        self.hosts = collections.OrderedDict()
+        self.last_output = ''
+        self.ts = None
+        self.posting = False
+        self.bypassed = 0
+        self.dirty = False
+        self.last_sent = None
+        self.flusher = None
+        self.lock = threading.Lock()
+
+    def add(self, host, when, output):
+        self.count += 1
+        self.last_seen = when
+        if host:
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+        if output:
+            self.last_output = output
+        self.dirty = True
+
+
 class BroadcastEventHandler(handler.Handler):
     """Handler that turns sensu events into slack messages."""
 
@@ -60,6 +93,26 @@ class BroadcastEventHandler(handler.Handler):
     requires_slack_sender = True
     required_configurations = ('event_channels',)
 
+    # Repeats of a check (in some status) within a window get collapsed
+    # into a single (updated) digest message per channel; this gets
+    # (re)made during setup_class from the configured window and size.
+    digests = cachetools.TTLCache(maxsize=1024, ttl=300)
+    digests_lock = threading.Lock()
+    digest_config = {}
+
+    # Last seen status of each client/check (used to find transitions).
+    last_statuses = cachetools.LRUCache(maxsize=8192)
+
+    @classmethod
+    def setup_class(cls, bot):
+        digest_config = cls.fetch_config(bot).get("digest", {})
+        with cls.digests_lock:
+            cls.digest_config = digest_config
+            cls.digests = cachetools.TTLCache(
+                maxsize=int(digest_config.get("max_digests", 1024)),
+                ttl=float(digest_config.get("window", 300)))
+            cls.last_statuses.clear()
+
     @classmethod
     def handles(cls, message, channel, config):
         channel_matcher = cls.handles_what['channel_matcher']
@@ -192,13 +245,191 @@ class BroadcastEventHandler(handler.Handler):
             message_text += "\n"
             message_text += "*Description*: %s" % event_output
         attachment = self._build_attachment(event, event_color, message_text)
+        if not self.digest_config.get("enabled", True):
+            for channel in event_channels:
+                self._post_attachment(channel, attachment)
+            return
+        try:
+            check_name = event.check.name
+        except AttributeError:
+            check_name = ''
+        try:
+            host = event.client.name
+        except AttributeError:
+            host = ''
+        bypass_statuses = self.digest_config.get("bypass_statuses", [2])
+        with self.digests_lock:
+            status_key = (host, check_name)
+            prior_status = self.last_statuses.get(status_key)
+            self.last_statuses[status_key] = event_status
+        # Tell people right away when something (newly) goes into one of
+        # these statuses (unless that is happening everywhere at once).
+        bypass = (event_status in bypass_statuses and
+                  prior_status != event_status)
         for channel in event_channels:
-            self.bot.slack_sender.post_send(
-                channel=channel,
-                text=' ', link_names=True,
-                unfurl_links=True,
-                as_user=True,
-                attachments=[attachment], log=LOG)
+            self._digest_event(channel, check_name, host, event_status,
+                               event_output, attachment, bypass=bypass)
+
+    def _post_attachment(self, channel, attachment):
+        return self.bot.slack_sender.post_send(
+            channel=channel,
+            text=' ', link_names=True,
+            unfurl_links=True,
+            as_user=True,
+            attachments=[attachment], log=LOG)
+
+    def _digest_event(self, channel, check_name, host, event_status,
+                      event_output, attachment, bypass=False):
+        now = self.date_wrangler.get_now()
+        key = (channel, check_name, event_status)
+        with self.digests_lock:
+            try:
+                digest = self.digests[key]
+            except KeyError:
+                digest = EventDigest(channel, check_name,
+                                     event_status, now)
+                self.digests[key] = digest
+        # NOTE: slack only gets called after the digest lock is released
+        # (so that a slow call does not stall every other worker handling
+        # events for this check); what to send is figured out under it.
+        first_post = False
+        bypass_post = False
+        update_attachment = None
+        with digest.lock:
+            digest.add(host, now, event_output)
+            if digest.ts is None:
+                if digest.posting:
+                    # Whoever is posting it sends these counts after.
+                    return
+                # First one in this window gets posted as is.
+                digest.posting = True
+                digest.dirty = False
+                first_post = True
+            else:
+                max_bypass = self.digest_config.get("max_bypass", 5)
+                if bypass and digest.bypassed < max_bypass:
+                    digest.bypassed += 1
+                    bypass_post = True
+                update_attachment = self._claim_digest_update(digest, now)
+        if first_post:
+            self._post_first(digest, attachment, now)
+            return
+        if bypass_post:
+            self._post_attachment(channel, attachment)
+        if update_attachment is not None:
+            self._send_digest(digest, update_attachment)
+
+    def _post_first(self, digest, attachment, now):
+        try:
+            resp = self._post_attachment(digest.channel, attachment)
+        except Exception:
+            with digest.lock:
+                digest.posting = False
+            raise
+        with digest.lock:
+            digest.posting = False
+            digest.ts = resp.get('ts')
+            digest.last_sent = now
+            if digest.dirty:
+                # More came in while it was being posted.
+                self._schedule_flush(digest, now)
+
+    def _schedule_flush(self, digest, now):
+        # NOTE: caller must hold the digest lock.
+        if digest.flusher is not None:
+            return
+        update_interval = self.digest_config.get("update_interval", 10)
+        since_sent = (now - digest.last_sent).total_seconds()
+        # Make sure the final counts eventually get sent.
+        digest.flusher = threading.Timer(
+            max(0, update_interval - since_sent),
+            self._flush_digest, args=(digest,))
+        digest.flusher.daemon = True
+        digest.flusher.start()
+
+    def _claim_digest_update(self, digest, now):
+        # NOTE: caller must hold the digest lock; returns the attachment
+        # to update the digest message with (if it is time to).
+        update_interval = self.digest_config.get("update_interval", 10)
+        since_sent = (now - digest.last_sent).total_seconds()
+        if since_sent < update_interval:
+            self._schedule_flush(digest, now)
+            return None
+        attachment = self._build_digest_attachment(digest)
+        digest.dirty = False
+        digest.last_sent = now
+        return attachment
+
+    def _flush_digest(self, digest):
+        with digest.lock:
+            digest.flusher = None
+            if not digest.dirty or digest.ts is None:
+                return
+            attachment = self._claim_digest_update(
+                digest, self.date_wrangler.get_now())
+        if attachment is None:
+            return
+        try:
+            self._send_digest(digest, attachment)
+        except Exception:
+            LOG.exception("Failed sending sensu digest for"
+                          " check '%s'", digest.check_name)
+
+    def _build_digest_attachment(self, digest):
+        status_prefix = STATUS_MAP.get(digest.status,
+                                       STATUS_MAP[UNKNOWN_STATUS])
+        event_color = COLOR_MAP.get(digest.status,
+                                    COLOR_MAP[UNKNOWN_STATUS])
+        message_text = "*%s*: %s (%s events from %s hosts)" % (
+            status_prefix, digest.check_name or "unknown check",
+            digest.count, len(digest.hosts))
+        if digest.last_output:
+            message_text += "\n"
+            message_text += "*Last description*: %s" % digest.last_output
+        max_hosts = self.digest_config.get("max_hosts", 20)
+        hosts = list(digest.hosts)
+        hosts_value = ", ".join(hosts[0:max_hosts])
+        if len(hosts) > max_hosts:
+            hosts_value += " and %s more" % (len(hosts) - max_hosts)
+        fields = [
+            {
+                "title": "First seen",
+                "value": digest.first_seen.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                "short": True,
+            },
+            {
+                "title": "Last seen",
+                "value": digest.last_seen.strftime("%Y-%m-%d %H:%M:%S %Z"),
+                "short": True,
+            },
+        ]
+        if hosts_value:
+            fields.append({
+                "title": "Hosts",
+                "value": hosts_value,
+                "short": utils.is_short(hosts_value),
+            })
+        return {
+            "footer": "Sensu",
+            "footer_icon": ("https://raw.githubusercontent.com/sensu/"
+                            "sensu-logo/master/"
+                            "sensu1_flat%20white%20bg_png.png"),
+            "color": event_color,
+            "text": message_text,
+            "fields": fields,
+            'mrkdwn_in': ["text"],
+        }
+
+    def _send_digest(self, digest, attachment):
+        try:
+            self.bot.slack_sender.update_post_send(
+                digest.channel, digest.ts, text=' ', link_names=True,
+                as_user=True, attachments=[attachment], log=LOG)
+        except Exception:
+            with digest.lock:
+                # So that the next update (or flush) sends it.
+                digest.dirty = True
+            raise
 
     def _run(self, **kwargs):
         event = self.message.body
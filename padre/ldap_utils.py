@@ -1,8 +1,32 @@
 import collections
+import contextlib
+import logging
+import threading
 
 import cachetools
 import ldap
+from ldap import controls as ldap_controls
+from ldap import filter as ldap_filter
 import munch
+from oslo_utils import timeutils
+import six
+
+LOG = logging.getLogger(__name__)
+
+#: Errors that mean a connection is (likely) no longer usable.
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+#: Matching rule (active directory only) that walks nested memberships.
+IN_CHAIN_RULE_OID = "1.2.840.113556.1.4.1941"
+
+#: Capability active directory servers advertise in their root DSE.
+ACTIVE_DIRECTORY_OID = "1.2.840.113556.1.4.800"
+
+
+def _to_text(value):
+    if isinstance(value, six.binary_type):
+        value = value.decode("utf-8")
+    return value
 
 
 def explode_member(member, overwrite_same_keys=False):
@@ -28,12 +52,143 @@ def explode_member(member, overwrite_same_keys=False):
     return member
 
 
+class _PooledConnection(object):
+    def __init__(self, client):
+        self.client = client
+        self.idle_watch = timeutils.StopWatch()
+        self.checked_watch = timeutils.StopWatch()
+        self.checked_watch.start()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of (already bound) ldap connections."""
+
+    def __init__(self, connect_func, max_size=4,
+                 idle_timeout=300, check_interval=60):
+        self._connect_func = connect_func
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._idle = collections.deque()
+        self._cond = threading.Condition()
+        self._size = 0
+        self._closed = False
+
+    @property
+    def size(self):
+        with self._cond:
+            return self._size
+
+    @property
+    def idle(self):
+        with self._cond:
+            return len(self._idle)
+
+    @staticmethod
+    def _close_client(client):
+        try:
+            client.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _discard(self, pooled):
+        self._close_client(pooled.client)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, pooled):
+        if (self.idle_timeout is not None and
+                pooled.idle_watch.elapsed() >= self.idle_timeout):
+            return False
+        if (self.check_interval is not None and
+                pooled.checked_watch.elapsed() >= self.check_interval):
+            try:
+                pooled.client.whoami_s()
+            except ldap.LDAPError:
+                LOG.debug("Dropping pooled ldap connection that"
+                          " failed its health check", exc_info=True)
+                return False
+            pooled.checked_watch.restart()
+        return True
+
+    def _acquire(self):
+        while True:
+            with self._cond:
+                while (not self._closed and not self._idle and
+                       self._size >= self.max_size):
+                    self._cond.wait()
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    # Most recently used first (the least likely to have
+                    # been dropped by the server).
+                    pooled = self._idle.pop()
+                else:
+                    pooled = None
+                    self._size += 1
+            if pooled is None:
+                try:
+                    return _PooledConnection(self._connect_func())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def _release(self, pooled):
+        pooled.idle_watch.restart()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(pooled)
+                self._cond.notify()
+                return
+        self._discard(pooled)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that provides a pooled (bound) ldap connection."""
+        pooled = self._acquire()
+        try:
+            yield pooled.client
+        except CONNECTION_ERRORS:
+            self._discard(pooled)
+            raise
+        except Exception:
+            self._release(pooled)
+            raise
+        else:
+            self._release(pooled)
+
+    def drop_idle(self):
+        """Closes (and forgets) the connections not currently in use."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            self._close_client(pooled.client)
+
+    def close(self):
+        """Closes the pool (connections in use get closed when released)."""
+        with self._cond:
+            self._closed = True
+        self.drop_idle()
+
+
 class LdapClient(object):
     """Helper client that makes interacting with our ldap easier."""
 
     def __init__(self, uri, bind_dn, bind_password,
                  user_dn, service_user_dn, group_dn,
-                 cache_size=512, cache_ttl=1800):
+                 cache_size=512, cache_ttl=1800, pool_size=4,
+                 pool_idle_timeout=300, pool_check_interval=60,
+                 page_size=500, group_batch_size=50,
+                 transitive_groups='auto'):
         self._uri = uri
         self._bind_dn = bind_dn
         self._bind_password = bind_password
@@ -47,6 +202,18 @@ class LdapClient(object):
                                  "(sAMAccountName=%(username)s))")
         # This avoids hammering ldap/ad for the same information all the time.
         self._cache = cachetools.TTLCache(cache_size, cache_ttl)
+        self._page_size = page_size
+        self._group_batch_size = max(1, group_batch_size)
+        # Either 'auto' (use it if the server is active directory) or
+        # a boolean to force it on or off.
+        self._transitive_groups = transitive_groups
+        self._root_dse = None
+        # Binding (and connecting) is expensive, so keep connections around
+        # (and share them between all users of this client).
+        self._pool = ConnectionPool(self._make_ldap_client,
+                                    max_size=pool_size,
+                                    idle_timeout=pool_idle_timeout,
+                                    check_interval=pool_check_interval)
 
     def _make_ldap_client(self):
         ldap_client = ldap.initialize(self._uri)
@@ -55,104 +222,201 @@ class LdapClient(object):
         ldap_client.simple_bind_s(self._bind_dn, self._bind_password)
         return ldap_client
 
+    def _run(self, func):
+        # NOTE: when the server has dropped a pooled connection (which
+        # we only find out about when using it) retry once on a fresh
+        # (newly bound) connection.
+        try:
+            with self._pool.connection() as client:
+                return func(client)
+        except CONNECTION_ERRORS:
+            LOG.debug("Retrying ldap operation on a new"
+                      " connection", exc_info=True)
+            # Whatever dropped that connection likely dropped the other
+            # idle ones too.
+            self._pool.drop_idle()
+            with self._pool.connection() as client:
+                return func(client)
+
     def whoami(self):
         cache_key = "me"
         try:
             return self._cache[cache_key]
         except KeyError:
-            client = self._make_ldap_client()
-            me = client.whoami_s()
+            me = self._run(lambda client: client.whoami_s())
             if me:
                 self._cache[cache_key] = me
             return me
 
-    def describe_user(self, user):
+    def _find_user(self, client, user):
         def _get_result_key(result, k):
             try:
                 return result[k][0]
             except (KeyError, IndexError):
                 return None
+        finders = [
+            (self._user_filter_tpl, self._user_dn),
+            (self._service_user_filter_tpl, self._service_user_dn),
+        ]
+        for filter_tpl, lookup_dn in finders:
+            filter = filter_tpl % {'username': user}
+            result = client.search_s(lookup_dn,
+                                     ldap.SCOPE_SUBTREE, filter)
+            if result:
+                _canon_user, result = result[0]
+                return munch.Munch({
+                    'street_address': _get_result_key(result,
+                                                      'streetAddress'),
+                    'name': _get_result_key(result, 'displayName'),
+                    'unix_home_directory': _get_result_key(
+                        result, "unixHomeDirectory"),
+                    'employee_id': _get_result_key(result, 'employeeID'),
+                    'uid': _get_result_key(result, 'uid'),
+                    'principal_name': _get_result_key(result,
+                                                      'userPrincipalName'),
+                    'mail': _get_result_key(result, "mail"),
+                    'description': _get_result_key(result, "description"),
+                })
+        return None
+
+    def describe_user(self, user):
         cache_key = "user:%s" % user
         try:
             real_user = self._cache[cache_key]
             return real_user.copy()
         except KeyError:
-            client = self._make_ldap_client()
-            finders = [
-                (self._user_filter_tpl, self._user_dn),
-                (self._service_user_filter_tpl, self._service_user_dn),
-            ]
-            real_user = None
-            for filter_tpl, lookup_dn in finders:
-                filter = filter_tpl % {'username': user}
-                result = client.search_s(lookup_dn,
-                                         ldap.SCOPE_SUBTREE, filter)
-                if result:
-                    _canon_user, result = result[0]
-                    real_user = munch.Munch({
-                        'street_address': _get_result_key(result,
-                                                          'streetAddress'),
-                        'name': _get_result_key(result, 'displayName'),
-                        'unix_home_directory': _get_result_key(
-                            result, "unixHomeDirectory"),
-                        'employee_id': _get_result_key(result, 'employeeID'),
-                        'uid': _get_result_key(result, 'uid'),
-                        'principal_name': _get_result_key(result,
-                                                          'userPrincipalName'),
-                        'mail': _get_result_key(result, "mail"),
-                        'description': _get_result_key(result, "description"),
-                    })
-                    break
+            real_user = self._run(
+                lambda client: self._find_user(client, user))
             if real_user is not None:
                 self._cache[cache_key] = real_user
                 return real_user.copy()
             else:
                 return real_user
 
+    def _paged_search(self, client, base, filter, attrlist=None):
+        page_control = ldap_controls.SimplePagedResultsControl(
+            True, size=self._page_size, cookie='')
+        while True:
+            msgid = client.search_ext(base, ldap.SCOPE_SUBTREE, filter,
+                                      attrlist=attrlist,
+                                      serverctrls=[page_control])
+            _rtype, rdata, _rmsgid, serverctrls = client.result3(msgid)
+            for dn, attrs in rdata:
+                # Referrals come back without a dn; skip them.
+                if dn:
+                    yield dn, attrs
+            cookie = None
+            for ctrl in serverctrls:
+                if ctrl.controlType == page_control.controlType:
+                    cookie = ctrl.cookie
+            if not cookie:
+                break
+            page_control.cookie = cookie
+
+    def _fetch_root_dse(self, client):
+        if self._root_dse is None:
+            root_dse = {}
+            result = client.search_s(
+                '', ldap.SCOPE_BASE, '(objectClass=*)',
+                ['supportedCapabilities', 'defaultNamingContext'])
+            if result:
+                _dn, attrs = result[0]
+                for k, values in attrs.items():
+                    root_dse[k] = [_to_text(v) for v in values]
+            self._root_dse = root_dse
+        return self._root_dse
+
+    def _use_transitive_groups(self, client):
+        if self._transitive_groups != 'auto':
+            return bool(self._transitive_groups)
+        try:
+            root_dse = self._fetch_root_dse(client)
+        except CONNECTION_ERRORS:
+            # Let the caller retry this on another connection.
+            raise
+        except ldap.LDAPError:
+            # NOTE: only a root DSE that was read gets remembered (so this
+            # gets tried again next time).
+            LOG.warning("Unable to read ldap root DSE (assuming no"
+                        " transitive group support)", exc_info=True)
+            return False
+        capabilities = root_dse.get('supportedCapabilities', [])
+        return (ACTIVE_DIRECTORY_OID in capabilities and
+                bool(root_dse.get('defaultNamingContext')))
+
+    def _find_transitive_members(self, client, canon_group):
+        # The server walks all the nested groups itself, so this is one
+        # (paged) search no matter how deep (or wide) the nesting is.
+        base = self._fetch_root_dse(client)['defaultNamingContext'][0]
+        member_filter = "(&(memberOf:%s:=%s)(!(objectClass=group)))" % (
+            IN_CHAIN_RULE_OID, ldap_filter.escape_filter_chars(canon_group))
+        return set(_to_text(dn) for dn, _attrs in self._paged_search(
+            client, base, member_filter, attrlist=['1.1']))
+
+    def _find_nested_members(self, client, canon_group, members):
+        group_members = set()
+        seen = set([canon_group])
+        scanning_members = collections.deque(members)
+        while scanning_members:
+            # Figure out which of a batch of members are groups (and get
+            # their members) in one search instead of one per member.
+            batch = {}
+            batch_cns = set()
+            while scanning_members and len(batch) < self._group_batch_size:
+                member = _to_text(scanning_members.popleft())
+                if member in seen:
+                    continue
+                seen.add(member)
+                tmp_member = explode_member(
+                    member, overwrite_same_keys=True)
+                member_cn = tmp_member.get("CN")
+                if not member_cn:
+                    group_members.add(member)
+                else:
+                    batch[member.lower()] = member
+                    batch_cns.add(member_cn)
+            if not batch:
+                continue
+            group_filter = "(&(objectClass=group)(|%s))" % "".join(
+                "(name=%s)" % ldap_filter.escape_filter_chars(member_cn)
+                for member_cn in sorted(batch_cns))
+            for found_group, attrs in self._paged_search(
+                    client, self._group_dn, group_filter,
+                    attrlist=['member']):
+                # NOTE: groups elsewhere can share a name with one of
+                # these members; only the member (dn) itself counts.
+                member = batch.pop(_to_text(found_group).lower(), None)
+                if member is not None:
+                    scanning_members.extend(attrs.get('member', []))
+            # Whatever was not found to be a group is a member.
+            group_members.update(batch.values())
+        return group_members
+
+    def _find_group_members(self, client, group):
+        group_filter = self._group_list_filter_tpl % {
+            'group': ldap_filter.escape_filter_chars(group),
+        }
+        result = client.search_s(self._group_dn, ldap.SCOPE_SUBTREE,
+                                 group_filter)
+        if not result:
+            return set()
+        canon_group, result = result[0]
+        if not canon_group:
+            return set()
+        canon_group = _to_text(canon_group)
+        if self._use_transitive_groups(client):
+            return self._find_transitive_members(client, canon_group)
+        return self._find_nested_members(client, canon_group,
+                                         result.get('member', []))
+
     def list_ldap_group(self, group):
         cache_key = "group:%s" % group
         try:
             group_members = self._cache[cache_key]
             return group_members.copy()
         except KeyError:
-            client = self._make_ldap_client()
-            group_members = set()
-            seen = set()
-            group_list_filter_tpl = self._group_list_filter_tpl
-            group_filter = group_list_filter_tpl % {'group': group}
-            result = client.search_s(self._group_dn, ldap.SCOPE_SUBTREE,
-                                     group_filter)
-            if result:
-                canon_group, result = result[0]
-                if canon_group:
-                    seen.add(canon_group)
-                    scanning_members = collections.deque(result['member'])
-                    while scanning_members:
-                        member = scanning_members.popleft()
-                        if member in seen:
-                            continue
-                        seen.add(member)
-                        tmp_member = explode_member(
-                            member, overwrite_same_keys=True)
-                        member_cn = tmp_member.get("CN")
-                        if not member_cn:
-                            group_members.add(member)
-                        else:
-                            group_filter = group_list_filter_tpl % {
-                                'group': member_cn,
-                            }
-                            result = client.search_s(self._group_dn,
-                                                     ldap.SCOPE_SUBTREE,
-                                                     group_filter)
-                            if result:
-                                canon_group, result = result[0]
-                                if canon_group:
-                                    seen.add(canon_group)
-                                    scanning_members.extend(result['member'])
-                                else:
-                                    group_members.add(member)
-                            else:
-                                group_members.add(member)
+            group_members = self._run(
+                lambda client: self._find_group_members(client, group))
             self._cache[cache_key] = group_members
             return group_members.copy()
 
@@ -167,10 +431,9 @@ class LdapClient(object):
             canon_user = self._cache[canon_user_key]
         except KeyError:
             canon_user = None
-            client = self._make_ldap_client()
             user_filter = self._user_filter_tpl % {'username': username}
-            result = client.search_s(self._user_dn, ldap.SCOPE_SUBTREE,
-                                     user_filter)
+            result = self._run(lambda client: client.search_s(
+                self._user_dn, ldap.SCOPE_SUBTREE, user_filter))
             if result:
                 canon_user, _result = result[0]
                 if canon_user:
@@ -180,4 +443,8 @@ class LdapClient(object):
         return False
 
     def connect(self):
-        self._make_ldap_client()
+        with self._pool.connection():
+            pass
+
+    def close(self):
+        self._pool.close()
@@ -24,6 +24,8 @@ def _make_matcher(base_component, sub_components):
                 return False
         return True
 
+    _matcher.kind = base_component
+    _matcher.sub_components = tuple(sub_components)
     return _matcher
 
 
@@ -43,6 +45,7 @@ def match_or(matcher, *more_matchers):
                 return True
         return False
 
+    _matcher.matchers = tuple(matchers)
     return _matcher
 
 
@@ -50,10 +53,44 @@ def match_none(*args, **kwargs):
     return False
 
 
+match_none.matchers = ()
+
+
 def match_any(*args, **kwargs):
     return True
 
 
+def find_sub_kinds(matcher, kind):
+    """Finds the (first level) sub-kinds of ``kind`` a matcher can match.
+
+    Returns none if this can not be determined (ie, the matcher could
+    match any sub-kind or it wasn't made by one of the functions in
+    this module).
+    """
+    try:
+        more_matchers = matcher.matchers
+    except AttributeError:
+        pass
+    else:
+        sub_kinds = set()
+        for m_func in more_matchers:
+            m_sub_kinds = find_sub_kinds(m_func, kind)
+            if m_sub_kinds is None:
+                return None
+            sub_kinds.update(m_sub_kinds)
+        return sub_kinds
+    try:
+        m_kind = matcher.kind
+        m_sub_components = matcher.sub_components
+    except AttributeError:
+        return None
+    if m_kind != kind:
+        return set()
+    if not m_sub_components:
+        return None
+    return set([m_sub_components[0]])
+
+
 def match_jira(*sub_components):
     return _make_matcher('jira', sub_components)
 
@@ -0,0 +1,93 @@
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _format_stat(stat):
+    frames = []
+    for frame in stat.traceback:
+        frames.append("%s:%s" % (frame.filename, frame.lineno))
+    formatted = {
+        'where': frames,
+        'size': stat.size,
+        'count': stat.count,
+    }
+    size_diff = getattr(stat, 'size_diff', None)
+    if size_diff is not None:
+        formatted['size_diff'] = size_diff
+        formatted['count_diff'] = stat.count_diff
+    return formatted
+
+
+class MemoryTracer(object):
+    """Starts/stops tracemalloc and keeps (a couple) snapshots from it."""
+
+    def __init__(self, max_snapshots=2):
+        self.max_snapshots = max(2, max_snapshots)
+        self.snapshots = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_supported():
+        return tracemalloc is not None
+
+    @staticmethod
+    def is_tracing():
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            del self.snapshots[:]
+
+    def take_snapshot(self):
+        """Snapshots what is allocated now (dropping the oldest snapshot)."""
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        with self.lock:
+            self.snapshots.append(snapshot)
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.pop(0)
+            return len(self.snapshots)
+
+    def top(self, limit=25, key_type='lineno'):
+        """Top allocation sites (of the latest snapshot)."""
+        with self.lock:
+            if not self.snapshots:
+                return []
+            snapshot = self.snapshots[-1]
+        stats = snapshot.statistics(key_type)
+        return [_format_stat(stat) for stat in stats[0:limit]]
+
+    def diff(self, limit=25, key_type='lineno'):
+        """Top changes in allocation sites (between the last 2 snapshots)."""
+        with self.lock:
+            if len(self.snapshots) < 2:
+                return []
+            older, newer = self.snapshots[-2], self.snapshots[-1]
+        stats = newer.compare_to(older, key_type)
+        return [_format_stat(stat) for stat in stats[0:limit]]
+
+    def summary(self):
+        summary = {
+            'supported': self.is_supported(),
+            'tracing': self.is_tracing(),
+            'snapshots': len(self.snapshots),
+        }
+        if summary['tracing']:
+            current, peak = tracemalloc.get_traced_memory()
+            summary['traced_current'] = current
+            summary['traced_peak'] = peak
+            summary['overhead'] = tracemalloc.get_tracemalloc_memory()
+        return summary
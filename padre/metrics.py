@@ -0,0 +1,218 @@
+import bisect
+import threading
+
+import six
+
+#: Content type of the (prometheus) text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+
+def _escape_label_value(value):
+    value = six.text_type(value)
+    return (value.replace("\\", "\\\\").
+            replace("\n", "\\n").replace('"', '\\"'))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_sample(name, labelnames, labelvalues, value, extra=None):
+    labels = ["%s=\"%s\"" % (k, _escape_label_value(v))
+              for k, v in zip(labelnames, labelvalues)]
+    if extra is not None:
+        labels.append("%s=\"%s\"" % extra)
+    if labels:
+        return "%s{%s} %s" % (name, ",".join(labels), _format_value(value))
+    return "%s %s" % (name, _format_value(value))
+
+
+class Metric(object):
+    """Base of all metrics (values are kept per set of label values)."""
+
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("Metric %s expects labels %s (not %s)"
+                             % (self.name, self.labelnames,
+                                sorted(labels)))
+        try:
+            return tuple(labels[k] for k in self.labelnames)
+        except KeyError:
+            raise ValueError("Metric %s expects labels %s (not %s)"
+                             % (self.name, self.labelnames,
+                                sorted(labels)))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _render_samples(self, values, lines):
+        for key, value in values:
+            lines.append(_format_sample(self.name, self.labelnames,
+                                        key, value))
+
+    def render(self, lines):
+        with self._lock:
+            values = sorted(self._copy_values().items())
+        lines.append("# HELP %s %s" % (self.name, self.doc))
+        lines.append("# TYPE %s %s" % (self.name, self.kind))
+        self._render_samples(values, lines)
+
+    def _copy_values(self):
+        return dict(self._values)
+
+
+class Counter(Metric):
+    """Value that only ever goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+
+class Gauge(Counter):
+    """Value that can go up and down (or be set)."""
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Counts observed values into (cumulative) buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # The +Inf bucket is the last one.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts = [0] * (len(self.buckets) + 1)
+                total = 0
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def _copy_values(self):
+        return dict((key, (list(counts), total))
+                    for key, (counts, total) in self._values.items())
+
+    def _render_samples(self, values, lines):
+        bounds = self.buckets + (float("inf"),)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(_format_sample(
+                    self.name + "_bucket", self.labelnames, key,
+                    cumulative, extra=("le", _format_value(bound))))
+            lines.append(_format_sample(self.name + "_sum",
+                                        self.labelnames, key, total))
+            lines.append(_format_sample(self.name + "_count",
+                                        self.labelnames, key, cumulative))
+
+
+class Registry(object):
+    """Collection of metrics that get rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._add(Counter(name, doc, labelnames=labelnames))
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._add(Gauge(name, doc, labelnames=labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, doc, labelnames=labelnames,
+                                   buckets=buckets))
+
+    def render(self, extra_metrics=None):
+        """Renders all metrics in the text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        if extra_metrics:
+            metrics.extend(extra_metrics)
+        lines = []
+        for metric in metrics:
+            metric.render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.counter(
+    "padre_messages_total",
+    "Messages submitted for processing.",
+    ('kind', 'sub_kind', 'channel'))
+
+DISPATCH_LATENCY = REGISTRY.histogram(
+    "padre_dispatch_latency_seconds",
+    "Seconds messages waited (after being submitted) to be processed.",
+    ('channel',))
+
+HANDLER_RUNS = REGISTRY.counter(
+    "padre_handler_runs_total",
+    "Handler runs (by handler class and outcome).",
+    ('handler', 'outcome'))
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    "padre_handler_duration_seconds",
+    "Seconds handlers took to run (by handler class).",
+    ('handler',))
+
+SCHEDULER_JOB_LAG = REGISTRY.histogram(
+    "padre_scheduler_job_lag_seconds",
+    "Seconds periodic jobs were submitted after they were scheduled for.")
+
+SENDER_CALLS = REGISTRY.counter(
+    "padre_sender_api_calls_total",
+    "Calls made to (chat) service apis by senders.",
+    ('sender', 'method', 'outcome'))
@@ -0,0 +1,85 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+from oslo_utils import timeutils
+
+
+def _frame_label(code):
+    # NOTE: only the last couple of path pieces are kept (that is enough
+    # to tell modules apart and keeps the stacks readable).
+    filename = "/".join(code.co_filename.split(os.sep)[-2:])
+    label = "%s (%s:%s)" % (code.co_name, filename, code.co_firstlineno)
+    # Semicolons separate frames in the collapsed format.
+    return label.replace(";", ":")
+
+
+class SamplingProfiler(object):
+    """Periodically samples (and counts) the stacks of all other threads.
+
+    The result is in the collapsed stack format used by flamegraph tools,
+    with each stack rooted at the name of the thread it was sampled from.
+    """
+
+    def __init__(self, rate=100, max_depth=128):
+        self.rate = rate
+        self.max_depth = max_depth
+        self.samples = 0
+
+    def _sample(self, counts, thread_names, my_ident):
+        frames = sys._current_frames()
+        try:
+            for t_ident, frame in frames.items():
+                if t_ident == my_ident:
+                    continue
+                codes = []
+                while frame is not None and len(codes) < self.max_depth:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                if t_ident not in thread_names:
+                    for t in threading.enumerate():
+                        thread_names[t.ident] = t.name
+                counts[(t_ident, tuple(codes))] += 1
+        finally:
+            # NOTE: don't hold onto frames (or create GC loops)...
+            frames.clear()
+            frame = None
+        self.samples += 1
+
+    def run(self, duration, dead=None):
+        """Samples for some number of seconds (or until dead is set)."""
+        interval = 1.0 / self.rate
+        counts = collections.Counter()
+        thread_names = {}
+        my_ident = threading.current_thread().ident
+        watch = timeutils.StopWatch(duration=duration)
+        watch.start()
+        while not watch.expired():
+            if dead is not None and dead.is_set():
+                break
+            self._sample(counts, thread_names, my_ident)
+            time.sleep(interval)
+        collapsed = collections.Counter()
+        labels = {}
+        for (t_ident, codes), count in counts.items():
+            stack = [thread_names.get(t_ident, str(t_ident))
+                     .replace(";", ":")]
+            for code in codes:
+                try:
+                    stack.append(labels[code])
+                except KeyError:
+                    labels[code] = _frame_label(code)
+                    stack.append(labels[code])
+            collapsed[";".join(stack)] += count
+        return collapsed
+
+    @staticmethod
+    def format_collapsed(collapsed):
+        lines = []
+        for stack, count in collapsed.most_common():
+            lines.append("%s %s" % (stack, count))
+        lines.append("")
+        return "\n".join(lines)
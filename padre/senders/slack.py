@@ -18,6 +18,7 @@ from tenacity.stop import stop_any
 from tenacity.stop import stop_when_event_set
 from tenacity.wait import wait_exponential
 
+from padre import metrics
 from padre import slack_utils as su
 
 LOG = logging.getLogger(__name__)
@@ -34,6 +35,26 @@ def _filter_message(message):
     return tmp_message
 
 
+class _counted(object):
+    """Counts (in metrics) the calls (and outcomes) of some api sender."""
+
+    def __init__(self, api_method, sender):
+        self.api_method = api_method
+        self.sender = sender
+
+    def __call__(self, *args, **kwargs):
+        try:
+            result = self.sender(*args, **kwargs)
+        except Exception:
+            metrics.SENDER_CALLS.inc(sender='slack', method=self.api_method,
+                                     outcome='failed')
+            raise
+        else:
+            metrics.SENDER_CALLS.inc(sender='slack', method=self.api_method,
+                                     outcome='ok')
+            return result
+
+
 def _convert_truthy(t):
     # TODO(harlowja): can we get rid of this function?
     if t is None:
@@ -183,7 +204,8 @@ class Sender(object):
                 pass
         r = self._make_retry(log=log, max_attempts=max_attempts,
                              max_backoff=max_backoff)
-        return r.call(sender, self.bot.clients.slack_client,
+        return r.call(_counted("chat.update", sender),
+                      self.bot.clients.slack_client,
                       message, timeout=self.bot.config.slack.get("timeout"))
 
     def files_upload(self, channels, content, filename,
@@ -207,7 +229,8 @@ class Sender(object):
         })
         r = self._make_retry(log=log, max_attempts=max_attempts,
                              max_backoff=max_backoff)
-        return r.call(sender, self.bot.clients.slack_client,
+        return r.call(_counted("files.upload", sender),
+                      self.bot.clients.slack_client,
                       message, timeout=self.bot.config.slack.get("timeout"))
 
     def im_open(self, user, return_im=True,
@@ -227,7 +250,8 @@ class Sender(object):
         })
         r = self._make_retry(log=log, max_attempts=max_attempts,
                              max_backoff=max_backoff)
-        return r.call(sender, self.bot.clients.slack_client,
+        return r.call(_counted("im.open", sender),
+                      self.bot.clients.slack_client,
                       message, timeout=self.bot.config.slack.get("timeout"))
 
     def post_send(self, channel, text=None, username=None, as_user=None,
@@ -272,7 +296,8 @@ class Sender(object):
                 pass
         r = self._make_retry(log=log, max_attempts=max_attempts,
                              max_backoff=max_backoff)
-        return r.call(sender, self.bot.clients.slack_client,
+        return r.call(_counted("chat.postMessage", sender),
+                      self.bot.clients.slack_client,
                       message, timeout=self.bot.config.slack.get("timeout"))
 
     def _emit_typing(self, channel, typed_chars):
@@ -327,6 +352,7 @@ class Sender(object):
                 pass
         r = self._make_retry(log=log, max_attempts=max_attempts,
                              max_backoff=max_backoff)
-        return r.call(sender, self.bot.clients.slack_client,
+        return r.call(_counted("rtm.send", sender),
+                      self.bot.clients.slack_client,
                       text, channel, thread=thread,
                       reply_broadcast=reply_broadcast)
@@ -0,0 +1,269 @@
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+import six
+
+LOG = logging.getLogger(__name__)
+
+# Entry operations (as written to the segment files).
+_ADD = 'add'
+_DONE = 'done'
+
+_SEGMENT_TPL = "spool-%012d.log"
+_SEGMENT_RE = re.compile(r"^spool-(\d+)\.log$")
+
+
+class SpoolEntry(object):
+    """Some (not yet marked as done) spooled entry."""
+
+    def __init__(self, entry_id, kind, data):
+        self.entry_id = entry_id
+        self.kind = kind
+        self.data = data
+
+    def __repr__(self):
+        return "SpoolEntry(%s, %r)" % (self.entry_id, self.kind)
+
+
+class Spool(object):
+    """Append-only (segmented) on-disk spool of accepted entries.
+
+    Each entry is appended (as a checksummed json line) to the current
+    segment file and later marked done by appending a done record for
+    it; on startup the segments are read back and whatever was added
+    but never marked done is given back (so it can be replayed).
+
+    Appends are fsynced in batches by a background thread (so that
+    concurrent appends share a single fsync); when ``fsync_wait`` is on
+    (the default) ``append`` does not return until the batch its entry
+    was in has been fsynced. Segments whose entries are all done (and
+    which are not the segment being written to) get removed.
+    """
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024,
+                 fsync_delay=0.005, fsync_wait=True):
+        self.path = path
+        self.segment_size = int(segment_size)
+        self.fsync_delay = float(fsync_delay)
+        self.fsync_wait = bool(fsync_wait)
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._dirty = threading.Event()
+        self._dying = threading.Event()
+        self._flusher = None
+        self._file = None
+        self._segment = None
+        self._next_id = 1
+        self._written_seq = 0
+        self._synced_seq = 0
+        # Segment number -> ids (added in it) not yet done.
+        self._pending = {}
+        # Entry id -> segment number it was added in.
+        self._entry_segments = {}
+
+    @classmethod
+    def from_config(cls, path, spool_config):
+        kwargs = {}
+        for k in ('segment_size', 'fsync_delay', 'fsync_wait'):
+            if k in spool_config:
+                kwargs[k] = spool_config[k]
+        return cls(path, **kwargs)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._entry_segments)
+
+    @staticmethod
+    def _encode(record):
+        blob = json.dumps(record, sort_keys=True, separators=(',', ':'))
+        if isinstance(blob, six.text_type):
+            blob = blob.encode("utf-8")
+        crc = zlib.crc32(blob) & 0xffffffff
+        return b"%08x " % crc + blob + b"\n"
+
+    @staticmethod
+    def _decode(line):
+        if not line.endswith(b"\n"):
+            # Torn (partially written) last line.
+            raise ValueError("Incomplete spool record")
+        crc, _sep, blob = line[0:-1].partition(b" ")
+        if int(crc, 16) != zlib.crc32(blob) & 0xffffffff:
+            raise ValueError("Spool record checksum mismatch")
+        return json.loads(blob.decode("utf-8"))
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.path):
+            match = _SEGMENT_RE.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, _SEGMENT_TPL % segment)
+
+    def _sync_dir(self):
+        # NOTE: segments get created (and removed) by changing the spool
+        # directory; unless that is fsynced too a crash can lose a whole
+        # segment (even one whose contents were fsynced).
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _read_segment(self, segment, entries):
+        with open(self._segment_path(segment), 'rb') as fh:
+            for line in fh:
+                try:
+                    record = self._decode(line)
+                except ValueError:
+                    LOG.warning("Skipping corrupt/incomplete record"
+                                " in spool segment %s", segment)
+                    continue
+                entry_id = record['id']
+                self._next_id = max(self._next_id, entry_id + 1)
+                if record['op'] == _ADD:
+                    entries[entry_id] = SpoolEntry(entry_id, record['kind'],
+                                                   record['data'])
+                    self._entry_segments[entry_id] = segment
+                    self._pending.setdefault(segment, set()).add(entry_id)
+                elif record['op'] == _DONE:
+                    entries.pop(entry_id, None)
+                    done_segment = self._entry_segments.pop(entry_id, None)
+                    if done_segment is not None:
+                        self._pending[done_segment].discard(entry_id)
+
+    def open(self):
+        """Opens the spool, returning the entries that were never done."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        entries = {}
+        segments = self._list_segments()
+        for segment in segments:
+            self._pending.setdefault(segment, set())
+            self._read_segment(segment, entries)
+        # Always start a new segment (never append after a possibly
+        # torn last record of a prior one).
+        if segments:
+            self._segment = segments[-1] + 1
+        else:
+            self._segment = 1
+        self._pending[self._segment] = set()
+        self._file = open(self._segment_path(self._segment), 'ab')
+        self._sync_dir()
+        self._remove_done_segments()
+        self._dying.clear()
+        self._flusher = threading.Thread(target=self._flush_forever)
+        self._flusher.daemon = True
+        self._flusher.start()
+        return [entries[entry_id] for entry_id in sorted(entries)]
+
+    def _write(self, record):
+        self._file.write(self._encode(record))
+        self._written_seq += 1
+        self._dirty.set()
+        return self._written_seq
+
+    def append(self, kind, data):
+        """Adds some entry to the spool (returning its entry id)."""
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("Spool is not open")
+            entry_id = self._next_id
+            self._next_id += 1
+            seq = self._write({'op': _ADD, 'id': entry_id,
+                               'kind': kind, 'data': data})
+            self._entry_segments[entry_id] = self._segment
+            self._pending[self._segment].add(entry_id)
+            if self.fsync_wait:
+                while self._synced_seq < seq and self._file is not None:
+                    self._synced.wait()
+        return entry_id
+
+    def mark_done(self, entry_id):
+        """Marks some entry as done (so that it will not be replayed)."""
+        with self._lock:
+            if self._file is None:
+                return
+            segment = self._entry_segments.pop(entry_id, None)
+            if segment is None:
+                return
+            self._pending[segment].discard(entry_id)
+            self._write({'op': _DONE, 'id': entry_id})
+
+    def _remove_done_segments(self):
+        # NOTE: segments are only ever removed oldest first, so that a done
+        # record for an entry is never removed before the entry itself.
+        removed = 0
+        for segment in sorted(self._pending):
+            if segment == self._segment or self._pending[segment]:
+                break
+            self._pending.pop(segment)
+            try:
+                os.unlink(self._segment_path(segment))
+            except OSError:
+                LOG.warning("Failed removing done spool segment %s",
+                            segment, exc_info=True)
+            else:
+                removed += 1
+        if removed:
+            self._sync_dir()
+
+    def _sync(self):
+        with self._lock:
+            fh = self._file
+            fh.flush()
+            seq = self._written_seq
+        # This is the slow part (and it is what batching amortizes); any
+        # appends that happen while this runs get picked up next time.
+        os.fsync(fh.fileno())
+        with self._lock:
+            if fh.tell() >= self.segment_size:
+                fh.flush()
+                os.fsync(fh.fileno())
+                seq = self._written_seq
+                self._segment += 1
+                self._pending[self._segment] = set()
+                self._file = open(self._segment_path(self._segment), 'ab')
+                fh.close()
+                # Before anything appended to it can count as synced.
+                self._sync_dir()
+            self._synced_seq = max(self._synced_seq, seq)
+            self._synced.notify_all()
+            self._remove_done_segments()
+
+    def _flush_forever(self):
+        while not self._dying.is_set():
+            self._dirty.wait()
+            self._dirty.clear()
+            if self.fsync_delay > 0:
+                # Give concurrent appends a chance to join this batch.
+                self._dying.wait(self.fsync_delay)
+            try:
+                self._sync()
+            except (IOError, OSError):
+                LOG.exception("Failed syncing spool segment %s",
+                              self._segment)
+                # Try again in a little while (appends waiting on this
+                # will keep on waiting until it works).
+                self._dying.wait(1.0)
+                self._dirty.set()
+
+    def close(self):
+        if self._flusher is not None:
+            self._dying.set()
+            self._dirty.set()
+            self._flusher.join()
+            self._flusher = None
+        if self._file is not None:
+            self._sync()
+            with self._lock:
+                self._file.close()
+                self._file = None
+                self._synced.notify_all()
@@ -83,7 +83,6 @@ def make_bot(user="AwesomeUser", password="somepassword",
     bot.brain = MockBrain()
     bot.calendars = munch.Munch()
     bot.locks = munch.Munch({
-        'brain': DummyLock(),
         'channel_stats': DummyLock(),
         'prior_handlers': DummyLock(),
     })
@@ -121,5 +120,17 @@ class MockBrain(object):
     def __getitem__(self, k):
         return self.storage[k]
 
+    def get_field(self, k, field):
+        return self.storage[k][field]
+
+    def set_field(self, k, field, v):
+        self.storage.setdefault(k, {})[field] = v
+
+    def pop_field(self, k, field):
+        return self.storage[k].pop(field)
+
+    def lock_for(self, k):
+        return DummyLock()
+
     def sync(self):
         pass
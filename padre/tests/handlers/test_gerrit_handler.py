@@ -0,0 +1,140 @@
+import munch
+from testtools import TestCase
+
+from padre.handlers import gerrit
+from padre.tests import common
+
+
+def _make_event(project, branch='master', email='someone@example.com'):
+    person = {'email': email, 'name': 'Someone', 'username': 'someone'}
+    return munch.munchify({
+        'change': {
+            'project': project,
+            'branch': branch,
+            'owner': person,
+        },
+        'patch_set': {
+            'author': person,
+            'uploader': person,
+        },
+        'uploader': person,
+    })
+
+
+class ChannelRoutesTest(TestCase):
+    def test_by_project(self):
+        routes = gerrit.ChannelRoutes([
+            {'channel': 'a', 'projects': ['nova', 'glance']},
+            {'channel': 'b', 'projects': ['*']},
+            {'channel': 'c', 'projects': ['glance']},
+            {'channel': 'd'},
+        ])
+        found = routes.find_targets(_make_event('glance'))
+        self.assertEqual(['a', 'b', 'c'], [t['channel'] for t in found])
+        found = routes.find_targets(_make_event('cinder'))
+        self.assertEqual(['b'], [t['channel'] for t in found])
+
+    def test_branches(self):
+        routes = gerrit.ChannelRoutes([
+            {'channel': 'a', 'projects': ['nova'],
+             'branches': ['master', 'stable/.*']},
+        ])
+        self.assertEqual(1, len(routes.find_targets(
+            _make_event('nova', branch='stable/queens'))))
+        self.assertEqual(0, len(routes.find_targets(
+            _make_event('nova', branch='feature/master'))))
+        self.assertEqual(0, len(routes.find_targets(
+            _make_event('nova', branch='master-2'))))
+
+    def test_emails(self):
+        routes = gerrit.ChannelRoutes([
+            {'channel': 'a', 'projects': ['*'],
+             'email_suffixes': ['@example.com']},
+            {'channel': 'b', 'projects': ['*'],
+             'email_suffixes': ['@elsewhere.com']},
+            {'channel': 'c', 'projects': ['*'],
+             'emails': ['me@elsewhere.com'],
+             'email_suffixes': ['@nowhere.com']},
+        ])
+        found = routes.find_targets(
+            _make_event('nova', email='me@elsewhere.com'))
+        self.assertEqual(['b', 'c'], [t['channel'] for t in found])
+
+    def test_setup_class(self):
+        bot = common.make_bot()
+        bot.config.gerrit = munch.munchify({
+            'channels': [{'channel': 'a', 'projects': ['nova']}],
+        })
+        self.addCleanup(setattr, gerrit.PatchSetCreatedHandler,
+                        'routes', None)
+        gerrit.PatchSetCreatedHandler.setup_class(bot)
+        found = gerrit.PatchSetCreatedHandler.routes.find_targets(
+            _make_event('nova'))
+        self.assertEqual(['a'], [t['channel'] for t in found])
+
+
+class UnfurlerTest(TestCase):
+    def setUp(self):
+        super(UnfurlerTest, self).setUp()
+        self.bot = common.make_bot()
+        self.bot.config.gerrit = munch.munchify({
+            'unfurl': {
+                'enabled': True,
+                'expand_for': ['review.example.com', 'review.other.org'],
+                'call_timeout': 1,
+                'cache_size': 10,
+                'cache_ttl': 60,
+            },
+        })
+        self.addCleanup(gerrit.Unfurler.setup_class, common.make_bot())
+        gerrit.Unfurler.setup_class(self.bot)
+
+    def test_find_matches(self):
+        text = ("see https://review.example.com/#/c/12/ and"
+                " http://review.other.org/34 but not"
+                " https://reviewXexample.com/56")
+        matches = gerrit.Unfurler._find_matches(text, self.bot.config.gerrit)
+        self.assertEqual([('review.example.com', 12, True),
+                          ('review.other.org', 34, False)],
+                         [(m.host, m.change_id, m.is_secure)
+                          for m in matches])
+
+    def test_fetch_changes_cached(self):
+        m = common.make_message(text="", channel="c")
+        h = gerrit.Unfurler(self.bot, m)
+        fetched = []
+
+        def fake_fetch(match, call_timeout):
+            fetched.append(match.change_id)
+            return munch.Munch({'number': match.change_id})
+
+        h._fetch_change = fake_fetch
+        text = ("https://review.example.com/12 https://review.example.com/13"
+                " https://review.other.org/12")
+        matches = gerrit.Unfurler._find_matches(text, self.bot.config.gerrit)
+        changes = h._fetch_changes(matches, 1)
+        self.assertEqual(3, len(changes))
+        self.assertEqual([12, 12, 13], sorted(fetched))
+        changes = h._fetch_changes(matches, 1)
+        self.assertEqual(3, len(changes))
+        self.assertEqual(3, len(fetched))
+        self.assertEqual(13, changes[('review.example.com', 13)].number)
+
+    def test_shared_executor_and_sessions(self):
+        executor = gerrit.Unfurler.executor
+        self.assertIsNotNone(executor)
+        m = common.make_message(text="", channel="c")
+        h = gerrit.Unfurler(self.bot, m)
+        sessions = []
+
+        def fake_fetch(match, call_timeout):
+            sessions.append(h._get_session())
+            return munch.Munch({'number': match.change_id})
+
+        h._fetch_change = fake_fetch
+        text = "https://review.example.com/12 https://review.example.com/13"
+        matches = gerrit.Unfurler._find_matches(text, self.bot.config.gerrit)
+        self.assertEqual(2, len(h._fetch_changes(matches, 1)))
+        self.assertIs(executor, gerrit.Unfurler.executor)
+        # Sessions are per-thread (and never the caller's own one).
+        self.assertNotIn(h._get_session(), sessions)
@@ -0,0 +1,101 @@
+import time
+
+import munch
+from testtools import TestCase
+
+from padre.handlers import sensu
+from padre import message
+from padre.tests import common
+
+
+def _make_event(client, check, status, output='broken'):
+    return munch.munchify({
+        'action': 'create',
+        'client': {'name': client},
+        'check': {'name': check, 'status': status, 'output': output},
+    })
+
+
+class SensuDigestTest(TestCase):
+    def setUp(self):
+        super(SensuDigestTest, self).setUp()
+        self.bot = common.make_bot()
+        self.bot.config.sensu.event_channels = ['#alerts']
+        self.bot.config.sensu.digest = {
+            'window': 300,
+            'update_interval': 0,
+        }
+        self.bot.slack_sender.post_send.return_value = {'ts': '1.1'}
+        sensu.BroadcastEventHandler.setup_class(self.bot)
+        self.addCleanup(sensu.BroadcastEventHandler.digests.clear)
+
+    def _process(self, event):
+        m = message.Message("sensu/create", {}, event)
+        h = sensu.BroadcastEventHandler(self.bot, m)
+        h._process_event(event, self.bot.config.sensu.event_channels)
+
+    def test_repeats_collapsed(self):
+        for i in range(0, 10):
+            self._process(_make_event('host-%s' % (i % 4), 'disk', 1))
+        self.assertEqual(1, self.bot.slack_sender.post_send.call_count)
+        sender = self.bot.slack_sender
+        self.assertEqual(9, sender.update_post_send.call_count)
+        args, kwargs = sender.update_post_send.call_args
+        self.assertEqual(('#alerts', '1.1'), args)
+        attachment = kwargs['attachments'][0]
+        self.assertIn("10 events from 4 hosts", attachment['text'])
+        hosts = [f['value'] for f in attachment['fields']
+                 if f['title'] == 'Hosts']
+        self.assertEqual(["host-0, host-1, host-2, host-3"], hosts)
+
+    def test_slack_called_unlocked(self):
+        locked = []
+        sender = self.bot.slack_sender
+
+        def post_send(**kwargs):
+            for digest in sensu.BroadcastEventHandler.digests.values():
+                locked.append(digest.lock.locked())
+            if sender.post_send.call_count == 1:
+                # Comes in while the first one is still being posted.
+                self._process(_make_event('host-2', 'disk', 1))
+            return {'ts': '1.1'}
+
+        def update_post_send(*args, **kwargs):
+            for digest in sensu.BroadcastEventHandler.digests.values():
+                locked.append(digest.lock.locked())
+
+        sender.post_send.side_effect = post_send
+        sender.update_post_send.side_effect = update_post_send
+        self._process(_make_event('host-1', 'disk', 1))
+        # The one that came in during the post gets sent by the flusher.
+        deadline = time.time() + 5
+        while not sender.update_post_send.called and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, sender.post_send.call_count)
+        self.assertEqual(1, sender.update_post_send.call_count)
+        self.assertEqual([False, False], locked)
+        attachment = sender.update_post_send.call_args[1]['attachments'][0]
+        self.assertIn("2 events from 2 hosts", attachment['text'])
+
+    def test_different_checks_not_collapsed(self):
+        self._process(_make_event('host-1', 'disk', 1))
+        self._process(_make_event('host-1', 'cpu', 1))
+        self.assertEqual(2, self.bot.slack_sender.post_send.call_count)
+        self.bot.slack_sender.update_post_send.assert_not_called()
+
+    def test_critical_transitions_bypass(self):
+        self._process(_make_event('host-1', 'disk', 2))
+        self._process(_make_event('host-2', 'disk', 2))
+        self._process(_make_event('host-2', 'disk', 2))
+        # The first two are new transitions into critical, the last one
+        # is just a repeat.
+        self.assertEqual(2, self.bot.slack_sender.post_send.call_count)
+        self.assertEqual(
+            2, self.bot.slack_sender.update_post_send.call_count)
+
+    def test_disabled(self):
+        self.bot.config.sensu.digest = {'enabled': False}
+        sensu.BroadcastEventHandler.setup_class(self.bot)
+        for _i in range(0, 3):
+            self._process(_make_event('host-1', 'disk', 1))
+        self.assertEqual(3, self.bot.slack_sender.post_send.call_count)
@@ -0,0 +1,319 @@
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import msgpack
+from oslo_serialization import msgpackutils as mu
+import sqlitedict
+from testtools import TestCase
+
+from padre import brain_utils as bu
+from padre import utils
+
+
+class CountingBrain(dict):
+    def __init__(self):
+        super(CountingBrain, self).__init__()
+        self.commits = 0
+        self.closed = False
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class WriteBehindBrainTest(TestCase):
+    def test_sync_durability_commits_every_write(self):
+        backing = CountingBrain()
+        brain = bu.WriteBehindBrain(backing, durability=bu.SYNC)
+        brain.start()
+        for i in range(0, 5):
+            brain["user:%s" % i] = {'aliases': {}}
+            self.assertEqual(i + 1, backing.commits)
+            brain.sync()
+        self.assertEqual(5, backing.commits)
+        del brain["user:0"]
+        self.assertEqual(6, backing.commits)
+        self.assertEqual(0, brain.close())
+        self.assertTrue(backing.closed)
+
+    def test_batched_groups_writes(self):
+        backing = CountingBrain()
+        brain = bu.WriteBehindBrain(backing, durability=bu.BATCHED,
+                                    batch_size=1000, flush_delay=60)
+        brain.start()
+        for i in range(0, 100):
+            brain["user:%s" % i] = {'aliases': {}}
+            brain.sync()
+        self.assertEqual(0, backing.commits)
+        self.assertEqual(100, brain.pending)
+        self.assertEqual(100, brain.flush())
+        self.assertEqual(1, backing.commits)
+        self.assertEqual(0, brain.flush())
+        self.assertEqual(1, backing.commits)
+        brain.close()
+
+    def test_batched_flushes_on_batch_size(self):
+        backing = CountingBrain()
+        brain = bu.WriteBehindBrain(backing, durability=bu.BATCHED,
+                                    batch_size=10, flush_delay=60)
+        brain.start()
+        flushed = threading.Event()
+        orig_commit = backing.commit
+
+        def commit():
+            orig_commit()
+            flushed.set()
+
+        backing.commit = commit
+        for i in range(0, 10):
+            brain["user:%s" % i] = {}
+        self.assertTrue(flushed.wait(10))
+        brain.close()
+        self.assertEqual(1, backing.commits)
+
+    def test_close_flushes(self):
+        backing = CountingBrain()
+        brain = bu.WriteBehindBrain(backing, durability=bu.BATCHED,
+                                    batch_size=1000, flush_delay=60)
+        brain.start()
+        brain["a"] = 1
+        brain["b"] = 2
+        brain.sync()
+        self.assertEqual(2, brain.close())
+        self.assertEqual(1, backing.commits)
+        self.assertTrue(backing.closed)
+
+    def test_failed_commit_stays_pending(self):
+        backing = CountingBrain()
+        brain = bu.WriteBehindBrain(backing, durability=bu.BATCHED,
+                                    batch_size=1000, flush_delay=60)
+        brain["a"] = 1
+        brain["b"] = 2
+
+        def commit():
+            raise IOError("Disk full")
+
+        backing.commit = commit
+        self.assertRaises(IOError, brain.flush)
+        self.assertEqual(2, brain.pending)
+        del backing.commit
+        self.assertEqual(2, brain.flush())
+        self.assertEqual(0, brain.pending)
+        self.assertEqual(1, backing.commits)
+
+    def test_bad_durability(self):
+        self.assertRaises(ValueError, bu.WriteBehindBrain,
+                          CountingBrain(), durability='sometimes')
+
+    def test_sqlitedict_roundtrip(self):
+        with utils.make_tmp_dir() as tmp_dir:
+            path = os.path.join(tmp_dir, "brain.sqlite")
+            brain = bu.WriteBehindBrain(
+                sqlitedict.SqliteDict(filename=path, tablename='padre',
+                                      autocommit=False, flag='c',
+                                      encode=mu.dumps, decode=mu.loads),
+                batch_size=1000, flush_delay=60)
+            brain.start()
+            brain['user:me'] = {'aliases': {'c': 'b'}}
+            brain.sync()
+            self.assertEqual({'aliases': {'c': 'b'}}, brain['user:me'])
+            brain.close()
+            brain = sqlitedict.SqliteDict(filename=path, tablename='padre',
+                                          flag='r', decode=mu.loads)
+            try:
+                self.assertEqual({'aliases': {'c': 'b'}}, brain['user:me'])
+            finally:
+                brain.close()
+
+
+class SqliteBrainTest(TestCase):
+    def setUp(self):
+        super(SqliteBrainTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "brain.sqlite")
+
+    def test_dict_like(self):
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        self.assertRaises(KeyError, brain.__getitem__, "user:me")
+        brain["user:me"] = {'aliases': {'c': 'b'}}
+        brain["user:you"] = {'aliases': {}}
+        self.assertIn("user:me", brain)
+        self.assertEqual({'aliases': {'c': 'b'}}, brain["user:me"])
+        self.assertEqual(2, brain.commit())
+        self.assertEqual(0, brain.commit())
+        del brain["user:you"]
+        self.assertNotIn("user:you", brain)
+        self.assertEqual(["user:me"], brain.keys())
+        brain.commit()
+        self.assertEqual([("user:me", {'aliases': {'c': 'b'}})],
+                         brain.items())
+        self.assertRaises(KeyError, brain.__delitem__, "user:you")
+
+    def test_uncommitted_visible_to_other_threads(self):
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        brain["a"] = 1
+        seen = []
+        t = threading.Thread(target=lambda: seen.append(brain["a"]))
+        t.start()
+        t.join()
+        self.assertEqual([1], seen)
+
+    def test_sqlitedict_compatible(self):
+        brain = bu.SqliteBrain(self.path)
+        brain["user:me"] = {'aliases': {'c': 'b'}}
+        brain.close()
+        brain = sqlitedict.SqliteDict(filename=self.path, tablename='padre',
+                                      decode=bu.RecordCodec().loads)
+        try:
+            self.assertEqual({'aliases': {'c': 'b'}}, brain['user:me'])
+        finally:
+            brain.close()
+
+    def test_reader_dropped_when_thread_exits(self):
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        brain["a"] = 1
+        brain.commit()
+        seen = []
+        t = threading.Thread(target=lambda: seen.append(brain["a"]))
+        t.start()
+        t.join()
+        self.assertEqual([1], seen)
+        self.assertEqual(1, brain.reader_count)
+        (_me_ref, conn), = brain._readers.values()
+        del t
+        gc.collect()
+        self.assertEqual(0, brain.reader_count)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+
+    def test_lock_for_stripes(self):
+        brain = bu.SqliteBrain(self.path, lock_stripes=4)
+        self.addCleanup(brain.close)
+        self.assertIs(brain.lock_for("user:me"), brain.lock_for("user:me"))
+        locks = set(id(brain.lock_for("user:%s" % i)) for i in range(100))
+        self.assertEqual(4, len(locks))
+
+    def test_concurrent_read_write(self):
+        num_keys = 8
+        num_writers = 4
+        num_readers = 8
+        writes_per_writer = 200
+        reads_per_reader = 500
+        brain = bu.WriteBehindBrain(bu.SqliteBrain(self.path),
+                                    batch_size=32, flush_delay=0.01)
+        brain.start()
+        for i in range(0, num_keys):
+            brain["counter:%s" % i] = {'count': 0}
+        brain.flush()
+        failures = []
+
+        def writer(offset):
+            for i in range(0, writes_per_writer):
+                key = "counter:%s" % ((i + offset) % num_keys)
+                with brain.lock_for(key):
+                    record = brain[key]
+                    record['count'] += 1
+                    brain[key] = record
+                    brain.sync()
+
+        def reader(offset):
+            for i in range(0, reads_per_reader):
+                key = "counter:%s" % ((i + offset) % num_keys)
+                try:
+                    brain[key]['count']
+                except Exception as e:
+                    failures.append(e)
+
+        threads = []
+        for i in range(0, num_writers):
+            threads.append(threading.Thread(target=writer, args=(i,)))
+        for i in range(0, num_readers):
+            threads.append(threading.Thread(target=reader, args=(i,)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        brain.close()
+        self.assertEqual([], failures)
+
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        total = sum(brain["counter:%s" % i]['count']
+                    for i in range(0, num_keys))
+        # Per-key locks mean no updates should have been lost.
+        self.assertEqual(num_writers * writes_per_writer, total)
+
+    def test_fields(self):
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        self.assertRaises(KeyError, brain.get_field, "user:me", "aliases")
+        brain.set_field("user:me", "aliases", {'c': 'b'})
+        brain.set_field("user:me", "name", "me")
+        self.assertEqual({'c': 'b'}, brain.get_field("user:me", "aliases"))
+        self.assertRaises(KeyError, brain.get_field, "user:me", "other")
+        brain.commit()
+        self.assertEqual({'aliases': {'c': 'b'}, 'name': 'me'},
+                         brain["user:me"])
+        self.assertEqual("me", brain.pop_field("user:me", "name"))
+        self.assertEqual({'aliases': {'c': 'b'}}, brain["user:me"])
+        self.assertRaises(KeyError, brain.pop_field, "user:me", "name")
+
+    def test_reads_legacy_blobs(self):
+        legacy = sqlitedict.SqliteDict(filename=self.path, tablename='padre',
+                                       autocommit=True, encode=mu.dumps,
+                                       decode=mu.loads)
+        legacy["user:me"] = {'aliases': {'c': 'b'}}
+        legacy.close()
+        brain = bu.SqliteBrain(self.path)
+        self.addCleanup(brain.close)
+        self.assertEqual({'aliases': {'c': 'b'}}, brain["user:me"])
+        self.assertEqual({'c': 'b'}, brain.get_field("user:me", "aliases"))
+        brain.set_field("user:me", "name", "me")
+        self.assertEqual({'aliases': {'c': 'b'}, 'name': 'me'},
+                         brain["user:me"])
+
+
+class RecordCodecTest(TestCase):
+    def test_roundtrip(self):
+        codec = bu.RecordCodec()
+        for value in [1, "a", [1, 2], {'a': {'b': [1, 2]}}, {}]:
+            self.assertEqual(value, codec.loads(codec.dumps(value)))
+
+    def test_schema_tagged(self):
+        codec = bu.RecordCodec(schema_versions={'user': 2})
+        self.assertEqual('user', codec.schema_for("user:me"))
+        self.assertEqual('', codec.schema_for("me"))
+        blob = codec.dumps({'a': 1}, schema='user')
+        self.assertEqual(['user', 2, 'r'],
+                         msgpack.unpackb(blob[1:], raw=False)[0:3])
+
+    def test_fields_decoded_lazily(self):
+        loaded = []
+
+        def field_loads(blob):
+            value = mu.loads(blob)
+            loaded.append(value)
+            return value
+
+        codec = bu.RecordCodec(field_loads=field_loads)
+        blob = codec.dumps({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(2, codec.load_field(blob, 'b'))
+        self.assertEqual([2], loaded)
+        blob = codec.dump_field(blob, 'd', 4)
+        self.assertEqual([2], loaded)
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3, 'd': 4}, codec.loads(blob))
+
+    def test_non_record_fields(self):
+        codec = bu.RecordCodec()
+        blob = codec.dumps([1, 2])
+        self.assertRaises(TypeError, codec.load_field, blob, 'a')
+        self.assertRaises(TypeError, codec.dump_field, blob, 'a', 1)
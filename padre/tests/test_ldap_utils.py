@@ -0,0 +1,267 @@
+import threading
+
+import ldap
+from ldap import controls as ldap_controls
+import mock
+from testtools import TestCase
+
+from padre import ldap_utils
+
+
+class FakeConnection(object):
+    """In-process stand-in for a (bound) ldap connection."""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.searches = 0
+        self.unbound = False
+        self.broken = False
+
+    def whoami_s(self):
+        if self.broken:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        return "u:me"
+
+    def search_s(self, base, scope, filter, attrlist=None):
+        if self.broken:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        self.searches += 1
+        return self.entries.get(filter, [])
+
+    def search_ext(self, base, scope, filter, attrlist=None,
+                   serverctrls=None):
+        page_control = serverctrls[0]
+        results = self.search_s(base, scope, filter, attrlist=attrlist)
+        start = int(page_control.cookie or 0)
+        end = start + page_control.size
+        self.pending = (results[start:end],
+                        str(end).encode() if end < len(results) else b'')
+        return 1
+
+    def result3(self, msgid):
+        page, cookie = self.pending
+        ctrl = ldap_controls.SimplePagedResultsControl(
+            True, size=len(page), cookie=cookie)
+        return (ldap.RES_SEARCH_RESULT, page, msgid, [ctrl])
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class ConnectionPoolTest(TestCase):
+    def test_reused(self):
+        connect = mock.MagicMock(side_effect=FakeConnection)
+        pool = ldap_utils.ConnectionPool(connect)
+        for _i in range(0, 5):
+            with pool.connection() as client:
+                client.whoami_s()
+        self.assertEqual(1, connect.call_count)
+        self.assertEqual(1, pool.idle)
+        pool.close()
+        self.assertEqual(0, pool.size)
+
+    def test_bounded(self):
+        connect = mock.MagicMock(side_effect=FakeConnection)
+        pool = ldap_utils.ConnectionPool(connect, max_size=2)
+        holding = [threading.Event(), threading.Event()]
+        done = threading.Event()
+        third = []
+
+        def user(holding_ev):
+            with pool.connection():
+                holding_ev.set()
+                done.wait()
+
+        def third_user():
+            with pool.connection() as client:
+                third.append(client)
+
+        threads = [threading.Thread(target=user, args=(ev,))
+                   for ev in holding]
+        for t in threads:
+            t.start()
+        for ev in holding:
+            ev.wait()
+        self.assertEqual(2, pool.size)
+        t3 = threading.Thread(target=third_user)
+        t3.start()
+        t3.join(0.1)
+        self.assertEqual([], third)
+        done.set()
+        for t in threads + [t3]:
+            t.join()
+        self.assertEqual(1, len(third))
+        self.assertEqual(2, connect.call_count)
+
+    def test_broken_discarded(self):
+        conns = []
+
+        def connect():
+            conns.append(FakeConnection())
+            return conns[-1]
+
+        pool = ldap_utils.ConnectionPool(connect)
+        with pool.connection():
+            pass
+        conns[0].broken = True
+        try:
+            with pool.connection() as client:
+                client.whoami_s()
+        except ldap.SERVER_DOWN:
+            pass
+        self.assertTrue(conns[0].unbound)
+        self.assertEqual(0, pool.size)
+
+    def test_idle_timeout(self):
+        connect = mock.MagicMock(side_effect=FakeConnection)
+        pool = ldap_utils.ConnectionPool(connect, idle_timeout=0)
+        with pool.connection():
+            pass
+        with pool.connection():
+            pass
+        self.assertEqual(2, connect.call_count)
+
+    def test_closed(self):
+        conns = []
+
+        def connect():
+            conns.append(FakeConnection())
+            return conns[-1]
+
+        pool = ldap_utils.ConnectionPool(connect)
+        with pool.connection():
+            with pool.connection():
+                pass
+            pool.close()
+            # The idle one was closed, the one in use is once released.
+            self.assertEqual(1, pool.size)
+        self.assertTrue(all(conn.unbound for conn in conns))
+        self.assertEqual(0, pool.size)
+        self.assertRaises(RuntimeError, pool.connection().__enter__)
+        self.assertEqual(2, len(conns))
+
+    def test_drop_idle(self):
+        connect = mock.MagicMock(side_effect=FakeConnection)
+        pool = ldap_utils.ConnectionPool(connect)
+        with pool.connection():
+            pass
+        pool.drop_idle()
+        self.assertEqual(0, pool.size)
+        # Still usable (unlike once closed).
+        with pool.connection():
+            pass
+        self.assertEqual(2, connect.call_count)
+
+
+class LdapClientTest(TestCase):
+    def _make_client(self, connect_func, **kwargs):
+        client = ldap_utils.LdapClient("ldap://localhost", "CN=bind", "pw",
+                                       "ou=users", "ou=services", "ou=groups",
+                                       **kwargs)
+        client._make_ldap_client = connect_func
+        client._pool._connect_func = connect_func
+        return client
+
+    def test_rebinds_after_server_down(self):
+        conns = []
+        user_filter = ("(&(objectClass=organizationalPerson)"
+                       "(!(objectClass=computer))"
+                       "(sAMAccountName=joe))")
+        entries = {
+            user_filter: [("CN=joe,ou=users", {})],
+            "(&(objectClass=group)(name=admins))": [
+                ("CN=admins,ou=groups", {'member': ["CN=joe,ou=users"]}),
+            ],
+            "(&(objectClass=group)(|(name=joe)))": [],
+        }
+
+        def connect():
+            conns.append(FakeConnection(entries))
+            return conns[-1]
+
+        client = self._make_client(connect)
+        self.assertEqual("u:me", client.whoami())
+        conns[0].broken = True
+        self.assertTrue(client.is_allowed("joe", ["admins"]))
+        self.assertEqual(2, len(conns))
+        self.assertTrue(conns[0].unbound)
+
+    def test_nested_groups_batched(self):
+        users = ["CN=user%s,ou=users" % i for i in range(0, 10)]
+        entries = {
+            "(&(objectClass=group)(name=top))": [
+                ("CN=top,ou=groups", {
+                    'member': users[0:4] + ["CN=sub,ou=groups"],
+                }),
+            ],
+            "(&(objectClass=group)(|(name=sub)(name=user3)))": [
+                ("CN=sub,OU=groups", {
+                    'member': [u.encode("utf8") for u in users[4:10]],
+                }),
+                # Same name, but not the group that is a member.
+                ("CN=sub,ou=elsewhere", {
+                    'member': [b"CN=intruder,ou=users"],
+                }),
+            ],
+        }
+        conn = FakeConnection(entries)
+        client = self._make_client(lambda: conn, group_batch_size=3,
+                                   transitive_groups=False, page_size=2)
+        self.assertEqual(set(users), client.list_ldap_group("top"))
+        # One for the group itself, then one per batch of (up to) 3
+        # members (2 batches for it and then 2 for the nested group).
+        self.assertEqual(1 + 2 + 2, conn.searches)
+
+    def test_transitive_groups(self):
+        member_filter = ("(&(memberOf:1.2.840.113556.1.4.1941:="
+                         "CN=top,ou=groups)(!(objectClass=group)))")
+        users = ["CN=user%s,ou=users" % i for i in range(0, 5)]
+        entries = {
+            "(objectClass=*)": [
+                ("", {
+                    'supportedCapabilities': [
+                        ldap_utils.ACTIVE_DIRECTORY_OID.encode("ascii"),
+                    ],
+                    'defaultNamingContext': [b"dc=example,dc=com"],
+                }),
+            ],
+            "(&(objectClass=group)(name=top))": [
+                ("CN=top,ou=groups", {'member': ["CN=sub,ou=groups"]}),
+            ],
+            member_filter: [(u, {}) for u in users],
+        }
+        conn = FakeConnection(entries)
+        client = self._make_client(lambda: conn, page_size=2)
+        self.assertEqual(set(users), client.list_ldap_group("top"))
+        # Root dse, the group itself and 3 pages of members.
+        self.assertEqual(1 + 1 + 3, conn.searches)
+
+    def test_transitive_groups_root_dse_errors(self):
+        conns = []
+        entries = {
+            "(objectClass=*)": [
+                ("", {
+                    'supportedCapabilities': [
+                        ldap_utils.ACTIVE_DIRECTORY_OID.encode("ascii"),
+                    ],
+                    'defaultNamingContext': [b"dc=example,dc=com"],
+                }),
+            ],
+        }
+
+        def connect():
+            conns.append(FakeConnection(entries))
+            return conns[-1]
+
+        client = self._make_client(connect)
+        conn = connect()
+        conn.broken = True
+        # Connection errors go to the caller (so it can retry them).
+        self.assertRaises(ldap.SERVER_DOWN,
+                          client._use_transitive_groups, conn)
+        conn.broken = False
+        with mock.patch.object(conn, 'search_s',
+                               side_effect=ldap.NO_SUCH_OBJECT({})):
+            self.assertFalse(client._use_transitive_groups(conn))
+        # Neither of those was remembered.
+        self.assertTrue(client._use_transitive_groups(conn))
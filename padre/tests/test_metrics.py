@@ -0,0 +1,44 @@
+from testtools import TestCase
+
+from padre import metrics
+
+
+class MetricsTest(TestCase):
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = registry.counter("things_total", "Things.", ('kind',))
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"c')
+        self.assertEqual(3, counter.get(kind='a'))
+        self.assertRaises(ValueError, counter.inc, other='a')
+        self.assertEqual("\n".join([
+            "# HELP things_total Things.",
+            "# TYPE things_total counter",
+            'things_total{kind="a"} 3',
+            'things_total{kind="b\\"c"} 1',
+            "",
+        ]), registry.render())
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("depth", "Depth.")
+        gauge.set(4)
+        gauge.dec()
+        lines = []
+        gauge.render(lines)
+        self.assertEqual("depth 3", lines[-1])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("took_seconds", "Took.",
+                                      buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value)
+        lines = []
+        histogram.render(lines)
+        self.assertEqual([
+            'took_seconds_bucket{le="0.1"} 2',
+            'took_seconds_bucket{le="1"} 3',
+            'took_seconds_bucket{le="+Inf"} 4',
+            'took_seconds_sum 5.65',
+            'took_seconds_count 4',
+        ], lines[2:])
@@ -0,0 +1,40 @@
+import threading
+
+from testtools import TestCase
+
+from padre import profile_utils
+
+
+def _spin_until(ev):
+    while not ev.is_set():
+        ev.wait(0.001)
+
+
+class SamplingProfilerTest(TestCase):
+    def test_collapsed_by_thread(self):
+        ev = threading.Event()
+        t = threading.Thread(target=_spin_until, args=(ev,),
+                             name="spinner-thread")
+        t.start()
+        try:
+            profiler = profile_utils.SamplingProfiler(rate=200)
+            collapsed = profiler.run(0.2)
+        finally:
+            ev.set()
+            t.join()
+        self.assertGreater(profiler.samples, 0)
+        spinner_stacks = [stack for stack in collapsed
+                          if stack.startswith("spinner-thread;")]
+        self.assertNotEqual([], spinner_stacks)
+        self.assertTrue(any("_spin_until (tests/test_profile_utils.py:"
+                            in stack for stack in spinner_stacks))
+        for line in profiler.format_collapsed(collapsed).splitlines():
+            _stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+
+    def test_stops_when_dead(self):
+        dead = threading.Event()
+        dead.set()
+        profiler = profile_utils.SamplingProfiler()
+        profiler.run(60, dead=dead)
+        self.assertEqual(0, profiler.samples)
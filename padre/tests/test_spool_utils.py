@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+from testtools import TestCase
+
+from padre import channel as c
+from padre import message
+from padre import spool_utils as spu
+from padre import wsgi_utils as wu
+
+
+class SpoolTest(TestCase):
+    def setUp(self):
+        super(SpoolTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "spool")
+
+    def _open(self, **kwargs):
+        spool = spu.Spool(self.path, **kwargs)
+        self.addCleanup(spool.close)
+        return spool, spool.open()
+
+    def test_replays_not_done(self):
+        spool, entries = self._open()
+        self.assertEqual([], entries)
+        a = spool.append("test", {'a': 1})
+        b = spool.append("test", {'b': 2})
+        spool.append("other", [1, 2])
+        spool.mark_done(b)
+        self.assertEqual(2, spool.pending)
+        spool.close()
+        spool, entries = self._open()
+        self.assertEqual([(a, "test", {'a': 1}), (b + 1, "other", [1, 2])],
+                         [(e.entry_id, e.kind, e.data) for e in entries])
+        self.assertEqual(2, spool.pending)
+        # Ids keep on going up (and replayed entries can be marked done).
+        self.assertEqual(b + 2, spool.append("test", {}))
+        for e in entries:
+            spool.mark_done(e.entry_id)
+        spool.close()
+        spool, entries = self._open()
+        self.assertEqual([b + 2], [e.entry_id for e in entries])
+
+    def test_skips_torn_record(self):
+        spool, _entries = self._open()
+        spool.append("test", {'a': 1})
+        spool.close()
+        segment = os.path.join(self.path, os.listdir(self.path)[0])
+        with open(segment, 'ab') as fh:
+            fh.write(b"0000 {\"op\": \"a")
+        spool, entries = self._open()
+        self.assertEqual([{'a': 1}], [e.data for e in entries])
+
+    def test_done_segments_removed(self):
+        spool, _entries = self._open(segment_size=256)
+        ids = [spool.append("test", {'i': i, 'pad': "x" * 64})
+               for i in range(0, 20)]
+        self.assertGreater(len(os.listdir(self.path)), 2)
+        for entry_id in ids:
+            spool.mark_done(entry_id)
+        spool.close()
+        spool, entries = self._open(segment_size=256)
+        self.assertEqual([], entries)
+        self.assertEqual(1, len(os.listdir(self.path)))
+
+    def test_dir_synced(self):
+        spool = spu.Spool(self.path, segment_size=256)
+        self.addCleanup(spool.close)
+        with mock.patch.object(spool, '_sync_dir',
+                               wraps=spool._sync_dir) as sync_dir:
+            spool.open()
+            # Creating the first segment.
+            self.assertEqual(1, sync_dir.call_count)
+            ids = [spool.append("test", {'i': i, 'pad': "x" * 64})
+                   for i in range(0, 4)]
+            # Creating the next segment(s).
+            created = sync_dir.call_count
+            self.assertGreater(created, 1)
+            for entry_id in ids:
+                spool.mark_done(entry_id)
+            spool.append("test", {'pad': "x" * 256})
+            spool.close()
+        # Removing the done segment(s).
+        self.assertGreater(sync_dir.call_count, created)
+
+    def test_concurrent_appends(self):
+        spool, _entries = self._open(fsync_delay=0.01)
+        ids = []
+        ids_lock = threading.Lock()
+
+        def appender(i):
+            for j in range(0, 25):
+                entry_id = spool.append("test", {'i': i, 'j': j})
+                with ids_lock:
+                    ids.append(entry_id)
+
+        threads = [threading.Thread(target=appender, args=(i,))
+                   for i in range(0, 8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(200, len(set(ids)))
+        spool.close()
+        _spool, entries = self._open()
+        self.assertEqual(sorted(ids), [e.entry_id for e in entries])
+
+
+class HookSpoolTest(TestCase):
+    def setUp(self):
+        super(HookSpoolTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "spool")
+
+    def test_submit_and_replay(self):
+        bot = mock.MagicMock()
+        bot.spool = spu.Spool(self.path)
+        bot.spool.open()
+        self.addCleanup(bot.spool.close)
+        futs = []
+
+        def submit_message(m, channel):
+            fut = mock.MagicMock()
+            futs.append(fut)
+            return fut
+
+        bot.submit_message.side_effect = submit_message
+        m = message.Message("sensu/resolve", {message.TO_ME_HEADER: True},
+                            {'check': {'name': 'disk'}})
+        wu.submit_hook_message(bot, m)
+        bot.submit_message.assert_any_call(m, c.BROADCAST)
+        bot.submit_message.assert_any_call(m, c.TARGETED)
+        bot.spool.close()
+
+        # Nothing got done, so it should get replayed.
+        bot.spool = spu.Spool(self.path)
+        entries = bot.spool.open()
+        self.addCleanup(bot.spool.close)
+        self.assertEqual(1, len(entries))
+        del futs[:]
+        bot.submit_message.reset_mock()
+        self.assertEqual(1, wu.replay_hook_messages(bot, entries))
+        replayed = bot.submit_message.call_args[0][0]
+        self.assertEqual("sensu", replayed.kind)
+        self.assertEqual("resolve", replayed.sub_kind)
+        self.assertEqual("disk", replayed.body.check.name)
+        for fut in futs:
+            for call in fut.add_done_callback.call_args_list:
+                call[0][0](fut)
+        self.assertEqual(0, bot.spool.pending)
@@ -0,0 +1,201 @@
+import hashlib
+import hmac
+import io
+import socket
+import time
+
+import futurist
+from six.moves import http_client
+from testtools import TestCase
+
+from padre import wsgi_utils as wu
+
+
+def _echo_app(environ, start_response):
+    if environ['PATH_INFO'] == '/ignore':
+        start_response("204 No Content", [])
+        return []
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    if environ['PATH_INFO'] == '/stream':
+        start_response("200 OK", [('Content-Type', 'text/plain')])
+        return [b"a", b"b", b"c"]
+    if environ['PATH_INFO'] == '/broken':
+        raise RuntimeError("Broken")
+    body = environ['PATH_INFO'].encode("ascii") + b":" + body
+    start_response("200 OK", [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class ReadBodyTest(TestCase):
+    def _sign(self, blob, secret=b"secret"):
+        return "sha256=" + hmac.new(secret, blob, hashlib.sha256).hexdigest()
+
+    def test_read_chunked_and_signed(self):
+        blob = b"x" * 1000
+        checker = wu.SignatureChecker(self._sign(blob), "secret")
+        body = wu.read_body(io.BytesIO(blob), len(blob),
+                            checker=checker, chunk_size=64)
+        self.assertEqual(blob, body)
+        checker.verify()
+
+    def test_bad_signature(self):
+        checker = wu.SignatureChecker(self._sign(b"other"), "secret")
+        wu.read_body(io.BytesIO(b"blob"), 4, checker=checker)
+        self.assertRaises(wu.BadSignature, checker.verify)
+
+    def test_too_large_not_read(self):
+        body_file = io.BytesIO(b"x" * 100)
+        self.assertRaises(wu.BodyTooLarge, wu.read_body,
+                          body_file, 100, max_bytes=99)
+        self.assertEqual(0, body_file.tell())
+
+    def test_short_body(self):
+        self.assertEqual(b"abc", wu.read_body(io.BytesIO(b"abc"), 10))
+
+
+class RequestBodyTest(TestCase):
+    def _make_body(self, buffered, length, send_continue=False):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        body = wu.RequestBody(ours, buffered, length, 5, time.time() + 5,
+                              send_continue=send_continue)
+        return body, theirs
+
+    def test_read_buffered_then_socket(self):
+        body, sock = self._make_body(b"abc", 6)
+        self.assertFalse(body.fully_read)
+        sock.sendall(b"def")
+        self.assertEqual(b"ab", body.read(2))
+        self.assertEqual(b"cdef", body.read())
+        self.assertTrue(body.fully_read)
+        self.assertEqual(b"", body.read())
+
+    def test_readline(self):
+        body, sock = self._make_body(b"a\nb", 7)
+        sock.sendall(b"c\nde")
+        self.assertEqual([b"a\n", b"bc\n", b"de"], list(body))
+
+    def test_continue_sent_on_read(self):
+        body, sock = self._make_body(b"", 2, send_continue=True)
+        sock.settimeout(0)
+        self.assertRaises(socket.error, sock.recv, 4096)
+        sock.sendall(b"hi")
+        self.assertEqual(b"hi", body.read())
+        sock.settimeout(5)
+        self.assertEqual(b"HTTP/1.1 100 Continue\r\n\r\n", sock.recv(4096))
+
+    def test_client_gone(self):
+        body, sock = self._make_body(b"", 10)
+        sock.sendall(b"hi")
+        sock.close()
+        self.assertRaises(socket.error, body.read)
+
+
+class KeepAliveWSGIServerTest(TestCase):
+    def setUp(self):
+        super(KeepAliveWSGIServerTest, self).setUp()
+        self.executor = futurist.ThreadPoolExecutor(max_workers=2)
+        self.server = wu.make_keepalive_server(
+            'localhost', 0, _echo_app, self.executor,
+            server_config={'max_request_bytes': 1024,
+                           'max_keepalive_requests': 3})
+        self.runner = futurist.ThreadPoolExecutor(max_workers=1)
+        self.runner.submit(self.server.serve_forever)
+        self.addCleanup(self.runner.shutdown)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.executor.shutdown)
+        self.host, self.port = self.server.server_address
+
+    def _make_conn(self):
+        conn = http_client.HTTPConnection(self.host, self.port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_keep_alive(self):
+        conn = self._make_conn()
+        socks = set()
+        for i in range(0, 2):
+            conn.request("POST", "/echo/%s" % i, body=b"hi")
+            resp = conn.getresponse()
+            self.assertEqual(200, resp.status)
+            self.assertEqual(("/echo/%s:hi" % i).encode("ascii"),
+                             resp.read())
+            self.assertIsNone(resp.getheader("Connection"))
+            socks.add(id(conn.sock))
+        # Same connection/socket should have been used for both.
+        self.assertEqual(1, len(socks))
+
+    def test_max_keepalive_requests(self):
+        conn = self._make_conn()
+        for i in range(0, 3):
+            conn.request("GET", "/")
+            resp = conn.getresponse()
+            resp.read()
+        self.assertEqual("close", resp.getheader("Connection"))
+
+    def test_chunked_response(self):
+        conn = self._make_conn()
+        conn.request("GET", "/stream")
+        resp = conn.getresponse()
+        self.assertEqual("chunked", resp.getheader("Transfer-Encoding"))
+        self.assertEqual(b"abc", resp.read())
+        conn.request("GET", "/stream")
+        self.assertEqual(b"abc", conn.getresponse().read())
+
+    def test_head(self):
+        conn = self._make_conn()
+        conn.request("HEAD", "/stream")
+        resp = conn.getresponse()
+        self.assertEqual(200, resp.status)
+        self.assertEqual(b"", resp.read())
+        conn.request("GET", "/a")
+        self.assertEqual(b"/a:", conn.getresponse().read())
+
+    def test_too_large(self):
+        conn = self._make_conn()
+        conn.request("POST", "/", body=b"a" * 2048)
+        resp = conn.getresponse()
+        self.assertEqual(413, resp.status)
+        self.assertEqual("close", resp.getheader("Connection"))
+
+    def test_unread_body_closes(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(b"POST /ignore HTTP/1.1\r\nHost: x\r\n"
+                     b"Content-Length: 500\r\n\r\nabc")
+        data = b""
+        while True:
+            buf = sock.recv(4096)
+            if not buf:
+                break
+            data += buf
+        self.assertTrue(data.startswith(b"HTTP/1.1 204"))
+        self.assertIn(b"Connection: close", data)
+
+    def test_app_failure(self):
+        conn = self._make_conn()
+        conn.request("GET", "/broken")
+        self.assertEqual(500, conn.getresponse().status)
+
+    def test_pipelined(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /b HTTP/1.1\r\nHost: x\r\nConnection: close"
+                     b"\r\n\r\n")
+        data = b""
+        while True:
+            buf = sock.recv(4096)
+            if not buf:
+                break
+            data += buf
+        self.assertEqual(2, data.count(b"HTTP/1.1 200 OK"))
+        self.assertTrue(data.endswith(b"/b:"))
+
+    def test_bad_request(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(b"NOPE\r\n\r\n")
+        self.assertTrue(sock.recv(4096).startswith(b"HTTP/1.1 400"))
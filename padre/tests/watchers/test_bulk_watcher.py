@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import time
+
+import futurist
+from testtools import TestCase
+
+from padre import channel as c
+from padre.tests import common
+from padre.watchers import bulk
+
+
+class BulkWatcherTest(TestCase):
+    def setUp(self):
+        super(BulkWatcherTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.bot = common.make_bot()
+        self.submitted = []
+
+        def submit_message(m, channel):
+            fut = futurist.Future()
+            self.submitted.append((m, channel, fut))
+            return fut
+
+        self.bot.submit_message.side_effect = submit_message
+
+    def _make_watcher(self, **conf):
+        conf.setdefault('path', os.path.join(self.tmp_dir, "bulk.sock"))
+        watcher = bulk.Watcher(self.bot, conf)
+        watcher.setup()
+        self.addCleanup(watcher._teardown)
+        return watcher
+
+    def _connect(self, watcher):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        theirs.settimeout(0)
+        conn = watcher._add_conn(ours, "bulk:test")
+        return conn, theirs
+
+    def _pump(self, watcher, sock, until, timeout=5):
+        """Runs the watcher loop (collecting what it sends) until told."""
+        events = []
+        buf = b""
+        closed = False
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            watcher._run_once(0.01)
+            try:
+                data = sock.recv(64 * 1024)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            if data == b"":
+                closed = True
+            elif data:
+                buf += data
+                lines = buf.split(b"\n")
+                buf = lines.pop()
+                events.extend(json.loads(line.decode("utf8"))
+                              for line in lines)
+            if until(events, closed):
+                return events, closed
+        self.fail("Gave up waiting (got %s, closed=%s)" % (events, closed))
+
+    @staticmethod
+    def _send(sock, *reqs):
+        sock.sendall(b"".join(json.dumps(req).encode("utf8") + b"\n"
+                              for req in reqs))
+
+    def test_requests_parsed_and_ids_echoed(self):
+        watcher = self._make_watcher()
+        _conn, sock = self._connect(watcher)
+        sock.sendall(b'{"id": "a", "text": "hi"}\n\nnot json\n'
+                     b'{"id": 7, "text": "more", "thread": 0}\n')
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 3)
+        self.assertEqual([('a', 'accepted'), (None, 'error'),
+                          (7, 'accepted')],
+                         [(e['id'], e['type']) for e in events])
+        self.assertEqual(["hi", "more"],
+                         [m.body.text for m, _ch, _fut in self.submitted])
+        self.assertEqual([c.TARGETED, c.FOLLOWUP],
+                         [ch for _m, ch, _fut in self.submitted])
+        self.assertEqual("0", self.submitted[1][0].body.thread_ts)
+
+    def test_out_of_order_completion(self):
+        watcher = self._make_watcher()
+        _conn, sock = self._connect(watcher)
+        self._send(sock, {'id': 1, 'text': 'slow'}, {'id': 2, 'text': 'fast'})
+        self._pump(watcher, sock, lambda events, closed: len(events) >= 2)
+        (m1, _ch, fut1), (m2, _ch, fut2) = self.submitted
+        m2.reply_text("working")
+        fut2.set_result("fast done")
+        fut1.set_exception(RuntimeError("broke"))
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 3)
+        self.assertEqual([(2, 'reply'), (2, 'result'), (1, 'result')],
+                         [(e['id'], e['type']) for e in events])
+        self.assertEqual("working", events[0]['text'])
+        self.assertEqual((True, "fast done"),
+                         (events[1]['ok'], events[1]['result']))
+        self.assertEqual((False, "RuntimeError"),
+                         (events[2]['ok'], events[2]['error_type']))
+
+    def test_half_close(self):
+        watcher = self._make_watcher()
+        conn, sock = self._connect(watcher)
+        sock.sendall(b'{"id": 1, "text": "one"}\n{"id": 2, "text": "two"}')
+        sock.shutdown(socket.SHUT_WR)
+        self._pump(watcher, sock, lambda events, closed: len(events) >= 2)
+        # Both requests (even the one lacking a newline) were taken, and
+        # the connection is kept open until their results are sent.
+        self.assertEqual(2, len(self.submitted))
+        self.assertTrue(conn.eof)
+        self.submitted[0][2].set_result("one done")
+        events, closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 1)
+        self.assertFalse(closed)
+        self.submitted[1][2].set_result("two done")
+        events, closed = self._pump(
+            watcher, sock, lambda events, closed: closed)
+        self.assertEqual([(2, 'result')],
+                         [(e['id'], e['type']) for e in events])
+
+    def test_oversize_line(self):
+        watcher = self._make_watcher(max_line_length=100)
+        _conn, sock = self._connect(watcher)
+        sock.sendall(b"x" * 200)
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: closed)
+        self.assertEqual(['error'], [e['type'] for e in events])
+        self.assertIn("exceeds 100 bytes", events[0]['error'])
+        self.assertEqual([], self.submitted)
+
+    def test_password_required(self):
+        watcher = self._make_watcher(password="secret")
+        _conn, sock = self._connect(watcher)
+        self._send(sock, {'id': 1, 'password': 'secret'},
+                   {'id': 2, 'text': 'hi'})
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 2)
+        self.assertEqual([(1, 'authenticated'), (2, 'accepted')],
+                         [(e['id'], e['type']) for e in events])
+        _conn, sock = self._connect(watcher)
+        self._send(sock, {'id': 1, 'password': 'wrong'},
+                   {'id': 2, 'text': 'hi'})
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: closed)
+        self.assertEqual([(1, 'error')],
+                         [(e['id'], e['type']) for e in events])
+        self.assertEqual(1, len(self.submitted))
+
+    def test_max_inflight(self):
+        watcher = self._make_watcher(max_inflight=1)
+        conn, sock = self._connect(watcher)
+        self._send(sock, {'id': 1, 'text': 'one'})
+        self._pump(watcher, sock, lambda events, closed: len(events) >= 1)
+        self._send(sock, {'id': 2, 'text': 'two'})
+        for _i in range(0, 10):
+            watcher._run_once(0.01)
+        # Too many running, so that second request was not read yet.
+        self.assertEqual(1, len(self.submitted))
+        self.assertFalse(conn.selector_events & bulk.selectors.EVENT_READ)
+        self.submitted[0][2].set_result("done")
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 2)
+        self.assertEqual([(1, 'result'), (2, 'accepted')],
+                         [(e['id'], e['type']) for e in events])
+
+    def test_max_buffered(self):
+        watcher = self._make_watcher(max_buffered=50)
+        conn, sock = self._connect(watcher)
+        self._send(sock, {'id': 1, 'text': 'chatty'})
+        self._pump(watcher, sock, lambda events, closed: len(events) >= 1)
+        m, _ch, fut = self.submitted[0]
+        for _i in range(0, 10):
+            m.reply_text("x" * 30)
+        # The first reply fills the buffer, the rest get dropped.
+        self.assertTrue(conn.send_full)
+        fut.set_result("done")
+        events, _closed = self._pump(
+            watcher, sock, lambda events, closed: len(events) >= 2)
+        self.assertEqual([(1, 'reply'), (1, 'result')],
+                         [(e['id'], e['type']) for e in events])
+        self.assertEqual(9, events[1]['dropped_replies'])
+        self.assertFalse(conn.send_full)
+
+    def test_unix_socket_mode(self):
+        watcher = self._make_watcher()
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(watcher.path).st_mode))
+
+    def test_port_needs_password(self):
+        self.assertRaises(ValueError, bulk.Watcher, self.bot, {'port': 0})
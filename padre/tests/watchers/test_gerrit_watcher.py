@@ -1,8 +1,17 @@
+import json
+import socket
+import struct
+import threading
+
 import mock
+import munch
+import six
 from testtools import TestCase
 
 from datetime import datetime
 
+from padre.handlers import gerrit as gerrit_handlers
+from padre import matchers
 from padre.tests import common
 from padre.watchers import gerrit
 
@@ -165,6 +174,294 @@ class GerritWatcher(TestCase):
         bot = common.make_bot()
         client = mock.MagicMock()
         bot.clients.gerrit_mqtt_client = client
+        bot.handlers = [gerrit_handlers.PatchSetCreatedHandler]
         watcher = gerrit.Watcher(bot)
         watcher.run()
         client.run.assert_called_once()
+        self.assertEqual(frozenset(['patchset-created']),
+                         watcher.event_types)
+
+    def test_watcher_topics(self):
+        bot = common.make_bot()
+        bot.config.gerrit = {
+            'mqtt': {'event_topic_tpl': 'gerrit/+/+/%(event_type)s'},
+        }
+        bot.config = munch.munchify(bot.config)
+        client = mock.MagicMock()
+        bot.clients.gerrit_mqtt_client = client
+        bot.handlers = [gerrit_handlers.PatchSetCreatedHandler]
+        watcher = gerrit.Watcher(bot)
+        watcher.run()
+        self.assertEqual(['gerrit/+/+/patchset-created'],
+                         client.run.call_args[1]['topics'])
+
+    def test_watcher_no_handlers(self):
+        bot = common.make_bot()
+        client = mock.MagicMock()
+        bot.clients.gerrit_mqtt_client = client
+        bot.handlers = []
+        watcher = gerrit.Watcher(bot)
+        watcher.dead.set()
+        watcher.run()
+        client.run.assert_not_called()
+
+    def test_filters_unwanted_before_decode(self):
+        bot = common.make_bot()
+        watcher = gerrit.Watcher(bot)
+        watcher.event_types = frozenset(['patchset-created'])
+        self.assertTrue(watcher._enqueue(
+            'gerrit/openstack/nova/patchset-created',
+            b'{"type": "patchset-created"}'))
+        self.assertFalse(watcher._enqueue(
+            'gerrit/openstack/nova/comment-added',
+            b'{"type": "comment-added"}'))
+        self.assertFalse(watcher._enqueue(
+            'gerrit', b'{"approvals": [{"type": "Code-Review"}],'
+                      b' "type": "comment-added"}'))
+        self.assertTrue(watcher._enqueue(
+            'gerrit', b'{"type":"patchset-created"}'))
+        self.assertEqual(2, watcher.filtered)
+        self.assertEqual(2, watcher.queue.depth)
+
+    def test_watcher_dispatches_queued(self):
+        bot = common.make_bot()
+        client = mock.MagicMock()
+        bot.clients.gerrit_mqtt_client = client
+        bot.handlers = [gerrit_handlers.PatchSetCreatedHandler]
+        watcher = gerrit.Watcher(bot)
+        event = {
+            'type': 'patchset-created',
+            'patchSet': {
+                'author': {'name': 'User', 'username': 'username'},
+                'createdOn': 1502386349,
+                'sizeDeletions': 0,
+                'sizeInsertions': 10,
+                'kind': 'kind',
+                'revision': 'revision',
+                'uploader': {'name': 'User', 'username': 'username'},
+            },
+            'change': {
+                'branch': 'branch',
+                'commitMessage': 'commit_message',
+                'id': 'id',
+                'number': 10,
+                'owner': {'name': 'User', 'username': 'username'},
+                'project': 'project',
+                'status': 'status',
+                'subject': 'subject',
+                'url': 'url',
+            },
+            'uploader': {'name': 'User', 'username': 'username'},
+            'eventCreatedOn': 1502386349,
+        }
+
+        def fake_run(death, enqueue_func, topics=None):
+            enqueue_func('gerrit', json.dumps(event).encode("utf8"))
+            enqueue_func('gerrit', b'{"type": "ref-updated"}')
+            enqueue_func('gerrit', b'not json')
+            enqueue_func('gerrit', b'{"type": "patchset-created", "x"')
+
+        client.run.side_effect = fake_run
+        watcher.run()
+        # Broadcast + targeted for the one event that has an extractor.
+        self.assertEqual(2, bot.submit_message.call_count)
+        self.assertEqual(2, watcher.queue.stats()['dequeued'])
+        self.assertEqual(2, watcher.filtered)
+
+
+class FindSubKindsTest(TestCase):
+    def test_find(self):
+        self.assertEqual(set(['patchset-created']), matchers.find_sub_kinds(
+            matchers.match_gerrit("patchset-created"), 'gerrit'))
+        self.assertEqual(set(), matchers.find_sub_kinds(
+            matchers.match_slack("message"), 'gerrit'))
+        self.assertEqual(set(['a', 'b']), matchers.find_sub_kinds(
+            matchers.match_or(matchers.match_gerrit("a"),
+                              matchers.match_slack("message"),
+                              matchers.match_gerrit("b", "c")), 'gerrit'))
+        self.assertIsNone(matchers.find_sub_kinds(
+            matchers.match_gerrit(), 'gerrit'))
+        self.assertIsNone(matchers.find_sub_kinds(
+            matchers.match_any, 'gerrit'))
+        self.assertEqual(set(), matchers.find_sub_kinds(
+            matchers.match_none, 'gerrit'))
+
+
+class GerritEventQueueTest(TestCase):
+    def test_batches(self):
+        q = gerrit.EventQueue(max_size=10)
+        for i in range(0, 5):
+            self.assertTrue(q.put(i))
+        self.assertEqual([0, 1, 2], q.get_batch(3))
+        self.assertEqual([3, 4], q.get_batch(3))
+        self.assertEqual([], q.get_batch(3, timeout=0.01))
+        stats = q.stats()
+        self.assertEqual(5, stats['enqueued'])
+        self.assertEqual(5, stats['dequeued'])
+        self.assertEqual(2, stats['batches'])
+        self.assertEqual(5, stats['high_water'])
+        self.assertEqual(0, stats['depth'])
+
+    def test_drop_oldest(self):
+        q = gerrit.EventQueue(max_size=2,
+                              overflow=gerrit.EventQueue.DROP_OLDEST)
+        for i in range(0, 4):
+            self.assertTrue(q.put(i))
+        self.assertEqual([2, 3], q.get_batch(10))
+        self.assertEqual(2, q.stats()['dropped'])
+
+    def test_drop_newest(self):
+        q = gerrit.EventQueue(max_size=2,
+                              overflow=gerrit.EventQueue.DROP_NEWEST)
+        self.assertTrue(q.put(0))
+        self.assertTrue(q.put(1))
+        self.assertFalse(q.put(2))
+        self.assertEqual([0, 1], q.get_batch(10))
+        self.assertEqual(1, q.stats()['dropped'])
+
+    def test_block_times_out(self):
+        q = gerrit.EventQueue(max_size=1, overflow=gerrit.EventQueue.BLOCK,
+                              block_timeout=0.01)
+        self.assertTrue(q.put(0))
+        self.assertFalse(q.put(1))
+        self.assertEqual(1, q.stats()['dropped'])
+
+    def test_close(self):
+        q = gerrit.EventQueue()
+        q.put(0)
+        q.close()
+        self.assertFalse(q.closed)
+        self.assertFalse(q.put(1))
+        self.assertEqual([0], q.get_batch(10))
+        self.assertEqual([], q.get_batch(10))
+        self.assertTrue(q.closed)
+
+    def test_bad_overflow(self):
+        self.assertRaises(ValueError, gerrit.EventQueue, overflow='explode')
+
+
+class FakeBroker(threading.Thread):
+    """Tiny (mqtt 3.1.1, qos 1) mosquitto stand-in for one client."""
+
+    def __init__(self, messages_per_connection):
+        super(FakeBroker, self).__init__()
+        self.daemon = True
+        self.messages_per_connection = list(messages_per_connection)
+        self.connects = []
+        self.subscriptions = []
+        self.acked = []
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.bind(('localhost', 0))
+        self.server_sock.listen(1)
+        self.port = self.server_sock.getsockname()[1]
+
+    @staticmethod
+    def _read_exactly(sock, am):
+        data = b""
+        while len(data) < am:
+            tmp_data = sock.recv(am - len(data))
+            if not tmp_data:
+                raise EOFError
+            data += tmp_data
+        return data
+
+    def _read_packet(self, sock):
+        kind = ord(self._read_exactly(sock, 1))
+        length = 0
+        multiplier = 1
+        while True:
+            byte = ord(self._read_exactly(sock, 1))
+            length += (byte & 127) * multiplier
+            multiplier *= 128
+            if not byte & 128:
+                break
+        return kind, self._read_exactly(sock, length)
+
+    @staticmethod
+    def _read_str(data, pos):
+        am = struct.unpack("!H", data[pos:pos + 2])[0]
+        return data[pos + 2:pos + 2 + am].decode("utf8"), pos + 2 + am
+
+    def _serve(self, sock, messages):
+        kind, data = self._read_packet(sock)
+        assert kind == 0x10
+        _proto, pos = self._read_str(data, 0)
+        flags = six.indexbytes(data, pos + 1)
+        client_id, _pos = self._read_str(data, pos + 4)
+        session_present = 1 if self.connects else 0
+        self.connects.append((client_id, bool(flags & 0x02)))
+        sock.sendall(struct.pack("!BBBB", 0x20, 2, session_present, 0))
+        kind, data = self._read_packet(sock)
+        assert kind == 0x82
+        pos = 2
+        while pos < len(data):
+            topic, pos = self._read_str(data, pos)
+            self.subscriptions.append((topic, six.indexbytes(data, pos)))
+            pos += 1
+        sock.sendall(struct.pack("!BB", 0x90, 3) + data[0:2] + b"\x01")
+        for i, (topic, payload) in enumerate(messages):
+            body = (struct.pack("!H", len(topic)) + topic.encode("utf8") +
+                    struct.pack("!H", i + 1) + payload)
+            sock.sendall(struct.pack("!BB", 0x32, len(body)) + body)
+            kind, data = self._read_packet(sock)
+            while kind == 0xC0:
+                sock.sendall(b"\xd0\x00")
+                kind, data = self._read_packet(sock)
+            assert kind == 0x40
+            self.acked.append(struct.unpack("!H", data)[0])
+
+    def run(self):
+        for messages in self.messages_per_connection:
+            sock, _addr = self.server_sock.accept()
+            try:
+                self._serve(sock, messages)
+            finally:
+                # Drop the connection (the client should come back).
+                sock.close()
+        self.server_sock.close()
+
+
+class MQTTClientTest(TestCase):
+    def test_persistent_session_survives_reconnect(self):
+        broker = FakeBroker([
+            [('gerrit/a/patchset-created', b'1')],
+            [('gerrit/a/patchset-created', b'2')],
+        ])
+        broker.start()
+        config = munch.Munch({
+            'firehose_host': 'localhost',
+            'firehose_port': broker.port,
+            'firehose_transport': 'tcp',
+            'client_id': 'padre-test',
+            'qos': 1,
+            'reconnect_min_delay': 0,
+            'reconnect_max_delay': 1,
+        })
+        client = gerrit.MQTTClient(config)
+        death = threading.Event()
+        got = []
+        got_all = threading.Event()
+
+        def enqueue(topic, payload):
+            got.append((topic, payload))
+            if len(got) == 2:
+                got_all.set()
+
+        runner = threading.Thread(target=client.run,
+                                  args=(death, enqueue),
+                                  kwargs={'topics': ['gerrit/#']})
+        runner.start()
+        try:
+            self.assertTrue(got_all.wait(10))
+        finally:
+            death.set()
+            runner.join(10)
+        self.assertFalse(runner.is_alive())
+        self.assertEqual([('gerrit/a/patchset-created', b'1'),
+                          ('gerrit/a/patchset-created', b'2')], got)
+        self.assertEqual([('padre-test', False), ('padre-test', False)],
+                         broker.connects)
+        self.assertEqual([('gerrit/#', 1), ('gerrit/#', 1)],
+                         broker.subscriptions)
+        broker.join(10)
+        self.assertEqual([1, 1], broker.acked)
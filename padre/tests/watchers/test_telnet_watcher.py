@@ -0,0 +1,169 @@
+import socket
+import threading
+import time
+
+import mock
+import munch
+from testtools import TestCase
+
+from padre.tests import common
+from padre.watchers import telnet
+
+
+def _make_message(max_buffered=None, block_timeout=None):
+    m_body = munch.Munch({
+        'text': 'hi',
+        'ts': '1',
+        'thread_ts': None,
+    })
+    return telnet.TelnetMessage("telnet/message", {}, m_body,
+                                max_buffered=max_buffered,
+                                block_timeout=block_timeout)
+
+
+def _make_fut(m, done=False):
+    fut = mock.MagicMock()
+    fut.message = m
+    fut.done.return_value = done
+    return fut
+
+
+class TelnetMessageTest(TestCase):
+    def test_drain_limit(self):
+        m = _make_message()
+        m.reply_text("a" * 10)
+        m.reply_text("b" * 10)
+        self.assertTrue(m.needs_drain)
+        self.assertEqual("a" * 10 + "\n" + "b" * 4, m.drain_buffer(limit=15))
+        self.assertEqual("b" * 6 + "\n", m.drain_buffer(limit=15))
+        self.assertFalse(m.needs_drain)
+
+    def test_dropped_summary(self):
+        m = _make_message(max_buffered=8, block_timeout=0)
+        m.reply_text("a" * 9)
+        # Over the limit now; so these get dropped (and counted).
+        m.reply_text("b" * 3)
+        m.reply_text("c" * 3)
+        out = m.drain_buffer()
+        self.assertTrue(out.startswith("a" * 9 + "\n"))
+        self.assertIn("8 characters of output dropped", out)
+        self.assertFalse(m.needs_drain)
+        # And once drained, output gets buffered again.
+        m.reply_text("d")
+        self.assertEqual("d\n", m.drain_buffer())
+
+    def test_block_timeout_expiry(self):
+        m = _make_message(max_buffered=4, block_timeout=0.2)
+        m.reply_text("a" * 4)
+        started = time.time()
+        m.reply_text("b")
+        self.assertGreaterEqual(time.time() - started, 0.15)
+        self.assertIn("2 characters of output dropped", m.drain_buffer())
+
+    def test_blocked_until_drained(self):
+        m = _make_message(max_buffered=4, block_timeout=30)
+        m.reply_text("a" * 4)
+        writer = threading.Thread(target=m.reply_text, args=("b",))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual("a" * 4 + "\n", m.drain_buffer())
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual("b\n", m.drain_buffer())
+
+    def test_close_output_unblocks(self):
+        m = _make_message(max_buffered=4, block_timeout=30)
+        m.reply_text("a" * 4)
+        writer = threading.Thread(target=m.reply_text, args=("b",))
+        writer.start()
+        m.close_output()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertFalse(m.needs_drain)
+
+
+class TelnetWatcherTest(TestCase):
+    def setUp(self):
+        super(TelnetWatcherTest, self).setUp()
+        self.bot = common.make_bot()
+
+    def _make_watcher(self, **conf):
+        conf.setdefault('port', 0)
+        conf.setdefault('password', 'secret')
+        watcher = telnet.Watcher(self.bot, conf)
+        watcher.setup()
+        return watcher
+
+    def _start(self, watcher):
+        watcher.start()
+
+        def stop():
+            watcher.dead.set()
+            watcher.join(5)
+
+        self.addCleanup(stop)
+
+    def _connect(self, watcher):
+        sock = socket.create_connection(
+            watcher._server_sock.getsockname(), timeout=5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_drain_budget(self):
+        watcher = telnet.Watcher(self.bot, {'send_buffer_limit': 100})
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        client = telnet.TelnetClient(a, ('test', 0))
+        client.authed = True
+        m = _make_message()
+        for _i in range(0, 10):
+            m.reply_text("x" * 49)
+        client.futs.append(_make_fut(m))
+        watcher._process_client_futs(client, set())
+        # Only (about) the budget worth of output got pulled out, the
+        # rest stays buffered in the message.
+        self.assertTrue(m.needs_drain)
+        self.assertLess(len(client.send_buffer), 100 + 200)
+        self.assertEqual(1, len(client.futs))
+        # Nothing more gets pulled until the socket catches up.
+        pending = len(client.send_buffer)
+        watcher._process_client_futs(client, set())
+        self.assertEqual(pending, len(client.send_buffer))
+
+    def test_idle_kicked(self):
+        watcher = self._make_watcher(idle_timeout=0.2)
+        self._start(watcher)
+        sock = self._connect(watcher)
+        started = time.time()
+        data = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertIn(b"Password: ", data)
+        self.assertLess(time.time() - started, 5)
+
+    def test_dead_wakes_loop(self):
+        watcher = self._make_watcher()
+        wakeup_r = watcher._wakeup_r
+        watcher.start()
+        # Give it a chance to go to sleep in its (timeout-less) select.
+        time.sleep(0.1)
+        self.assertTrue(watcher.is_alive())
+        watcher.dead.set()
+        watcher.join(5)
+        self.assertFalse(watcher.is_alive())
+        self.assertIsNone(watcher._wakeup_w)
+        self.assertRaises(OSError, telnet.os.fstat, wakeup_r)
+
+    def test_max_connections(self):
+        watcher = self._make_watcher(max_connections=1)
+        self._start(watcher)
+        first = self._connect(watcher)
+        self.assertIn(b"Password", first.recv(4096))
+        second = self._connect(watcher)
+        self.assertEqual(b"", second.recv(4096))
+        self.assertEqual(1, watcher.client_count())
@@ -167,3 +167,94 @@ class GithubHookApplicationTest(TestCase):
             'Error')
         self.assertEqual('202 Accepted', self.hook.hook(req).status)
         self.bot.submit_message.assert_called()
+
+
+class GithubDeliveryDedupTest(TestCase):
+    def setUp(self):
+        super(GithubDeliveryDedupTest, self).setUp()
+        self.bot = common.make_bot()
+
+    def _make_req(self, delivery_id, body=b'{ "first": "data" }'):
+        req = mock.MagicMock()
+        req.headers.get.side_effect = ['push', delivery_id]
+        req.method = 'POST'
+        req.content_type = 'application/json'
+        req.content_length = 100
+        req.body_file.read.return_value = body
+        return req
+
+    def test_duplicate_not_dispatched(self):
+        hook = github.HookApplication(self.bot)
+        self.assertEqual('202 Accepted',
+                         hook.hook(self._make_req('abc')).status)
+        self.assertEqual(2, self.bot.submit_message.call_count)
+        resp = hook.hook(self._make_req('abc'))
+        self.assertEqual('200 OK', resp.status)
+        self.assertEqual('true', resp.headers['X-Padre-Duplicate'])
+        self.assertEqual(2, self.bot.submit_message.call_count)
+        self.assertEqual('202 Accepted',
+                         hook.hook(self._make_req('def')).status)
+
+    def test_bad_delivery_can_be_retried(self):
+        hook = github.HookApplication(self.bot)
+        with ExpectedException(exc.HTTPBadRequest):
+            hook.hook(self._make_req('abc', body=b'[ "test" ]'))
+        self.assertEqual('202 Accepted',
+                         hook.hook(self._make_req('abc')).status)
+
+    def test_dedup_disabled(self):
+        self.bot.config.github.hook.dedup = {'enabled': False}
+        hook = github.HookApplication(self.bot)
+        self.assertIsNone(hook.deliveries)
+        for _i in range(0, 2):
+            self.assertEqual('202 Accepted',
+                             hook.hook(self._make_req('abc')).status)
+
+    def test_persisted(self):
+        self.bot.config.github.hook.dedup = {'persist': True}
+        hook = github.HookApplication(self.bot)
+        hook.hook(self._make_req('abc'))
+        self.assertIn('abc', self.bot.brain[github.DeliveryTracker.BRAIN_KEY])
+        # Another (restarted) hook still knows about it.
+        hook = github.HookApplication(self.bot)
+        self.assertEqual('200 OK', hook.hook(self._make_req('abc')).status)
+
+    def test_expired_not_loaded(self):
+        brain = common.MockBrain({
+            github.DeliveryTracker.BRAIN_KEY: {'old': 0.0, 'new': 1e12},
+        })
+        tracker = github.DeliveryTracker(ttl=60, brain=brain)
+        self.assertTrue(tracker.claim('old'))
+        self.assertFalse(tracker.claim('new'))
+        self.assertNotIn('old', brain[github.DeliveryTracker.BRAIN_KEY])
+
+
+class GithubBodyLimitsTest(TestCase):
+    def setUp(self):
+        super(GithubBodyLimitsTest, self).setUp()
+        self.bot = common.make_bot()
+
+    def _make_req(self, kind, content_length):
+        req = mock.MagicMock()
+        req.headers.get.side_effect = [kind, 'abc']
+        req.method = 'POST'
+        req.content_type = 'application/json'
+        req.content_length = content_length
+        req.body_file.read.return_value = b'{ "first": "data" }'
+        return req
+
+    def test_too_large_rejected(self):
+        self.bot.config.github.hook.max_body_bytes = 10
+        hook = github.HookApplication(self.bot)
+        req = self._make_req('push', 100)
+        with ExpectedException(exc.HTTPRequestEntityTooLarge):
+            hook.hook(req)
+        req.body_file.read.assert_not_called()
+
+    def test_unwanted_event_not_read(self):
+        self.bot.config.github.hook.events = ['pull_request']
+        hook = github.HookApplication(self.bot)
+        req = self._make_req('push', 100)
+        self.assertEqual('204 No Content', hook.hook(req).status)
+        req.body_file.read.assert_not_called()
+        self.bot.submit_message.assert_not_called()
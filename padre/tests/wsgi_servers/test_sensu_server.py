@@ -157,3 +157,22 @@ class SensuHookApplicationTest(TestCase):
             'Error')
         self.assertEqual('202 Accepted', self.hook.hook(req).status)
         self.bot.submit_message.assert_called()
+
+    def test_hook_ignores_unwanted_action_header(self):
+        req = mock.MagicMock()
+        req.headers.get.side_effect = ['resolve']
+        self.bot.config.sensu.hook.actions = ['create']
+        self.assertEqual('204 No Content', self.hook.hook(req).status)
+        req.body_file.read.assert_not_called()
+        self.bot.submit_message.assert_not_called()
+
+    def test_hook_ignores_unwanted_action_body(self):
+        req = mock.MagicMock()
+        req.headers.get.side_effect = ['']
+        req.method = 'POST'
+        req.content_type = 'application/json'
+        req.content_length = 100
+        req.body_file.read.return_value = b'{ "action": "resolve" }'
+        self.bot.config.sensu.hook.actions = ['create']
+        self.assertEqual('204 No Content', self.hook.hook(req).status)
+        self.bot.submit_message.assert_not_called()
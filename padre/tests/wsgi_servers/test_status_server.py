@@ -1,9 +1,14 @@
 from __future__ import unicode_literals
 
 from datetime import datetime
+from datetime import timedelta
 import json
 import mock
+import os
+import shutil
+import tempfile
 from testtools import TestCase, ExpectedException  # noqa
+from webob import Request
 
 from padre import channel as c
 from padre.tests import common
@@ -46,6 +51,7 @@ class StatusWatcherTest(TestCase):
             },
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'channel_stats': {},
             'handlers': {
@@ -68,6 +74,7 @@ class StatusWatcherTest(TestCase):
             'uptime': {},
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'channel_stats': {},
             'handlers': {
@@ -106,6 +113,7 @@ class StatusWatcherTest(TestCase):
             'uptime': {},
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'channel_stats': {},
             'handlers': {
@@ -143,6 +151,7 @@ class StatusWatcherTest(TestCase):
             'uptime': {},
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'channel_stats': {},
             'handlers': {
@@ -177,6 +186,7 @@ class StatusWatcherTest(TestCase):
             'channel_stats': {},
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'handlers': {
                 'active': [],
@@ -223,6 +233,7 @@ class StatusWatcherTest(TestCase):
             'uptime': {},
             'clients': [],
             'watchers': [],
+            'queues': {},
             'wsgi_servers': [],
             'channel_stats': {},
             'handlers': {
@@ -247,3 +258,270 @@ class StatusWatcherTest(TestCase):
         self.assertDictEqual(
             resp,
             json.loads(self.hook.reply_status(req, None).body))
+
+    def test_status_cached_and_conditional(self):
+        self.bot.started_at = None
+        self.bot.handlers = []
+        built = []
+        orig_build = self.hook._build_status
+
+        def build():
+            built.append(True)
+            return orig_build()
+
+        self.hook.status_doc.build_func = build
+        self.hook.status_doc.max_age = 60
+        resp = Request.blank("/status").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertIsNotNone(resp.etag)
+        self.assertEqual({}, json.loads(resp.body)['uptime'])
+        req = Request.blank("/status")
+        req.if_none_match = resp.etag
+        resp_2 = req.get_response(self.hook)
+        self.assertEqual(304, resp_2.status_int)
+        self.assertEqual(b"", resp_2.body)
+        self.assertEqual(1, len(built))
+
+    @mock.patch("padre.date_utils.get_now")
+    def test_status_etag_ignores_uptime(self, mock_now):
+        self.bot.handlers = []
+        self.hook.status_doc.max_age = 0
+        mock_now.return_value = self.bot.started_at
+        resp = Request.blank("/status").get_response(self.hook)
+        mock_now.return_value = self.bot.started_at + timedelta(seconds=5)
+        resp_2 = Request.blank("/status").get_response(self.hook)
+        self.assertNotEqual(json.loads(resp.body)['uptime'],
+                            json.loads(resp_2.body)['uptime'])
+        self.assertTrue(resp.headers['ETag'].startswith('W/'))
+        self.assertEqual(resp.etag, resp_2.etag)
+        req = Request.blank("/status")
+        req.if_none_match = resp.etag
+        self.assertEqual(304, req.get_response(self.hook).status_int)
+
+    def test_config_cached(self):
+        resp = Request.blank("/config").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.bot.config.extra = 'thing'
+        resp_2 = Request.blank("/config").get_response(self.hook)
+        self.assertEqual(resp.etag, resp_2.etag)
+        self.assertNotIn('extra', json.loads(resp_2.body))
+
+    def test_metrics(self):
+        executor = mock.MagicMock()
+        executor.queue_size = 3
+        executor.num_workers = 4
+        executor.get_num_idle_workers.return_value = 1
+        self.bot.executors = {'primary': executor}
+        self.bot.scheduler = None
+        self.bot.watchers = {}
+        resp = Request.blank("/metrics").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual("text/plain; version=0.0.4; charset=utf-8",
+                         resp.headers['Content-Type'])
+        lines = resp.text.splitlines()
+        self.assertIn('padre_executor_queue_depth{executor="primary"} 3',
+                      lines)
+        self.assertIn('padre_executor_workers{executor="primary",'
+                      'state="active"} 3', lines)
+        self.assertIn("# TYPE padre_handler_duration_seconds histogram",
+                      lines)
+
+
+class StatusIndexTest(TestCase):
+    def setUp(self):
+        super(StatusIndexTest, self).setUp()
+        self.bot = common.make_bot()
+        self.bot.name = 'padre'
+        self.bot.config.slack = {}
+        self.hook = status.StatusApplication(self.bot)
+
+    @mock.patch("padre.wsgi_servers.status._get_threadstacks")
+    @mock.patch("pkg_resources.get_distribution")
+    def test_index_cached_without_stacks(self, get_distribution,
+                                         get_threadstacks):
+        get_distribution.return_value.version = '1.0'
+        get_distribution.return_value.key = 'padre'
+        self.hook.index_doc.max_age = 60
+        resp = Request.blank("/").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertIn("stacks.txt", resp.text)
+        Request.blank("/").get_response(self.hook)
+        self.assertEqual(1, get_distribution.call_count)
+        self.assertEqual(0, get_threadstacks.call_count)
+
+    @mock.patch("padre.wsgi_servers.status._get_threadstacks")
+    def test_stacks_rate_limited(self, get_threadstacks):
+        get_threadstacks.return_value = [
+            {'id': 1, 'traceback': 'File "a.py", line 1\n'},
+        ]
+        resp = Request.blank("/stacks.txt").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertIn('Thread #1 (???):\nFile "a.py", line 1', resp.text)
+        resp_2 = Request.blank("/stacks").get_response(self.hook)
+        self.assertEqual(resp.text, resp_2.text)
+        self.assertEqual(1, get_threadstacks.call_count)
+
+
+class StatusProfileTest(TestCase):
+    def setUp(self):
+        super(StatusProfileTest, self).setUp()
+        self.bot = common.make_bot()
+        self.bot.config.status = {'profile': {'max_seconds': 0.1}}
+        self.hook = status.StatusApplication(self.bot)
+
+    def test_profile(self):
+        resp = Request.blank("/profile?seconds=30").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual("0.1", resp.headers['X-Profile-Seconds'])
+
+    def test_one_at_a_time(self):
+        with self.hook.profile_lock:
+            resp = Request.blank("/profile").get_response(self.hook)
+        self.assertEqual(409, resp.status_int)
+
+    def test_bad_params(self):
+        resp = Request.blank("/profile?rate=-1").get_response(self.hook)
+        self.assertEqual(400, resp.status_int)
+
+
+class StatusMemoryTest(TestCase):
+    def setUp(self):
+        super(StatusMemoryTest, self).setUp()
+        self.bot = common.make_bot()
+        self.bot.active_handlers = set()
+        self.bot.prior_handlers = {c.TARGETED: {'slack': [1, 2]}}
+        self.bot.executors = {}
+        self.bot.watchers = {}
+        self.bot.handlers = []
+        self.hook = status.StatusApplication(self.bot)
+
+    def _post(self, path):
+        return Request.blank(path, method='POST').get_response(self.hook)
+
+    def test_structures(self):
+        resp = Request.blank("/memory").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        resp_body = json.loads(resp.body)
+        self.assertEqual({'slack': 2},
+                         resp_body['structures']['prior_handlers']['targeted'])
+        self.assertFalse(resp_body['tracemalloc']['tracing'])
+        self.assertEqual([], resp_body['top'])
+
+    def test_snapshot_diff(self):
+        self.assertEqual(409, self._post("/memory/snapshot").status_int)
+        self.addCleanup(self._post, "/memory/stop")
+        self.assertEqual(200, self._post("/memory/start").status_int)
+        self._post("/memory/snapshot")
+        blobs = [bytearray(1024) for _i in range(0, 1000)]
+        resp = self._post("/memory/snapshot")
+        self.assertEqual(2, json.loads(resp.body)['snapshots'])
+        resp = Request.blank("/memory?limit=5").get_response(self.hook)
+        resp_body = json.loads(resp.body)
+        self.assertTrue(resp_body['tracemalloc']['tracing'])
+        self.assertEqual(5, len(resp_body['top']))
+        self.assertGreater(resp_body['diff'][0]['size_diff'], 1024 * 1000)
+        del blobs
+
+
+class StatusLogTest(TestCase):
+    def setUp(self):
+        super(StatusLogTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.log_file = os.path.join(self.tmp_dir, "padre.log")
+        with open(self.log_file, 'wb') as fh:
+            for i in range(0, 100):
+                fh.write(b"line %03d\n" % i)
+        self.bot = common.make_bot()
+        self.bot.config.log_file = self.log_file
+        self.bot.config.log_http_max_bytes = 25
+        self.bot.config.log_http_follow_timeout = 0.1
+        self.hook = status.StatusApplication(self.bot)
+
+    def test_tail(self):
+        resp = Request.blank("/log.txt").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(b"line 098\nline 099\n", resp.body)
+
+    def test_all(self):
+        resp = Request.blank("/log.txt?all=1").get_response(self.hook)
+        self.assertEqual(900, len(resp.body))
+        self.assertTrue(resp.body.startswith(b"line 000\n"))
+
+    def test_range(self):
+        req = Request.blank("/log.txt")
+        req.range = (9, 18)
+        resp = req.get_response(self.hook)
+        self.assertEqual(206, resp.status_int)
+        self.assertEqual(b"line 001\n", resp.body)
+        self.assertEqual("bytes 9-17/900", str(resp.content_range))
+
+    def test_missing(self):
+        os.unlink(self.log_file)
+        resp = Request.blank("/log.txt").get_response(self.hook)
+        self.assertEqual(b"", resp.body)
+
+    def test_follow(self):
+        resp = Request.blank("/log.txt?follow=1").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(b"line 098\nline 099\n", resp.body)
+        self.assertEqual(0, self.hook.log_followers)
+
+    def test_follow_picks_up_appends(self):
+        app_iter = status.FollowFileIter(
+            self.log_file, open(self.log_file, 'rb'), 10, self.bot.dead,
+            poll_interval=0)
+        self.addCleanup(app_iter.close)
+        chunks = iter(app_iter)
+        self.assertEqual(900, len(next(chunks)))
+        with open(self.log_file, 'ab') as fh:
+            fh.write(b"line 100\n")
+        self.assertEqual(b"line 100\n", next(chunks))
+        # Rotation should be noticed (and the new file followed).
+        os.rename(self.log_file, self.log_file + ".1")
+        with open(self.log_file, 'wb') as fh:
+            fh.write(b"new 000\n")
+        self.assertEqual(b"new 000\n", next(chunks))
+
+
+class StatusStaticTest(TestCase):
+    def setUp(self):
+        super(StatusStaticTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.bot = common.make_bot()
+        self.bot.config.statics_dir = self.tmp_dir
+        self.hook = status.StatusApplication(self.bot)
+        self.path = os.path.join(self.tmp_dir, "site.css")
+        with open(self.path, 'wb') as fh:
+            fh.write(b"body { color: red; }\n" * 50)
+
+    def test_cached_and_compressed(self):
+        resp = Request.blank("/static/site.css").get_response(self.hook)
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual('text/css', resp.content_type)
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(3600, resp.cache_control.max_age)
+        req = Request.blank("/static/site.css")
+        req.accept_encoding = 'gzip'
+        resp_gz = req.get_response(self.hook)
+        self.assertEqual('gzip', resp_gz.content_encoding)
+        self.assertNotEqual(resp.etag, resp_gz.etag)
+        resp_gz.decode_content()
+        self.assertEqual(resp.body, resp_gz.body)
+        req = Request.blank("/static/site.css")
+        req.if_none_match = resp.etag
+        self.assertEqual(304, req.get_response(self.hook).status_int)
+
+    def test_reloaded_when_changed(self):
+        resp = Request.blank("/static/site.css").get_response(self.hook)
+        with open(self.path, 'wb') as fh:
+            fh.write(b"body {}\n")
+        os.utime(self.path, (0, 0))
+        resp_2 = Request.blank("/static/site.css").get_response(self.hook)
+        self.assertEqual(b"body {}\n", resp_2.body)
+        self.assertNotEqual(resp.etag, resp_2.etag)
+
+    def test_missing(self):
+        resp = Request.blank("/static/nope.css").get_response(self.hook)
+        self.assertEqual(404, resp.status_int)
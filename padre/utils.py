@@ -2,8 +2,10 @@ import collections
 import contextlib
 import datetime
 import errno
+import gzip
 import hashlib
 import inspect
+import io
 import json
 import keyword
 import logging
@@ -11,10 +13,10 @@ import os
 import re
 import shlex
 import shutil
+import socket
 import sys
 import tempfile
 
-import futurist
 import jinja2
 import munch
 import six
@@ -25,7 +27,6 @@ from six.moves import zip as compat_zip
 from oslo_utils import importutils
 from oslo_utils import reflection
 from oslo_utils import strutils
-from oslo_utils import timeutils
 import paho.mqtt.client as mqtt
 
 from padre import exceptions as excp
@@ -216,6 +217,16 @@ def to_bytes(blob, encode_as='utf8'):
     return blob.encode(encode_as)
 
 
+def gzip_compress(blob, compresslevel=9):
+    buf = io.BytesIO()
+    # NOTE: mtime is fixed so that the same blob always compresses to
+    # the same output.
+    with gzip.GzipFile(fileobj=buf, mode='wb',
+                       compresslevel=compresslevel, mtime=0) as fh:
+        fh.write(blob)
+    return buf.getvalue()
+
+
 def is_short(text):
     # For slack fields...
     return len(text) <= 15
@@ -495,6 +506,26 @@ def read_backwards_up_to(fh, max_bytes):
         return (seek_to, fh.read())
 
 
+def find_next_line_start(fh, offset, block_size=8192):
+    """Finds where the first full line at (or after) some offset starts.
+
+    Only reads (a block at a time) from the offset until the next newline,
+    so memory used does not depend on how large the file is.
+    """
+    if offset <= 0:
+        return 0
+    fh.seek(offset - 1, os.SEEK_SET)
+    pos = offset - 1
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            return pos
+        nl_index = block.find(b"\n")
+        if nl_index != -1:
+            return pos + nl_index + 1
+        pos += len(block)
+
+
 def find_executable(what, sys_bin_path=None):
     maybe_bin_paths = []
     if not sys_bin_path:
@@ -548,68 +579,65 @@ def canonicalize_text(message_text):
     return message_text
 
 
-def make_mqtt_client(config, topics=None,
-                     max_connect_wait=10, check_delay=0.01,
-                     log=None):
+def make_mqtt_client(config, topics=None, log=None):
+    """Makes a (not yet connected) mqtt client from some configuration.
+
+    The client (re)subscribes to the given topics every time it
+    connects; by default it asks for a persistent session (with a stable
+    client id) so that the broker keeps messages (sent with a qos
+    greater than zero) for it while it is not connected.
+    """
     if log is None:
         log = LOG
 
-    fut = futurist.Future()
-    fut.set_running_or_notify_cancel()
-    firehose_port = config.firehose_port
     if not topics:
         topics = set(["#"])
     else:
         topics = set(topics)
+    qos = int(config.get("qos", 1))
+    clean_session = strutils.bool_from_string(
+        config.get("clean_session", False))
+    client_id = config.get("client_id")
+    if not client_id:
+        client_id = "padre-%s" % socket.gethostname()
 
     def on_connect(client, userdata, flags, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            log.warning("MQTT failed connecting to %s:%s over %s,"
+                        " reason=%s", config.firehose_host,
+                        config.firehose_port, config.firehose_transport,
+                        mqtt.connack_string(rc))
+            return
+        log.info("MQTT client '%s' connected to %s:%s over %s"
+                 " (session present=%s)", client_id,
+                 config.firehose_host, config.firehose_port,
+                 config.firehose_transport,
+                 bool(flags.get('session present')))
+        rc, _mid = client.subscribe([(topic, qos)
+                                     for topic in sorted(topics)])
         if rc == mqtt.MQTT_ERR_SUCCESS:
-            log.info("MQTT client connected to %s:%s over %s",
-                     config.firehose_host,
-                     firehose_port, config.firehose_transport)
-        fut.set_result(rc)
-
-    def cleanup_and_raise(client, rc):
-        try:
-            client.disconnect()
-        except IOError:
-            pass
-        error_msg_tpl = ("MQTT failed connecting to %s:%s over %s,"
-                         " reason=%s")
-        raise IOError(error_msg_tpl % (
-            config.firehose_host,
-            firehose_port,
-            config.firehose_transport,
-            mqtt.error_string(rc)))
-
-    client = mqtt.Client(transport=config.firehose_transport)
+            log.info("MQTT client subscribed to topics %s (qos=%s)",
+                     sorted(topics), qos)
+        else:
+            log.warning("MQTT client failed subscribing to topics %s,"
+                        " reason=%s", sorted(topics),
+                        mqtt.error_string(rc))
+
+    def on_disconnect(client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            log.warning("MQTT client unexpectedly disconnected from"
+                        " %s:%s, reason=%s", config.firehose_host,
+                        config.firehose_port, mqtt.error_string(rc))
+
+    client = mqtt.Client(client_id=client_id, clean_session=clean_session,
+                         transport=config.firehose_transport)
+    client.max_inflight_messages_set(int(config.get("max_inflight", 20)))
+    client.max_queued_messages_set(int(config.get("max_queued", 0)))
+    client.reconnect_delay_set(
+        min_delay=int(config.get("reconnect_min_delay", 1)),
+        max_delay=int(config.get("reconnect_max_delay", 60)))
     client.on_connect = on_connect
-    client.connect(config.firehose_host, port=firehose_port)
-
-    with timeutils.StopWatch(duration=max_connect_wait) as watch:
-        awaiting_connect = True
-        while awaiting_connect:
-            if watch.expired() and not fut.done():
-                cleanup_and_raise(client, mqtt.MQTT_ERR_NO_CONN)
-            if fut.done():
-                rc = fut.result()
-                if rc != mqtt.MQTT_ERR_SUCCESS:
-                    cleanup_and_raise(client, rc)
-                else:
-                    for topic in topics:
-                        rc, _mid = client.subscribe(topic)
-                        if rc == mqtt.MQTT_ERR_SUCCESS:
-                            log.info("MQTT client subscribed to"
-                                     " topic '%s'", topic)
-                        else:
-                            break
-                    if rc != mqtt.MQTT_ERR_SUCCESS:
-                        cleanup_and_raise(client, rc)
-                    else:
-                        awaiting_connect = False
-            else:
-                client.loop(check_delay)
-
+    client.on_disconnect = on_disconnect
     return client
 
 
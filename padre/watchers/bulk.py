@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+
+"""Newline delimited JSON command socket (for scripted automation).
+
+Each line sent to this socket is a JSON object that looks like::
+
+    {"id": "1", "text": "ping"}
+    {"id": "2", "text": "...", "thread": "1"}
+
+Every request is submitted to the bot as soon as it is read (so many
+can be running at once) and events about it stream back (one JSON
+object per line, tagged with the request id) as they happen, which
+means results come back in whatever order the requests finish::
+
+    {"id": "1", "type": "accepted", "ts": "0"}
+    {"id": "1", "type": "reply", "text": "..."}
+    {"id": "1", "type": "result", "ok": true, "result": "..."}
+"""
+
+import collections
+import errno
+import functools
+import itertools
+import json
+import logging
+import os
+import selectors
+import socket
+import threading
+import traceback
+
+import munch
+import six
+
+from padre import channel as c
+from padre import exceptions as excp
+from padre import message
+from padre.watchers import telnet
+
+LOG = logging.getLogger(__name__)
+
+
+class BulkMessage(telnet.TelnetMessage):
+    def __init__(self, raw_kind, headers, body, on_reply):
+        super(BulkMessage, self).__init__(raw_kind, headers, body)
+        self._on_reply = on_reply
+
+    def reply_attachments(self, attachments, **kwargs):
+        reply = {'attachments': list(attachments)}
+        text = kwargs.get("text")
+        if text:
+            reply['text'] = text
+        self._on_reply(reply)
+
+    def reply_text(self, text, **kwargs):
+        self._on_reply({'text': text})
+
+
+class BulkConnection(object):
+    def __init__(self, sock, name, max_buffered):
+        self.sock = sock
+        self.name = name
+        self.active = True
+        self.authed = False
+        # Set once the client has shut down its side (no more requests
+        # will come), the results of those already sent still get sent.
+        self.eof = False
+        self.in_buffer = b""
+        self.futs = set()
+        self.selector_events = 0
+        self.max_buffered = max_buffered
+        self._out_buffer = collections.deque()
+        self._out_bytes = 0
+        self._out_lock = threading.Lock()
+        # Replies dropped (by request id) because too much was buffered.
+        self._dropped = collections.Counter()
+
+    def queue(self, event, droppable=False):
+        line = (json.dumps(event, default=str) + "\n").encode("utf8")
+        with self._out_lock:
+            if droppable and self._out_bytes >= self.max_buffered:
+                # NOTE: the client isn't reading fast enough; rather than
+                # growing forever, drop it (the result says how many).
+                self._dropped[event.get('id')] += 1
+                return False
+            self._out_buffer.append(line)
+            self._out_bytes += len(line)
+            return True
+
+    def pop_dropped(self, req_id):
+        with self._out_lock:
+            return self._dropped.pop(req_id, 0)
+
+    @property
+    def send_pending(self):
+        with self._out_lock:
+            return bool(self._out_buffer)
+
+    @property
+    def finished(self):
+        """Whether nothing more will (or can) be sent to the client."""
+        if not self.active:
+            return True
+        return self.eof and not self.futs
+
+    @property
+    def send_full(self):
+        with self._out_lock:
+            return self._out_bytes >= self.max_buffered
+
+    def socket_send(self):
+        with self._out_lock:
+            while self._out_buffer:
+                chunk = self._out_buffer[0]
+                try:
+                    sent = self.sock.send(chunk)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error:
+                    LOG.warning("Failed sending to %s.", self.name,
+                                exc_info=True)
+                    self.active = False
+                    self._out_buffer.clear()
+                    self._out_bytes = 0
+                    break
+                self._out_bytes -= sent
+                if sent < len(chunk):
+                    self._out_buffer[0] = chunk[sent:]
+                    break
+                self._out_buffer.popleft()
+
+    def read_lines(self, max_line_length):
+        try:
+            data = self.sock.recv(64 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except socket.error:
+            self.active = False
+            return []
+        if not data:
+            self.eof = True
+            # Treat a final line that lacks its newline as a request too.
+            line, self.in_buffer = self.in_buffer, b""
+            return [line] if line.strip() else []
+        self.in_buffer += data
+        lines = self.in_buffer.split(b"\n")
+        self.in_buffer = lines.pop()
+        if len(self.in_buffer) > max_line_length:
+            self.queue({'id': None, 'type': 'error',
+                        'error': 'Request exceeds %s bytes' % max_line_length})
+            self.active = False
+            self.in_buffer = b""
+        return [line for line in lines if line.strip()]
+
+
+class Watcher(threading.Thread):
+    #: Most bytes a single request (line) may be.
+    MAX_LINE_LENGTH = 64 * 1024
+
+    #: Most requests a single connection may have running at once, past
+    #: this point no more is read from it until some of them finish.
+    MAX_INFLIGHT = 256
+
+    #: Most bytes of (unsent) output buffered for a single connection,
+    #: past this point no more is read from it (and replies from its
+    #: running requests get dropped) until the client catches up.
+    MAX_BUFFERED = 1024 * 1024
+
+    MAX_CONNECTIONS = 32
+    LISTEN_BACKLOG = 16
+    PORT = 6667
+
+    #: Permissions the unix socket (when listening on one) gets.
+    SOCKET_MODE = 0o600
+
+    # Selector key data used to tell the non-connection sockets apart.
+    _ACCEPT = 'accept'
+    _WAKEUP = 'wakeup'
+
+    def __init__(self, bot, conf, address='localhost'):
+        super(Watcher, self).__init__()
+        self.bot = bot
+        self.dead = telnet.WakeupEvent(self._wakeup)
+        self.address = address
+        self.path = conf.get("path")
+        self.mode = int(conf.get("mode", self.SOCKET_MODE))
+        self.port = int(conf.get("port", self.PORT))
+        self.password = conf.get("password")
+        if not self.path and not self.password:
+            # Anything on this host could otherwise run commands (as an
+            # already authorized user) through it.
+            raise ValueError("A password is required when the bulk"
+                             " socket listens on a port (instead of"
+                             " on a unix socket path)")
+        self.max_connections = int(max(1, conf.get("max_connections",
+                                                   self.MAX_CONNECTIONS)))
+        self.max_inflight = int(max(1, conf.get("max_inflight",
+                                                self.MAX_INFLIGHT)))
+        self.max_line_length = int(max(1, conf.get("max_line_length",
+                                                   self.MAX_LINE_LENGTH)))
+        self.max_buffered = int(max(1, conf.get("max_buffered",
+                                                self.MAX_BUFFERED)))
+        self._ts_counter = itertools.count(0)
+        self._conn_counter = itertools.count(0)
+        self._selector = None
+        self._server_sock = None
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._conns = set()
+        self._ready_conns = set()
+        self._ready_lock = threading.Lock()
+
+    def client_count(self):
+        return len(self._conns)
+
+    @staticmethod
+    def insert_periodics(bot, scheduler):
+        pass
+
+    def _wakeup(self):
+        wakeup_w = self._wakeup_w
+        if wakeup_w is None:
+            return
+        try:
+            os.write(wakeup_w, b"x")
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def _drain_wakeup(self):
+        while True:
+            try:
+                if not os.read(self._wakeup_r, 4096):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+    def _emit(self, conn, event, droppable=False):
+        if not conn.queue(event, droppable=droppable):
+            return
+        with self._ready_lock:
+            self._ready_conns.add(conn)
+        self._wakeup()
+
+    def _on_reply(self, conn, req_id, reply):
+        reply = dict(reply)
+        reply.update({'id': req_id, 'type': 'reply'})
+        self._emit(conn, reply, droppable=True)
+
+    def _on_done(self, conn, req_id, fut):
+        conn.futs.discard(fut)
+        event = {'id': req_id, 'type': 'result'}
+        try:
+            res = fut.result()
+        except excp.Dying:
+            event.update({'ok': False, 'error': 'Program dying',
+                          'error_type': 'Dying'})
+        except Exception as e:
+            event.update({'ok': False, 'error': str(e),
+                          'error_type': type(e).__name__})
+            if isinstance(e, excp.NoHandlerFound) and e.suggestion:
+                event['suggestion'] = e.suggestion
+            else:
+                event['traceback'] = traceback.format_exc()
+        else:
+            event.update({'ok': True, 'result': res})
+        dropped = conn.pop_dropped(req_id)
+        if dropped:
+            event['dropped_replies'] = dropped
+        self._emit(conn, event)
+
+    def _process_request(self, conn, line):
+        try:
+            req = json.loads(line.decode("utf8"))
+            if not isinstance(req, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as e:
+            conn.queue({'id': None, 'type': 'error',
+                        'error': 'Invalid request: %s' % e})
+            return
+        req_id = req.get('id')
+        if not conn.authed:
+            if req.get('password') != self.password:
+                conn.queue({'id': req_id, 'type': 'error',
+                            'error': 'Authentication failed'})
+                conn.active = False
+            else:
+                conn.authed = True
+                conn.queue({'id': req_id, 'type': 'authenticated'})
+            return
+        text = req.get('text')
+        if not isinstance(text, six.string_types) or not text.strip():
+            conn.queue({'id': req_id, 'type': 'error',
+                        'error': "Request needs non-empty 'text'"})
+            return
+        text = text.strip()
+        thread_ts = req.get('thread')
+        if thread_ts is not None:
+            thread_ts = str(thread_ts)
+        m_headers = {
+            message.VALIDATED_HEADER: True,
+            message.TO_ME_HEADER: True,
+            message.CHECK_AUTH_HEADER: False,
+        }
+        ts = str(six.next(self._ts_counter))
+        # NOTE: Made to look like a telnet message so that existing
+        # handlers (that match on telnet messages) just work.
+        m_body = munch.Munch({
+            'text': text,
+            'ts': ts,
+            'thread_ts': thread_ts,
+            'text_no_links': text,
+            'user_id': conn.name,
+            'user_name': conn.name,
+            'channel': conn.name,
+            'channel_id': conn.name,
+            'quick_link': '',
+            'directed': True,
+        })
+        m = BulkMessage("telnet/message", m_headers, m_body,
+                        functools.partial(self._on_reply, conn, req_id))
+        if thread_ts is None:
+            fut = self.bot.submit_message(m, c.TARGETED)
+        else:
+            fut = self.bot.submit_message(m, c.FOLLOWUP)
+        conn.futs.add(fut)
+        conn.queue({'id': req_id, 'type': 'accepted', 'ts': ts})
+        fut.add_done_callback(
+            functools.partial(self._on_done, conn, req_id))
+
+    def setup(self):
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            bind_to = self.path
+        else:
+            server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_sock.setsockopt(socket.SOL_SOCKET,
+                                   socket.SO_REUSEADDR, 1)
+            bind_to = (self.address, self.port)
+        try:
+            server_sock.bind(bind_to)
+            if self.path:
+                # NOTE: before listening, so that nothing can connect
+                # while it still has the (umask derived) default mode.
+                os.chmod(self.path, self.mode)
+            server_sock.listen(self.LISTEN_BACKLOG)
+            server_sock.setblocking(False)
+        except socket.error:
+            server_sock.close()
+            raise
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            os.set_blocking(fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(server_sock, selectors.EVENT_READ, self._ACCEPT)
+        selector.register(wakeup_r, selectors.EVENT_READ, self._WAKEUP)
+        self._server_sock = server_sock
+        self._wakeup_r = wakeup_r
+        self._wakeup_w = wakeup_w
+        self._selector = selector
+        if self.path:
+            return self.path
+        return ":".join(str(p) for p in server_sock.getsockname())
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self._server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                LOG.warning("Failed accepting bulk connection",
+                            exc_info=True)
+                break
+            if len(self._conns) >= self.max_connections:
+                LOG.warning("Refusing new bulk connection, maximum"
+                            " of %s connections already in use.",
+                            self.max_connections)
+                sock.close()
+                continue
+            if addr:
+                name = "bulk:%s:%s" % (addr[0], addr[1])
+            else:
+                name = "bulk:%s" % six.next(self._conn_counter)
+            self._add_conn(sock, name)
+
+    def _add_conn(self, sock, name):
+        sock.setblocking(False)
+        conn = BulkConnection(sock, name, self.max_buffered)
+        conn.authed = not self.password
+        conn.selector_events = selectors.EVENT_READ
+        self._selector.register(sock, conn.selector_events, conn)
+        self._conns.add(conn)
+        LOG.debug("Bulk session to %s opened.", name)
+        return conn
+
+    def _disconnect(self, conn):
+        if conn.selector_events:
+            self._selector.unregister(conn.sock)
+            conn.selector_events = 0
+        self._conns.discard(conn)
+        for fut in list(conn.futs):
+            fut.cancel()
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        LOG.debug("Bulk session to %s closed.", conn.name)
+
+    def _update_interest(self, conn):
+        if conn not in self._conns:
+            return
+        send_pending = conn.send_pending
+        if conn.finished and not send_pending:
+            self._disconnect(conn)
+            return
+        events = 0
+        # NOTE: Stop reading more requests from connections that have
+        # too many running (or too much output waiting to be sent),
+        # they'll be read once some of those finish (or get sent).
+        if (conn.active and not conn.eof and
+                len(conn.futs) < self.max_inflight and not conn.send_full):
+            events |= selectors.EVENT_READ
+        if send_pending:
+            events |= selectors.EVENT_WRITE
+        if events == conn.selector_events:
+            return
+        if not events:
+            # Nothing to read (yet) and nothing to write; the futures
+            # that are running will wake us up when they finish.
+            self._selector.unregister(conn.sock)
+        elif not conn.selector_events:
+            self._selector.register(conn.sock, events, conn)
+        else:
+            self._selector.modify(conn.sock, events, conn)
+        conn.selector_events = events
+
+    def _process_conn(self, conn, mask):
+        if mask & selectors.EVENT_READ and conn.active and not conn.eof:
+            for line in conn.read_lines(self.max_line_length):
+                if not conn.active:
+                    break
+                self._process_request(conn, line)
+        if mask & selectors.EVENT_WRITE:
+            conn.socket_send()
+
+    def _teardown(self):
+        for conn in list(self._conns):
+            self._disconnect(conn)
+        self._selector.close()
+        self._server_sock.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        wakeup_r, wakeup_w = self._wakeup_r, self._wakeup_w
+        self._wakeup_w = self._wakeup_r = None
+        os.close(wakeup_w)
+        os.close(wakeup_r)
+
+    def _run_once(self, timeout=None):
+        touched = set()
+        for key, mask in self._selector.select(timeout):
+            if key.data is self._WAKEUP:
+                self._drain_wakeup()
+            elif key.data is self._ACCEPT:
+                self._accept()
+            else:
+                conn = key.data
+                touched.add(conn)
+                self._process_conn(conn, mask)
+        with self._ready_lock:
+            touched.update(self._ready_conns)
+            self._ready_conns.clear()
+        for conn in touched:
+            self._update_interest(conn)
+
+    def run(self):
+        try:
+            while not self.dead.is_set():
+                self._run_once()
+        finally:
+            self._teardown()
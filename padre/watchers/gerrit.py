@@ -1,17 +1,17 @@
 # Taken from https://github.com/harlowja/gerritbot2/ and slightly adjusted
 # to work *without* errbot in our codebase here.
 
+import collections
 from datetime import datetime
 
 import json
 import logging
+import re
 import threading
 
-from oslo_utils import timeutils
-import paho.mqtt.client as mqtt
-
 from padre import channel as c
 from padre import finishers
+from padre import matchers
 from padre import message
 from padre import utils
 
@@ -22,90 +22,47 @@ LOG = logging.getLogger(__name__)
 
 
 class MQTTClient(object):
-    """Client that better handles the underlying client crapping out."""
+    """Client that keeps one (persistent) connection to the firehose.
 
-    MAX_READ_LOOP_DURATION = 1.0
-    RECONNECT_WAIT = 1.0
+    The underlying client is made once and reused for as long as this
+    object lives; its network loop runs on its own thread (reconnecting
+    with backoff as needed) so that nothing is lost or re-created when
+    the broker has hiccups.
+    """
 
     def __init__(self, config):
         self.config = config
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def _get_client(self, topics=None):
+        with self._client_lock:
+            if self._client is None:
+                self._client = utils.make_mqtt_client(self.config,
+                                                      topics=topics)
+            return self._client
 
-    def run(self, death, translator_func, submit_func):
+    def run(self, death, enqueue_func, topics=None):
 
         def on_message(client, userdata, msg):
             if not msg.topic or not msg.payload:
                 return
-            try:
-                payload = msg.payload
-                if isinstance(payload, six.binary_type):
-                    payload = payload.decode("utf8")
-                details = {'event': json.loads(payload)}
-            except (UnicodeError, ValueError):
-                LOG.exception(
-                    "Received corrupted/invalid payload: %s", msg.payload)
-            else:
-                message = translator_func(details)
-                if message is not None:
-                    try:
-                        submit_func(message)
-                    except RuntimeError:
-                        pass
+            # NOTE: This runs on the network loop, so keep it cheap and
+            # leave decoding (and everything else) to the consumer.
+            enqueue_func(msg.topic, msg.payload)
 
         config = self.config
-        real_client = utils.make_mqtt_client(config)
+        real_client = self._get_client(topics=topics)
         real_client.on_message = on_message
-        rc = mqtt.MQTT_ERR_SUCCESS
-        running = True
-
-        while not death.is_set() and running:
-            max_duration = self.MAX_READ_LOOP_DURATION
-            reconnect_wait = self.RECONNECT_WAIT
-            with timeutils.StopWatch(duration=max_duration) as watch:
-                try:
-                    while (rc == mqtt.MQTT_ERR_SUCCESS and
-                           not watch.expired()):
-                        rc = real_client.loop(timeout=watch.leftover())
-                        if death.is_set():
-                            break
-                except IOError:
-                    LOG.exception("Failed consumption")
-                    rc = mqtt.MQTT_ERR_UNKNOWN
-                if rc in [mqtt.MQTT_ERR_NO_CONN,
-                          mqtt.MQTT_ERR_CONN_REFUSED,
-                          mqtt.MQTT_ERR_CONN_LOST,
-                          mqtt.MQTT_ERR_NOT_FOUND,
-                          mqtt.MQTT_ERR_UNKNOWN]:
-                    LOG.warn("Reconnecting, reason=%s",
-                             mqtt.error_string(rc))
-                    try:
-                        real_client.reconnect()
-                    except IOError:
-                        LOG.exception("Failed reconnecting")
-                        LOG.info("Waiting %s seconds before retrying",
-                                 reconnect_wait)
-                        death.wait(reconnect_wait)
-                    else:
-                        rc = mqtt.MQTT_ERR_SUCCESS
-                elif rc == mqtt.MQTT_ERR_NOMEM:
-                    # The client seems to leak memory...
-                    #
-                    # What a PITA...
-                    LOG.critical("Regenerating client, client"
-                                 " reported out of memory")
-                    try:
-                        real_client = utils.make_mqtt_client(config)
-                    except IOError:
-                        LOG.critical("Fatal client failure (unable"
-                                     " to recreate client), reason=%s",
-                                     mqtt.error_string(rc))
-                        running = False
-                    else:
-                        real_client.on_message = on_message
-                        rc = mqtt.MQTT_ERR_SUCCESS
-                elif rc != mqtt.MQTT_ERR_SUCCESS:
-                    LOG.critical("Fatal client failure, reason=%s",
-                                 mqtt.error_string(rc))
-                    running = False
+        real_client.connect_async(config.firehose_host,
+                                  port=config.firehose_port,
+                                  keepalive=int(config.get("keepalive", 60)))
+        real_client.loop_start()
+        try:
+            death.wait()
+        finally:
+            real_client.disconnect()
+            real_client.loop_stop()
 
 
 def extract_entity(data):
@@ -152,7 +109,121 @@ def extract_patch_set_created(data):
     })
 
 
+class EventQueue(object):
+    """Bounded queue that hands out what it contains in batches."""
+
+    #: When full, the oldest item is dropped to make space.
+    DROP_OLDEST = 'drop_oldest'
+
+    #: When full, the item being added is dropped.
+    DROP_NEWEST = 'drop_newest'
+
+    #: When full, wait (up to some timeout) for space, then drop the
+    #: item being added.
+    BLOCK = 'block'
+
+    OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+    def __init__(self, max_size=1024, overflow=DROP_OLDEST,
+                 block_timeout=1.0):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s' (expected"
+                             " one of %s)" % (overflow,
+                                              self.OVERFLOW_POLICIES))
+        self.max_size = max(1, int(max_size))
+        self.overflow = overflow
+        self.block_timeout = float(block_timeout)
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            'enqueued': 0,
+            'dequeued': 0,
+            'dropped': 0,
+            'batches': 0,
+            'high_water': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return cls()
+        return cls(max_size=config.get('max_size', 1024),
+                   overflow=config.get('overflow', cls.DROP_OLDEST),
+                   block_timeout=config.get('block_timeout', 1.0))
+
+    @property
+    def depth(self):
+        with self._cond:
+            return len(self._items)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = len(self._items)
+            stats['max_size'] = self.max_size
+        return stats
+
+    def put(self, item):
+        """Adds an item (returns false if the item got dropped)."""
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._items) >= self.max_size:
+                if self.overflow == self.DROP_OLDEST:
+                    self._items.popleft()
+                    self._stats['dropped'] += 1
+                elif self.overflow == self.BLOCK:
+                    self._cond.wait_for(
+                        lambda: (self._closed or
+                                 len(self._items) < self.max_size),
+                        timeout=self.block_timeout)
+                if self._closed or len(self._items) >= self.max_size:
+                    self._stats['dropped'] += 1
+                    return False
+            self._items.append(item)
+            self._stats['enqueued'] += 1
+            self._stats['high_water'] = max(self._stats['high_water'],
+                                            len(self._items))
+            self._cond.notify_all()
+            return True
+
+    def get_batch(self, max_items, timeout=None):
+        """Waits for (and then takes up to ``max_items``) items.
+
+        Returns an empty list if nothing showed up before the timeout
+        or if the queue was closed (and has been emptied).
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or self._items,
+                                timeout=timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                batch.append(self._items.popleft())
+            if batch:
+                self._stats['dequeued'] += len(batch)
+                self._stats['batches'] += 1
+                self._cond.notify_all()
+            return batch
+
+    @property
+    def closed(self):
+        with self._cond:
+            return self._closed and not self._items
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class Watcher(threading.Thread):
+    #: Most events dispatched (to the bot) in one go.
+    BATCH_SIZE = 64
+
+    #: Finds (all) the event types in a raw (undecoded) payload.
+    EVENT_TYPE_RE = re.compile(br'"type"\s*:\s*"([a-z-]+)"')
+
     GERRIT_EVENT_TO_EXTRACTOR = {
         'change-abandoned': None,
         'change-merged': None,
@@ -175,6 +246,67 @@ class Watcher(threading.Thread):
         self.dead = threading.Event()
         self.bot = bot
         self.daemon = True
+        try:
+            queue_config = bot.config.gerrit.mqtt.queue
+        except AttributeError:
+            queue_config = None
+        self.queue = EventQueue.from_config(queue_config)
+        if queue_config:
+            self.batch_size = max(1, int(queue_config.get(
+                'batch_size', self.BATCH_SIZE)))
+        else:
+            self.batch_size = self.BATCH_SIZE
+        try:
+            self.event_topic_tpl = bot.config.gerrit.mqtt.event_topic_tpl
+        except AttributeError:
+            self.event_topic_tpl = None
+        self.event_types = frozenset()
+        self.filtered = 0
+
+    def _find_event_types(self):
+        """Finds the event types the loaded handlers want to see."""
+        event_types = set()
+        for h_cls in list(self.bot.handlers):
+            try:
+                message_matcher = h_cls.handles_what['message_matcher']
+            except (AttributeError, KeyError):
+                continue
+            h_event_types = matchers.find_sub_kinds(message_matcher,
+                                                    'gerrit')
+            if h_event_types is None:
+                # Can't tell, so it gets everything we can translate.
+                h_event_types = self.GERRIT_EVENT_TO_EXTRACTOR.keys()
+            event_types.update(h_event_types)
+        return frozenset(
+            event_type for event_type in event_types
+            if self.GERRIT_EVENT_TO_EXTRACTOR.get(event_type) is not None)
+
+    def _find_topics(self):
+        if not self.event_topic_tpl:
+            return None
+        return sorted(self.event_topic_tpl % {'event_type': event_type}
+                      for event_type in self.event_types)
+
+    def _is_wanted(self, topic, payload):
+        # NOTE: This runs on the network loop, so it has to be cheap; it
+        # only throws away events that are certainly not wanted and leaves
+        # the rest to the (full) decoding done by the consumer.
+        topic_event_type = topic.rsplit("/", 1)[-1]
+        if (topic_event_type in self.GERRIT_EVENT_TO_EXTRACTOR and
+                topic_event_type not in self.event_types):
+            return False
+        if not isinstance(payload, six.binary_type):
+            payload = payload.encode("utf8")
+        for event_type in self.EVENT_TYPE_RE.findall(payload):
+            if event_type.decode("ascii") in self.event_types:
+                return True
+        return False
+
+    def _enqueue(self, topic, payload):
+        if not self._is_wanted(topic, payload):
+            self.filtered += 1
+            return False
+        return self.queue.put(payload)
 
     def setup(self):
         pass
@@ -183,38 +315,81 @@ class Watcher(threading.Thread):
     def insert_periodics(bot, scheduler):
         pass
 
-    def run(self):
+    def _translate_event(self, payload):
+        try:
+            if isinstance(payload, six.binary_type):
+                payload = payload.decode("utf8")
+            data = json.loads(payload)
+        except (UnicodeError, ValueError):
+            LOG.exception("Received corrupted/invalid payload: %s", payload)
+            return None
+        try:
+            event_type = data.pop('type')
+        except (KeyError, AttributeError, TypeError):
+            return None
+        if event_type not in self.event_types:
+            return None
+        extract_func = self.GERRIT_EVENT_TO_EXTRACTOR.get(event_type)
+        if not extract_func:
+            return None
+        try:
+            event = extract_func(data)
+        except (KeyError, TypeError, ValueError):
+            LOG.exception("Received unexpected payload: %s", data)
+            return None
+        else:
+            m_headers = {
+                message.VALIDATED_HEADER: False,
+                message.TO_ME_HEADER: True,
+                message.CHECK_AUTH_HEADER: False,
+            }
+            m_body = event
+            m_kind = 'gerrit/%s' % event_type
+            m = message.Message(m_kind, m_headers, m_body)
+            return m
 
-        def translate_event(details):
-            try:
-                event_type = details['event'].pop('type')
-            except KeyError:
-                return None
-            extract_func = self.GERRIT_EVENT_TO_EXTRACTOR.get(event_type)
-            if not extract_func:
-                return None
-            try:
-                event = extract_func(details['event'])
-            except (KeyError, TypeError, ValueError):
-                LOG.exception(
-                    "Received unexpected payload: %s", details['event'])
-                return None
-            else:
-                m_headers = {
-                    message.VALIDATED_HEADER: False,
-                    message.TO_ME_HEADER: True,
-                    message.CHECK_AUTH_HEADER: False,
-                }
-                m_body = event
-                m_kind = 'gerrit/%s' % event_type
-                m = message.Message(m_kind, m_headers, m_body)
-                return m
-
-        def submit_message(message):
-            self.bot.submit_message(message, c.BROADCAST)
-            fut = self.bot.submit_message(message, c.TARGETED)
-            fut.add_done_callback(
-                finishers.log_on_fail(self.bot, message, log=LOG))
-
-        mqtt_client = self.bot.clients.gerrit_mqtt_client
-        mqtt_client.run(self.dead, translate_event, submit_message)
+    def _submit_message(self, m):
+        self.bot.submit_message(m, c.BROADCAST)
+        fut = self.bot.submit_message(m, c.TARGETED)
+        fut.add_done_callback(
+            finishers.log_on_fail(self.bot, m, log=LOG))
+
+    def _consume(self):
+        last_dropped = 0
+        while not self.queue.closed:
+            batch = self.queue.get_batch(self.batch_size)
+            dropped = self.queue.stats()['dropped']
+            if dropped != last_dropped:
+                LOG.warning("Gerrit event queue overflowed, %s events"
+                            " dropped so far", dropped)
+                last_dropped = dropped
+            for payload in batch:
+                m = self._translate_event(payload)
+                if m is None:
+                    continue
+                try:
+                    self._submit_message(m)
+                except RuntimeError:
+                    # Executors are shutting down, nothing more to do.
+                    pass
+
+    def run(self):
+        self.event_types = self._find_event_types()
+        if not self.event_types:
+            LOG.info("No handlers want gerrit events, not subscribing"
+                     " to any of them")
+            self.dead.wait()
+            return
+        topics = self._find_topics()
+        LOG.info("Handlers want gerrit events %s (subscribing to"
+                 " topics %s)", sorted(self.event_types), topics or ['#'])
+        consumer = threading.Thread(target=self._consume,
+                                    name="gerrit-event-consumer")
+        consumer.daemon = True
+        consumer.start()
+        try:
+            mqtt_client = self.bot.clients.gerrit_mqtt_client
+            mqtt_client.run(self.dead, self._enqueue, topics=topics)
+        finally:
+            self.queue.close()
+            consumer.join()
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import errno
+import functools
+import heapq
 import itertools
 import logging
+import os
 import pkg_resources
 import random
 import re
+import selectors
 import socket
 import threading
+import time
 import traceback
 
-from miniboa import async as async_boa
 from miniboa import telnet
 from miniboa import xterm
 
@@ -114,8 +120,12 @@ def _cook_slack_text(text, replace_mrkdwn=True):
     if isinstance(text, six.text_type):
         for u_ch, b_ch in UNICODE_REPLACEMENTS:
             text = text.replace(u_ch, b_ch)
+        # NOTE: Round trip so that what comes out is still text (and
+        # can be written into text buffers) but with anything that the
+        # target encoding can't handle replaced.
         text = text.encode(
-            UNICODE_TARGET_ENCODING, errors='replace')
+            UNICODE_TARGET_ENCODING, errors='replace').decode(
+                UNICODE_TARGET_ENCODING)
 
     return text
 
@@ -135,6 +145,47 @@ class TelnetClient(telnet.TelnetClient):
         super(TelnetClient, self).__init__(sock, addr_tup)
         self.futs = []
         self.authed = False
+        self.selector_events = 0
+
+    #: Largest piece of the send buffer handed to the socket at once.
+    SEND_CHUNK = 16 * 1024
+
+    def socket_send(self):
+        # NOTE: Unlike the parent class this never blocks (and only
+        # encodes what is being sent instead of the whole buffer); it
+        # sends what the socket will take right now and leaves the rest
+        # for when the selector says the socket is writable again.
+        while self.send_buffer:
+            chunk = self.send_buffer[0:self.SEND_CHUNK]
+            if not isinstance(chunk, six.binary_type):
+                chunk = chunk.encode("cp1252", "replace")
+            try:
+                sent = self.sock.send(chunk, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                LOG.warning("Failed sending to %s.", self.addrport(),
+                            exc_info=True)
+                self.active = False
+                return
+            self.bytes_sent += sent
+            self.send_buffer = self.send_buffer[sent:]
+            if sent < len(chunk):
+                break
+        if not self.send_buffer:
+            self.send_pending = False
+
+
+class WakeupEvent(threading.Event):
+    """Event that also wakes up a (selector based) loop when set."""
+
+    def __init__(self, waker):
+        super(WakeupEvent, self).__init__()
+        self._waker = waker
+
+    def set(self):
+        super(WakeupEvent, self).set()
+        self._waker()
 
 
 class ManualTelnetProgressBar(pb.ManualProgressBar):
@@ -157,18 +208,69 @@ class AutoTelnetProgressBar(pb.AutoProgressBar):
 
 
 class TelnetMessage(message.Message):
-    def __init__(self, raw_kind, headers, body):
+    #: Most (characters of) output that will be buffered before
+    #: handlers producing more output get blocked.
+    MAX_BUFFERED = 64 * 1024
+
+    #: How long a handler will be blocked waiting for buffered output
+    #: to be drained before its newer output starts to be dropped.
+    BLOCK_TIMEOUT = 10.0
+
+    def __init__(self, raw_kind, headers, body,
+                 max_buffered=None, block_timeout=None):
         super(TelnetMessage, self).__init__(raw_kind, headers, body)
-        self._buffer = six.StringIO()
-        self._buffer_lock = threading.Lock()
+        if max_buffered is None:
+            max_buffered = self.MAX_BUFFERED
+        if block_timeout is None:
+            block_timeout = self.BLOCK_TIMEOUT
+        self.max_buffered = max(1, int(max_buffered))
+        self.block_timeout = max(0.0, float(block_timeout))
+        self._buffer = collections.deque()
+        self._buffered = 0
+        self._dropped = 0
+        self._closed = False
+        self._buffer_cond = threading.Condition()
+        # Called (with no arguments) whenever new output gets buffered.
+        self.on_output = None
+
+    def _notify_output(self):
+        if self.on_output is not None:
+            self.on_output()
+
+    def _write(self, text):
+        with self._buffer_cond:
+            if self._closed:
+                return
+            if self._buffered >= self.max_buffered and not self._dropped:
+                # NOTE: Push back on whatever handler is producing all
+                # this output until the client catches up (or if it never
+                # does, start dropping it instead of growing forever).
+                self._buffer_cond.wait_for(
+                    lambda: (self._closed or
+                             self._buffered < self.max_buffered),
+                    timeout=self.block_timeout)
+            if self._closed:
+                return
+            if self._buffered >= self.max_buffered:
+                self._dropped += len(text)
+                return
+            self._buffer.append(text)
+            self._buffered += len(text)
+        self._notify_output()
+
+    def close_output(self):
+        """Discards buffered (and any future) output."""
+        with self._buffer_cond:
+            self._closed = True
+            self._buffer.clear()
+            self._buffered = 0
+            self._dropped = 0
+            self._buffer_cond.notify_all()
 
     @property
     def needs_drain(self):
-        with self._buffer_lock:
-            curr_pos = self._buffer.tell()
-            if curr_pos == 0:
-                return False
-            return True
+        with self._buffer_cond:
+            return bool(self._buffered or self._dropped)
 
     def rewrite(self, text_aliases=None):
         if not text_aliases:
@@ -183,12 +285,27 @@ class TelnetMessage(message.Message):
             new_me.body.text_no_links = new_text
             return new_me
 
-    def drain_buffer(self):
-        with self._buffer_lock:
-            buf = self._buffer.getvalue()
-            self._buffer.seek(0)
-            self._buffer.truncate()
-            return buf
+    def drain_buffer(self, limit=None):
+        """Takes (up to ``limit`` characters of) buffered output."""
+        with self._buffer_cond:
+            pieces = []
+            taken = 0
+            while self._buffer and (limit is None or taken < limit):
+                piece = self._buffer.popleft()
+                if limit is not None and taken + len(piece) > limit:
+                    left_over = piece[limit - taken:]
+                    piece = piece[0:limit - taken]
+                    self._buffer.appendleft(left_over)
+                pieces.append(piece)
+                taken += len(piece)
+            self._buffered -= taken
+            if not self._buffer and self._dropped:
+                pieces.append("... %s characters of output dropped"
+                              " (client was not reading fast enough)"
+                              " ...\n" % self._dropped)
+                self._dropped = 0
+            self._buffer_cond.notify_all()
+            return "".join(pieces)
 
     def make_manual_progress_bar(self):
         return ManualTelnetProgressBar(self.reply_text)
@@ -226,23 +343,25 @@ class TelnetMessage(message.Message):
                     buf.write("\n")
         out_buf = buf.getvalue()
         if out_buf:
-            with self._buffer_lock:
-                self._buffer.write(out_buf)
+            self._write(out_buf)
 
     def reply_text(self, text, **kwargs):
         buf = six.StringIO()
         buf.write(_cook_slack_text(text))
         buf.write("\n")
-        with self._buffer_lock:
-            self._buffer.write(buf.getvalue())
+        self._write(buf.getvalue())
 
 
 class Watcher(threading.Thread):
-    WAIT_TIMEOUT = 0.1
     IDLE_TIMEOUT = 10 * 60
-    MAX_CONNECTIONS = 5
+    MAX_CONNECTIONS = 128
+    LISTEN_BACKLOG = 64
     PORT = 6666
 
+    #: Once a client has this much (unsent) output queued up no more
+    #: will be pulled from its messages until the socket catches up.
+    SEND_BUFFER_LIMIT = 64 * 1024
+
     pw_prompt = "Password: "
     prompt_tpl = "%(name)s Telnet Server> "
     what = 'padre'
@@ -250,23 +369,42 @@ class Watcher(threading.Thread):
                    '%(name)s' + RESET + " " + BRIGHT_YELLOW + "v%(version)s" +
                    RESET + " telnet server.")
 
+    # Selector key data used to tell the non-client sockets apart.
+    _ACCEPT = 'accept'
+    _WAKEUP = 'wakeup'
+
     def __init__(self, bot, conf, address='localhost'):
         super(Watcher, self).__init__()
         self.bot = bot
-        self.dead = threading.Event()
+        self.dead = WakeupEvent(self._wakeup)
         self.address = address
         self.port = int(conf.get("port", self.PORT))
         self.password = conf.get("password")
         self.max_connections = int(max(1, conf.get("max_connections",
                                                    self.MAX_CONNECTIONS)))
         self.idle_timeout = float(conf.get("idle_timeout", self.IDLE_TIMEOUT))
+        self.send_buffer_limit = int(max(1, conf.get(
+            "send_buffer_limit", self.SEND_BUFFER_LIMIT)))
+        self.max_output = int(max(1, conf.get(
+            "max_output", TelnetMessage.MAX_BUFFERED)))
+        self.output_block_timeout = float(conf.get(
+            "output_block_timeout", TelnetMessage.BLOCK_TIMEOUT))
         self._ts_counter = itertools.count(0)
-        self._server = None
+        self._selector = None
+        self._server_sock = None
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._clients = {}
+        # Heap of (idle deadline, tie breaker, client) entries.
+        self._idle_deadlines = []
+        self._idle_counter = itertools.count(0)
+        # Clients that have futures done (or output buffered) that
+        # need to be written out to them.
+        self._ready_clients = set()
+        self._ready_lock = threading.Lock()
 
     def client_count(self):
-        if self._server is None:
-            return 0
-        return self._server.client_count()
+        return len(self._clients)
 
     @classmethod
     def _make_prompt(cls):
@@ -278,6 +416,39 @@ class Watcher(threading.Thread):
         welcome = cls.welcome_tpl % {'name': cls.what, 'version': me.version}
         return welcome
 
+    def _wakeup(self):
+        wakeup_w = self._wakeup_w
+        if wakeup_w is None:
+            return
+        try:
+            os.write(wakeup_w, b"x")
+        except OSError as e:
+            # If the pipe is full then the loop is already going to wake
+            # up (and if it's closed, then it isn't running anymore).
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def _drain_wakeup(self):
+        while True:
+            try:
+                if not os.read(self._wakeup_r, 4096):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+    def _mark_ready(self, client, *args, **kwargs):
+        with self._ready_lock:
+            self._ready_clients.add(client)
+        self._wakeup()
+
+    def _pop_ready(self):
+        with self._ready_lock:
+            ready_clients = self._ready_clients
+            self._ready_clients = set()
+        return ready_clients
+
     def _on_connect(self, client):
         client_name = client.addrport()
         LOG.debug("Session to %s opened.", client_name)
@@ -306,6 +477,9 @@ class Watcher(threading.Thread):
             while client.futs:
                 fut = client.futs.pop(0)
                 fut.cancel()
+                # Don't leave anything blocked waiting on a client that
+                # is never going to read its output.
+                fut.message.close_output()
         finally:
             try:
                 client.sock.close()
@@ -316,83 +490,161 @@ class Watcher(threading.Thread):
         if ok_closed:
             LOG.debug("Session to %s closed.", client_name)
 
-    def _kick_idle(self):
-        for client in list(six.itervalues(self._server.clients)):
-            if not client.active:
+    def _is_current(self, client):
+        return self._clients.get(client.fileno) is client
+
+    def _accept(self, touched):
+        while True:
+            try:
+                sock, addr_tup = self._server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                LOG.warning("Failed accepting telnet connection",
+                            exc_info=True)
+                break
+            if len(self._clients) >= self.max_connections:
+                LOG.warning("Refusing new connection from %s, maximum"
+                            " of %s connections already in use.",
+                            addr_tup, self.max_connections)
+                sock.close()
                 continue
-            if client.idle() >= self.idle_timeout:
+            sock.setblocking(True)
+            client = TelnetClient(sock, addr_tup)
+            self._clients[client.fileno] = client
+            client.selector_events = selectors.EVENT_READ
+            self._selector.register(sock, client.selector_events, client)
+            heapq.heappush(self._idle_deadlines,
+                           (client.last_input_time + self.idle_timeout,
+                            six.next(self._idle_counter), client))
+            self._on_connect(client)
+            touched[client.fileno] = client
+
+    def _disconnect(self, client):
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        self._clients.pop(client.fileno, None)
+        self._on_disconnect(client)
+
+    def _update_interest(self, client):
+        if not client.active:
+            if self._is_current(client):
+                self._disconnect(client)
+            return
+        events = selectors.EVENT_READ
+        if client.send_pending:
+            events |= selectors.EVENT_WRITE
+        if events != client.selector_events:
+            self._selector.modify(client.sock, events, client)
+            client.selector_events = events
+
+    def _next_timeout(self):
+        if not self._idle_deadlines:
+            return None
+        return max(0.0, self._idle_deadlines[0][0] - time.time())
+
+    def _kick_idle(self, touched):
+        now = time.time()
+        while self._idle_deadlines and self._idle_deadlines[0][0] <= now:
+            _deadline, _i, client = heapq.heappop(self._idle_deadlines)
+            if not client.active or not self._is_current(client):
+                continue
+            deadline = client.last_input_time + self.idle_timeout
+            if deadline > now:
+                # Had input since this was scheduled; check again later.
+                heapq.heappush(self._idle_deadlines,
+                               (deadline, six.next(self._idle_counter),
+                                client))
+            else:
                 LOG.debug("Kicking idle session %s.", client.addrport())
                 client.deactivate()
+                touched[client.fileno] = client
 
-    def _process_clients_futs(self, clients_needing_prompt):
-        for client in list(six.itervalues(self._server.clients)):
-            if not client.active:
-                continue
-            client_name = client.addrport()
-            if not client.futs or not client.authed:
-                continue
-            not_done = []
-            done = []
-            buf = six.StringIO()
-            for fut in client.futs:
-                if not fut.done():
-                    not_done.append(fut)
-                else:
-                    done.append(fut)
-                if fut.message.needs_drain:
-                    title_text = "Thread %s" % _cook_message_ts(fut.message)
-                    title_text += " produced some output"
-                    buf.write(_block_text(title_text))
-                    buf.write("\n")
-                    tmp_out = fut.message.drain_buffer()
-                    buf.write(tmp_out)
-                    if not tmp_out.endswith("\n"):
-                        buf.write("\n")
-            for fut in done:
+    def _process_client_socket(self, client, mask, clients_needing_prompt):
+        if mask & selectors.EVENT_READ:
+            try:
+                client.socket_recv()
+            except telnet.ConnectionLost:
+                client.deactivate()
+        if mask & selectors.EVENT_WRITE and client.active:
+            client.socket_send()
+            if client.futs:
+                self._process_client_futs(client, clients_needing_prompt)
+        if client.active and client.cmd_ready:
+            self._process_client_input(client, clients_needing_prompt)
+
+    def _process_client_futs(self, client, clients_needing_prompt):
+        if not client.active or not client.futs or not client.authed:
+            return
+        # NOTE: Only pull as much output as the client can take; the rest
+        # stays buffered in the messages (pushing back on the handlers
+        # producing it) until the socket becomes writable again.
+        budget = self.send_buffer_limit - len(client.send_buffer)
+        if budget <= 0:
+            return
+        not_done = []
+        done = []
+        buf = six.StringIO()
+        for fut in client.futs:
+            if fut.message.needs_drain and budget > 0:
                 title_text = "Thread %s" % _cook_message_ts(fut.message)
-                try:
-                    res = fut.result()
-                except excp.Dying:
-                    title_text += " committed suicide"
-                    buf.write(_block_text(title_text))
+                title_text += " produced some output"
+                buf.write(_block_text(title_text))
+                buf.write("\n")
+                tmp_out = fut.message.drain_buffer(limit=budget)
+                budget -= len(tmp_out)
+                buf.write(tmp_out)
+                if not tmp_out.endswith("\n"):
                     buf.write("\n")
-                    buf.write(BRIGHT_RED + "Program dying" + RESET + "!")
+            if not fut.done() or fut.message.needs_drain:
+                not_done.append(fut)
+            else:
+                done.append(fut)
+        for fut in done:
+            title_text = "Thread %s" % _cook_message_ts(fut.message)
+            try:
+                res = fut.result()
+            except excp.Dying:
+                title_text += " committed suicide"
+                buf.write(_block_text(title_text))
+                buf.write("\n")
+                buf.write(BRIGHT_RED + "Program dying" + RESET + "!")
+                buf.write("\n")
+            except Exception as e:
+                if isinstance(e, excp.NoHandlerFound) and e.suggestion:
+                    title_text += " produced a suggestion"
+                    buf.write(_block_text(title_text))
                     buf.write("\n")
-                except Exception as e:
-                    if isinstance(e, excp.NoHandlerFound) and e.suggestion:
-                        title_text += " produced a suggestion"
-                        buf.write(_block_text(title_text))
-                        buf.write("\n")
-                        buf.write("Perhaps you meant ")
-                        buf.write(UNDERLINE + BOLD)
-                        buf.write(_escape_caret(e.suggestion))
-                        buf.write(RESET)
-                        buf.write("?\n")
-                    else:
-                        title_text += " produced a failure"
-                        buf.write(_block_text(title_text))
-                        buf.write("\n")
-                        tmp_buf = six.StringIO()
-                        traceback.print_exc(file=tmp_buf)
-                        buf.write(_cook_traceback(tmp_buf.getvalue()))
+                    buf.write("Perhaps you meant ")
+                    buf.write(UNDERLINE + BOLD)
+                    buf.write(_escape_caret(e.suggestion))
+                    buf.write(RESET)
+                    buf.write("?\n")
                 else:
-                    title_text += " produced some result"
+                    title_text += " produced a failure"
                     buf.write(_block_text(title_text))
                     buf.write("\n")
-                    buf.write(_escape_caret(str(res)))
-                    buf.write("\n")
-            buf = buf.getvalue()
-            if buf:
-                if client_name not in clients_needing_prompt:
-                    client.send("\n")
-                client.send_cc(buf)
-                clients_needing_prompt.add(client_name)
-            client.futs = not_done
-
-    def _process_clients_input(self, clients_needing_prompt):
-        for client in list(six.itervalues(self._server.clients)):
-            if not client.active or not client.cmd_ready:
-                continue
+                    tmp_buf = six.StringIO()
+                    traceback.print_exc(file=tmp_buf)
+                    buf.write(_cook_traceback(tmp_buf.getvalue()))
+            else:
+                title_text += " produced some result"
+                buf.write(_block_text(title_text))
+                buf.write("\n")
+                buf.write(_escape_caret(str(res)))
+                buf.write("\n")
+        buf = buf.getvalue()
+        if buf:
+            if client not in clients_needing_prompt:
+                client.send("\n")
+            client.send_cc(buf)
+            clients_needing_prompt.add(client)
+        client.futs = not_done
+
+    def _process_client_input(self, client, clients_needing_prompt):
+        while client.active and client.cmd_ready:
             client_name = client.addrport()
             client_cmd = client.get_command()
             client_cmd = client_cmd.strip()
@@ -415,9 +667,9 @@ class Watcher(threading.Thread):
                 buf.write(_rainbow_colorize("pong"))
                 buf.write("\n")
                 client.send_cc(buf.getvalue())
-                clients_needing_prompt.add(client_name)
+                clients_needing_prompt.add(client)
             else:
-                clients_needing_prompt.add(client_name)
+                clients_needing_prompt.add(client)
                 if client_cmd:
                     m_headers = {
                         message.VALIDATED_HEADER: True,
@@ -446,23 +698,29 @@ class Watcher(threading.Thread):
                         'directed': True,
                     })
                     m_kind = "telnet/message"
-                    m = TelnetMessage(m_kind, m_headers, m_body)
+                    m = TelnetMessage(
+                        m_kind, m_headers, m_body,
+                        max_buffered=self.max_output,
+                        block_timeout=self.output_block_timeout)
+                    # NOTE: Instead of polling every client for output, the
+                    # message (and its future) wake the selector loop up
+                    # when there is something to write back out.
+                    m.on_output = functools.partial(self._mark_ready, client)
                     if thread_ts is None:
                         fut = self.bot.submit_message(m, c.TARGETED)
                     else:
                         fut = self.bot.submit_message(m, c.FOLLOWUP)
                     client.futs.append(fut)
+                    fut.add_done_callback(
+                        functools.partial(self._mark_ready, client))
                     buf = six.StringIO()
                     buf.write("Submitted thread %s" % _cook_message_ts(m))
                     buf.write("\n")
                     client.send_cc(buf.getvalue())
 
     def _process_clients_prompts(self, clients_needing_prompt):
-        for client in list(six.itervalues(self._server.clients)):
-            if not client.active:
-                continue
-            client_name = client.addrport()
-            if client_name in clients_needing_prompt:
+        for client in clients_needing_prompt:
+            if client.active:
                 client.send_cc(self._make_prompt())
 
     @staticmethod
@@ -470,24 +728,62 @@ class Watcher(threading.Thread):
         pass
 
     def setup(self):
-        self._server = async_boa.TelnetServer(
-            port=self.port, address=self.address,
-            timeout=self.WAIT_TIMEOUT, on_connect=self._on_connect,
-            on_disconnect=self._on_disconnect,
-            max_connections=self.max_connections,
-            client_class=TelnetClient)
-        return ":".join(
-            str(p) for p in self._server.server_socket.getsockname())
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_sock.setsockopt(socket.SOL_SOCKET,
+                                   socket.SO_REUSEADDR, 1)
+            server_sock.bind((self.address, self.port))
+            server_sock.listen(self.LISTEN_BACKLOG)
+            server_sock.setblocking(False)
+        except socket.error:
+            server_sock.close()
+            raise
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            os.set_blocking(fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(server_sock, selectors.EVENT_READ, self._ACCEPT)
+        selector.register(wakeup_r, selectors.EVENT_READ, self._WAKEUP)
+        self._server_sock = server_sock
+        self._wakeup_r = wakeup_r
+        self._wakeup_w = wakeup_w
+        self._selector = selector
+        return ":".join(str(p) for p in server_sock.getsockname())
+
+    def _teardown(self):
+        for client in list(six.itervalues(self._clients)):
+            self._disconnect(client)
+        self._selector.close()
+        self._server_sock.close()
+        wakeup_r, wakeup_w = self._wakeup_r, self._wakeup_w
+        self._wakeup_w = self._wakeup_r = None
+        os.close(wakeup_w)
+        os.close(wakeup_r)
 
     def run(self):
-        server = self._server
         try:
             while not self.dead.is_set():
-                server.poll()
-                self._kick_idle()
+                events = self._selector.select(self._next_timeout())
                 cnp = set()
-                self._process_clients_input(cnp)
-                self._process_clients_futs(cnp)
+                touched = {}
+                for key, mask in events:
+                    if key.data is self._WAKEUP:
+                        self._drain_wakeup()
+                    elif key.data is self._ACCEPT:
+                        self._accept(touched)
+                    else:
+                        client = key.data
+                        touched[client.fileno] = client
+                        self._process_client_socket(client, mask, cnp)
+                self._kick_idle(touched)
+                for client in self._pop_ready():
+                    if self._is_current(client):
+                        touched[client.fileno] = client
+                        self._process_client_futs(client, cnp)
                 self._process_clients_prompts(cnp)
+                for client in cnp:
+                    touched[client.fileno] = client
+                for client in six.itervalues(touched):
+                    self._update_interest(client)
         finally:
-            server.stop()
+            self._teardown()
@@ -1,25 +1,121 @@
 import json
 import logging
 import re
+import threading
+import time
 
+import cachetools
 import munch
 
 from webob import exc
 from webob import Request
 from webob import Response
 
-from padre import channel as c
-from padre import finishers
 from padre import message
 from padre import wsgi_utils as wu
 
 LOG = logging.getLogger(__name__)
 
 
+class DeliveryTracker(object):
+    """Remembers (for a while) which github deliveries were accepted."""
+
+    #: Brain key deliveries get persisted under (when persisting).
+    BRAIN_KEY = "github:deliveries"
+
+    #: How many persisted deliveries between pruning the persisted ones.
+    PRUNE_EVERY = 64
+
+    def __init__(self, max_size=10000, ttl=86400, brain=None):
+        self.ttl = ttl
+        self.brain = brain
+        # NOTE: wall clock time (vs. monotonic time) is used so that
+        # persisted deliveries can expire correctly after a restart.
+        self._seen = cachetools.TTLCache(max_size, ttl, timer=time.time)
+        self._lock = threading.Lock()
+        self._loaded = brain is None
+        self._persists = 0
+
+    @classmethod
+    def from_config(cls, config, brain=None):
+        if not config.get("enabled", True):
+            return None
+        if not config.get("persist", False):
+            brain = None
+        return cls(max_size=config.get("max_size", 10000),
+                   ttl=config.get("ttl", 86400), brain=brain)
+
+    def _load(self):
+        try:
+            persisted = self.brain[self.BRAIN_KEY]
+        except KeyError:
+            persisted = {}
+        now = time.time()
+        expired = []
+        for delivery_id, seen_at in persisted.items():
+            if now - seen_at >= self.ttl:
+                expired.append(delivery_id)
+            else:
+                self._seen[delivery_id] = seen_at
+        if expired:
+            with self.brain.lock_for(self.BRAIN_KEY):
+                for delivery_id in expired:
+                    self.brain.pop_field(self.BRAIN_KEY, delivery_id)
+        self._loaded = True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+    def claim(self, delivery_id):
+        """Marks a delivery as seen (returns false if it already was)."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if delivery_id in self._seen:
+                return False
+            self._seen[delivery_id] = time.time()
+            return True
+
+    def release(self, delivery_id):
+        """Forgets a claimed delivery (so that it can be retried)."""
+        with self._lock:
+            self._seen.pop(delivery_id, None)
+
+    def persist(self, delivery_id):
+        """Records (in the brain) that a claimed delivery was accepted."""
+        if self.brain is None:
+            return
+        with self._lock:
+            try:
+                seen_at = self._seen[delivery_id]
+            except KeyError:
+                return
+            self._persists += 1
+            prune = self._persists % self.PRUNE_EVERY == 0
+            alive = set(self._seen) if prune else None
+        with self.brain.lock_for(self.BRAIN_KEY):
+            if prune:
+                # Anything evicted (or expired) from memory should also
+                # stop being persisted, so drop those every so often.
+                try:
+                    persisted = list(self.brain[self.BRAIN_KEY])
+                except KeyError:
+                    persisted = []
+                for old_delivery_id in persisted:
+                    if old_delivery_id not in alive:
+                        self.brain.pop_field(self.BRAIN_KEY, old_delivery_id)
+            self.brain.set_field(self.BRAIN_KEY, delivery_id, seen_at)
+
+
 class HookApplication(object):
     hook_path = "github-webhook"
     pong_response = json.dumps({'msg': 'pong'}, indent=4)
 
+    #: Largest body accepted (unless configured); github itself caps
+    #: payloads at 25 MB.
+    max_body_bytes = 25 * 1024 * 1024
+
     def __init__(self, bot):
         self.urls = [
             # Order matters.
@@ -27,6 +123,20 @@ class HookApplication(object):
              ["GET", "POST"], self.hook),
         ]
         self.bot = bot
+        try:
+            dedup_config = bot.config.github.hook.get("dedup", {})
+        except AttributeError:
+            dedup_config = {}
+        self.deliveries = DeliveryTracker.from_config(
+            dedup_config, brain=getattr(bot, 'brain', None))
+
+    def reply_duplicate(self, req, delivery_id):
+        LOG.info("Skipping already accepted github delivery '%s'",
+                 delivery_id)
+        resp = Response()
+        resp.status = 200
+        resp.headers['X-Padre-Duplicate'] = 'true'
+        return resp
 
     def __call__(self, environ, start_response):
         req = Request(environ)
@@ -65,6 +175,16 @@ class HookApplication(object):
             raise exc.HTTPBadRequest
         if kind == 'ping':
             return self.reply_pong(req)
+        hook_config = self.bot.config.github.hook
+        events = hook_config.get('events')
+        if events and kind not in events:
+            # Not something we'd do anything with, so don't bother reading
+            # (or decoding) it.
+            LOG.debug("Ignoring unwanted github event '%s' (delivery"
+                      " id '%s')", kind, delivery_id)
+            resp = Response()
+            resp.status = 204
+            return resp
         req_meth = req.method
         if req_meth != "POST":
             raise exc.HTTPBadRequest
@@ -78,27 +198,44 @@ class HookApplication(object):
                 raise ValueError
         except ValueError:
             raise exc.HTTPBadRequest
+        secret = hook_config.get('secret', '')
         try:
-            req_body = req.body_file.read(data_len)
+            if secret:
+                checker = wu.SignatureChecker(
+                    req.headers.get('X-Hub-Signature'), secret)
+            else:
+                checker = None
+            req_body = wu.read_body(
+                req.body_file, data_len, checker=checker,
+                max_bytes=hook_config.get('max_body_bytes',
+                                          self.max_body_bytes))
+            if checker is not None:
+                checker.verify()
+        except wu.BodyTooLarge:
+            LOG.warning("Rejecting too large github delivery '%s'"
+                        " of %s bytes", delivery_id, data_len)
+            raise exc.HTTPRequestEntityTooLarge
         except IOError:
             raise exc.HTTPBadRequest
-        secret = self.bot.config.github.hook.get('secret', '')
-        try:
-            if secret:
-                wu.check_signature(req.headers.get('X-Hub-Signature'),
-                                   req_body, secret)
         except (wu.NoSignature, wu.BadSignature):
-            LOG.debug(
-                "Received no/bad signature for delivery id '%s' with"
-                " body '%s'", delivery_id, req_body)
+            LOG.debug("Received no/bad signature for delivery id '%s'",
+                      delivery_id)
             raise exc.HTTPUnauthorized
         except wu.UnknownSignatureAlgorithm:
             raise exc.HTTPBadRequest
+        # NOTE: this is checked after the signature is (so that unsigned
+        # requests can't fill up the seen deliveries with junk) but before
+        # anything else is done with the body.
+        deliveries = self.deliveries
+        if deliveries is not None and not deliveries.claim(delivery_id):
+            return self.reply_duplicate(req, delivery_id)
         try:
             req_body = json.loads(req_body.decode('utf-8'))
             if not isinstance(req_body, dict):
                 raise ValueError
         except (ValueError, TypeError, UnicodeError):
+            if deliveries is not None:
+                deliveries.release(delivery_id)
             raise exc.HTTPBadRequest
         else:
             m_kind = 'github/%s' % kind
@@ -110,12 +247,18 @@ class HookApplication(object):
             m_body = munch.munchify(req_body)
             m = message.Message(m_kind, m_headers, m_body)
             try:
-                self.bot.submit_message(m, c.BROADCAST)
-                fut = self.bot.submit_message(m, c.TARGETED)
-                fut.add_done_callback(
-                    finishers.log_on_fail(self.bot, m, log=LOG))
+                wu.submit_hook_message(self.bot, m, log=LOG)
             except RuntimeError:
                 pass
+            except (IOError, OSError):
+                # Couldn't record it; so don't accept it (the sender will
+                # hopefully retry it later).
+                LOG.exception("Failed spooling %s message", m_kind)
+                if deliveries is not None:
+                    deliveries.release(delivery_id)
+                raise exc.HTTPServiceUnavailable
+            if deliveries is not None:
+                deliveries.persist(delivery_id)
             resp = Response()
             resp.status = 202
             return resp
@@ -130,4 +273,5 @@ def create_server(bot, max_workers):
     except AttributeError:
         exposed = False
     return wu.WSGIServerRunner(ssl_config, wsgi_app, wsgi_port,
-                               exposed=exposed, max_workers=max_workers)
+                               exposed=exposed, max_workers=max_workers,
+                               server_config=bot.config.get("wsgi_server"))
@@ -8,8 +8,6 @@ from webob import exc
 from webob import Request
 from webob import Response
 
-from padre import channel as c
-from padre import finishers
 from padre import message
 from padre import wsgi_utils as wu
 
@@ -20,6 +18,9 @@ EVENT_PREFIX = "jira:"
 class HookApplication(object):
     hook_path = "jira-webhook"
 
+    #: Largest body accepted (unless configured).
+    max_body_bytes = 10 * 1024 * 1024
+
     def __init__(self, bot):
         self.urls = [
             # Order matters.
@@ -70,7 +71,17 @@ class HookApplication(object):
                      exc_info=True)
             raise exc.HTTPBadRequest
         try:
-            req_body = req.body_file.read(data_len)
+            max_body_bytes = self.bot.config.jira.hook.get(
+                'max_body_bytes', self.max_body_bytes)
+        except AttributeError:
+            max_body_bytes = self.max_body_bytes
+        try:
+            req_body = wu.read_body(req.body_file, data_len,
+                                    max_bytes=max_body_bytes)
+        except wu.BodyTooLarge:
+            LOG.warn("Rejecting too large jira event"
+                     " of %s bytes", data_len)
+            raise exc.HTTPRequestEntityTooLarge
         except IOError:
             LOG.warn("Could not read full POST body", exc_info=True)
             raise exc.HTTPBadRequest
@@ -107,12 +118,14 @@ class HookApplication(object):
             m_body = munch.munchify(req_body)
             m = message.Message(m_kind, m_headers, m_body)
             try:
-                self.bot.submit_message(m, c.BROADCAST)
-                fut = self.bot.submit_message(m, c.TARGETED)
-                fut.add_done_callback(
-                    finishers.log_on_fail(self.bot, m, log=LOG))
+                wu.submit_hook_message(self.bot, m, log=LOG)
             except RuntimeError:
                 pass
+            except (IOError, OSError):
+                # Couldn't record it; so don't accept it (the sender will
+                # hopefully retry it later).
+                LOG.exception("Failed spooling %s message", m_kind)
+                raise exc.HTTPServiceUnavailable
             resp = Response()
             resp.status = 202
             return resp
@@ -127,4 +140,5 @@ def create_server(bot, max_workers):
     except AttributeError:
         exposed = False
     return wu.WSGIServerRunner(ssl_config, wsgi_app, wsgi_port,
-                               exposed=exposed, max_workers=max_workers)
+                               exposed=exposed, max_workers=max_workers,
+                               server_config=bot.config.get("wsgi_server"))
@@ -9,8 +9,6 @@ from webob import exc
 from webob import Request
 from webob import Response
 
-from padre import channel as c
-from padre import finishers
 from padre import message
 from padre import wsgi_utils as wu
 
@@ -20,6 +18,9 @@ LOG = logging.getLogger(__name__)
 class HookApplication(object):
     hook_path = "sensu-webhook"
 
+    #: Largest body accepted (unless configured).
+    max_body_bytes = 1024 * 1024
+
     def __init__(self, bot):
         self.urls = [
             # Order matters.
@@ -47,7 +48,24 @@ class HookApplication(object):
         else:
             return resp(environ, start_response)
 
+    @staticmethod
+    def reply_ignored(action):
+        LOG.debug("Ignoring unwanted sensu event (%s)", action)
+        resp = Response()
+        resp.status = 204
+        return resp
+
     def hook(self, req):
+        hook_config = self.bot.config.sensu.hook
+        actions = hook_config.get('actions')
+        if actions:
+            # Sensu itself sends no header saying what kind of event it
+            # is; senders that set one get unwanted events rejected before
+            # their body is read (or decoded), others get them rejected
+            # right after it is decoded.
+            action = req.headers.get('X-Padre-Action', '').strip()
+            if action and action not in actions:
+                return self.reply_ignored(action)
         req_meth = req.method
         if req_meth.lower() != "post":
             LOG.warning("Received invalid sensu request"
@@ -69,28 +87,36 @@ class HookApplication(object):
             LOG.warning("Could not extract request content length",
                         exc_info=True)
             raise exc.HTTPBadRequest
+        secret = hook_config.get('secret', '')
+        req_headers = req.headers
         try:
-            req_body = req.body_file.read(data_len)
+            if secret:
+                checker = wu.SignatureChecker(
+                    req_headers.get('X-Padre-Signature'), secret)
+            else:
+                checker = None
+            req_body = wu.read_body(
+                req.body_file, data_len, checker=checker,
+                max_bytes=hook_config.get('max_body_bytes',
+                                          self.max_body_bytes))
+            if checker is not None:
+                checker.verify()
+        except wu.BodyTooLarge:
+            LOG.warning("Rejecting too large sensu"
+                        " event of %s bytes", data_len)
+            raise exc.HTTPRequestEntityTooLarge
         except IOError:
             LOG.warning("Could not read full POST body", exc_info=True)
             raise exc.HTTPBadRequest
-        secret = self.bot.config.sensu.hook.get('secret', '')
-        req_headers = req.headers
-        try:
-            if secret:
-                wu.check_signature(req_headers.get('X-Padre-Signature'),
-                                   req_body, secret)
         except (wu.NoSignature, wu.BadSignature):
             LOG.warning(
                 "Received no/bad signature for"
-                " body '%s'; headers=%s", req_body,
-                req_headers, exc_info=True)
+                " sensu event; headers=%s", req_headers, exc_info=True)
             raise exc.HTTPUnauthorized
         except wu.UnknownSignatureAlgorithm:
             LOG.warning(
                 "Received unknown signature algorithm for"
-                " body '%s'; headers=%s", req_body, req_headers,
-                exc_info=True)
+                " sensu event; headers=%s", req_headers, exc_info=True)
             raise exc.HTTPBadRequest
         try:
             if isinstance(req_body, six.binary_type):
@@ -113,6 +139,8 @@ class HookApplication(object):
                             " event body '%s' (missing event 'action')",
                             req_body, exc_info=True)
                 raise exc.HTTPBadRequest
+            if actions and event_action not in actions:
+                return self.reply_ignored(event_action)
             if secret:
                 LOG.debug("Received validated"
                           " sensu event (%s): %s", event_action, req_body)
@@ -129,12 +157,14 @@ class HookApplication(object):
             m_body = munch.munchify(req_body)
             m = message.Message(m_kind, m_headers, m_body)
             try:
-                self.bot.submit_message(m, c.BROADCAST)
-                fut = self.bot.submit_message(m, c.TARGETED)
-                fut.add_done_callback(
-                    finishers.log_on_fail(self.bot, m, log=LOG))
+                wu.submit_hook_message(self.bot, m, log=LOG)
             except RuntimeError:
                 pass
+            except (IOError, OSError):
+                # Couldn't record it; so don't accept it (the sender will
+                # hopefully retry it later).
+                LOG.exception("Failed spooling %s message", m_kind)
+                raise exc.HTTPServiceUnavailable
             resp = Response()
             resp.status = 202
             return resp
@@ -149,4 +179,5 @@ def create_server(bot, max_workers):
     except AttributeError:
         exposed = False
     return wu.WSGIServerRunner(ssl_config, wsgi_app, wsgi_port,
-                               exposed=exposed, max_workers=max_workers)
+                               exposed=exposed, max_workers=max_workers,
+                               server_config=bot.config.get("wsgi_server"))
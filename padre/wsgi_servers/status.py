@@ -1,27 +1,37 @@
 import copy
+import datetime
 import errno
 import functools
+import hashlib
 import logging
 import os
 import pkg_resources
 import platform
 import re
 import socket
+import stat
 import sys
 import threading
 import traceback
 
+import cachetools
 import munch
+from oslo_utils import excutils
 from oslo_utils import reflection
 from oslo_utils import strutils
+from oslo_utils import timeutils
 import six
 from tabulate import tabulate
 from webob import exc
 from webob import Request
 from webob import Response
+from webob import static
 
+from padre import memory_utils
+from padre import metrics
 from padre import mixins
 from padre import periodic_utils as pu
+from padre import profile_utils
 from padre import utils
 from padre import wsgi_utils as wu
 
@@ -112,7 +122,195 @@ def _check_accepts(offers):
     return decorator
 
 
+class FollowFileIter(object):
+    """Iterates over a (growing) file, following data appended to it.
+
+    Stops after some number of seconds (or when the bot starts dying); if
+    the file is rotated (or truncated) while being followed then it is
+    re-opened and followed from its start.
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, path, fh, timeout, dead,
+                 poll_interval=0.5, on_close=None):
+        self.path = path
+        self.fh = fh
+        self.timeout = timeout
+        self.dead = dead
+        self.poll_interval = poll_interval
+        self.on_close = on_close
+
+    def _was_rotated(self):
+        try:
+            path_stat = os.stat(self.path)
+        except OSError:
+            return False
+        fh_stat = os.fstat(self.fh.fileno())
+        return (path_stat.st_ino != fh_stat.st_ino or
+                path_stat.st_size < self.fh.tell())
+
+    def __iter__(self):
+        watch = timeutils.StopWatch(duration=self.timeout)
+        watch.start()
+        while True:
+            data = self.fh.read(self.block_size)
+            if data:
+                yield data
+                continue
+            if watch.expired() or self.dead.is_set():
+                break
+            if self._was_rotated():
+                self.fh.close()
+                self.fh = open(self.path, 'rb')
+                continue
+            self.dead.wait(self.poll_interval)
+
+    def close(self):
+        self.fh.close()
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+
+
+class StaticAsset(object):
+    """Some static file (and its precomputed gzip variant and etag)."""
+
+    #: Content types that are worth compressing.
+    COMPRESSIBLE = frozenset([
+        'application/javascript', 'application/json',
+        'image/svg+xml', 'image/x-icon',
+    ])
+
+    #: Content types by (lower cased) file extension.
+    CONTENT_TYPES = {
+        'css': 'text/css',
+        'html': 'text/html',
+        'ico': 'image/x-icon',
+        'js': 'application/javascript',
+        'png': 'image/png',
+        'svg': 'image/svg+xml',
+    }
+
+    def __init__(self, path, body, mtime, size):
+        self.path = path
+        self.body = body
+        self.mtime = mtime
+        self.size = size
+        self.etag = hashlib.sha1(body).hexdigest()
+        _base, ext = os.path.splitext(path)
+        ext = ext.lower().lstrip(".")
+        self.content_type = self.CONTENT_TYPES.get(ext, 'application/binary')
+        self.gzip_body = None
+        if (self.content_type.startswith("text/") or
+                self.content_type in self.COMPRESSIBLE):
+            gzip_body = utils.gzip_compress(body)
+            if len(gzip_body) < len(body):
+                self.gzip_body = gzip_body
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            path_stat = os.fstat(fh.fileno())
+            return cls(path, fh.read(), path_stat.st_mtime,
+                       path_stat.st_size)
+
+
+class StaticCache(object):
+    """Loads static assets once (reloading them if they change)."""
+
+    def __init__(self):
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            path_stat = None
+        if path_stat is None or not stat.S_ISREG(path_stat.st_mode):
+            with self.lock:
+                self.assets.pop(path, None)
+            return None
+        with self.lock:
+            asset = self.assets.get(path)
+        if (asset is not None and asset.mtime == path_stat.st_mtime and
+                asset.size == path_stat.st_size):
+            return asset
+        try:
+            asset = StaticAsset.load(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with self.lock:
+            self.assets[path] = asset
+        return asset
+
+
+class CachedDocument(object):
+    """Document that gets rebuilt (at most) once per some interval.
+
+    The build function may return a ``(body, stable_body)`` pair, in which
+    case the etag (which then is a weak one) is computed from the latter
+    only; this is for documents that have some always changing parts
+    (which alone should not make clients fetch them again).
+    """
+
+    def __init__(self, build_func, max_age):
+        self.build_func = build_func
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.body = None
+        self.etag = None
+        self.strong_etag = True
+        self.last_modified = None
+        self.watch = None
+
+    @staticmethod
+    def _encode(body):
+        if isinstance(body, six.text_type):
+            body = body.encode("utf-8")
+        return body
+
+    def get(self):
+        with self.lock:
+            if (self.watch is None or self.watch.expired() or
+                    self.body is None):
+                body = self.build_func()
+                if isinstance(body, tuple):
+                    body, stable_body = body
+                    self.strong_etag = False
+                else:
+                    stable_body = body
+                    self.strong_etag = True
+                self.body = self._encode(body)
+                etag = hashlib.sha1(self._encode(stable_body)).hexdigest()
+                if etag != self.etag:
+                    self.etag = etag
+                    self.last_modified = datetime.datetime.utcnow()
+                self.watch = timeutils.StopWatch(duration=self.max_age)
+                self.watch.start()
+            etag = (self.etag, self.strong_etag)
+            return self.body, etag, self.last_modified
+
+
 class StatusApplication(mixins.TemplateUser):
+    #: Default seconds the /status and /config documents are cached for.
+    SNAPSHOT_INTERVAL = 2.0
+
+    #: Default seconds browsers may cache static assets for.
+    STATIC_MAX_AGE = 3600
+
+    #: Default seconds between (actual) thread stack captures.
+    STACKS_INTERVAL = 10.0
+
+    #: Default (and max) samples per second the profiler takes and
+    #: the most seconds it may be ran for.
+    PROFILE_RATE = 100
+    PROFILE_MAX_RATE = 1000
+    PROFILE_MAX_SECONDS = 60.0
+
     def __init__(self, bot):
         self.urls = [
             (re.compile("^([/]*)$", re.I), ["GET"], self.reply_index)
@@ -127,6 +325,20 @@ class StatusApplication(mixins.TemplateUser):
                 (re.compile(v_r, re.I), ["GET"], self.reply_config))
         self.urls.append(
             (re.compile(r"^static/(.*)$", re.I), ["GET"], self.reply_static))
+        self.urls.append(
+            (re.compile(r"^metrics$", re.I), ["GET"], self.reply_metrics))
+        self.urls.append(
+            (re.compile(r"^stacks(\.txt)?$", re.I), ["GET"],
+             self.reply_stacks))
+        self.urls.append(
+            (re.compile(r"^profile(\.txt)?$", re.I), ["GET"],
+             self.reply_profile))
+        self.urls.append(
+            (re.compile(r"^memory(\.json)?$", re.I), ["GET"],
+             self.reply_memory))
+        self.urls.append(
+            (re.compile(r"^memory/(start|stop|snapshot)$", re.I), ["POST"],
+             self.reply_memory_action))
         for v in ("periodics", "periodics.json"):
             v_r = r'^' + v + r'$'
             self.urls.append(
@@ -137,15 +349,74 @@ class StatusApplication(mixins.TemplateUser):
             pass
         else:
             log_http_max_bytes = int(bot.config.get("log_http_max_bytes", -1))
+            self.log_follow_timeout = float(
+                bot.config.get("log_http_follow_timeout", 60))
+            self.log_max_followers = int(
+                bot.config.get("log_http_max_followers", 4))
             reply_func = functools.partial(
                 self.reply_log, log_file, log_http_max_bytes)
             for v in ("log.txt", "logging.txt"):
                 v_r = r'^' + v + r'$'
                 self.urls.append((re.compile(v_r, re.I), ["GET"], reply_func))
+        self.log_followers = 0
+        self.log_followers_lock = threading.Lock()
         self.bot = bot
         self.template_dirs = list(bot.config.get('template_dirs', []))
         self.template_subdir = 'status'
         self.statics_dir = bot.config.statics_dir
+        self.static_cache = StaticCache()
+        try:
+            self.static_max_age = int(bot.config.status.get(
+                "static_max_age", self.STATIC_MAX_AGE))
+        except AttributeError:
+            self.static_max_age = self.STATIC_MAX_AGE
+        try:
+            snapshot_interval = bot.config.status.get(
+                "snapshot_interval", self.SNAPSHOT_INTERVAL)
+        except AttributeError:
+            snapshot_interval = self.SNAPSHOT_INTERVAL
+        self.snapshot_interval = max(0, float(snapshot_interval))
+        self.status_doc = CachedDocument(self._build_status,
+                                         self.snapshot_interval)
+        self.config_doc = CachedDocument(self._build_config,
+                                         self.snapshot_interval)
+        self.index_doc = CachedDocument(self._build_index,
+                                        self.snapshot_interval)
+        try:
+            stacks_interval = bot.config.status.get(
+                "stacks_interval", self.STACKS_INTERVAL)
+        except AttributeError:
+            stacks_interval = self.STACKS_INTERVAL
+        self.stacks_interval = max(0, float(stacks_interval))
+        self.stacks_doc = CachedDocument(self._build_stacks,
+                                         self.stacks_interval)
+        self.profile_lock = threading.Lock()
+        self.memory_tracer = memory_utils.MemoryTracer()
+        try:
+            profile_config = dict(bot.config.status.get("profile", {}))
+        except AttributeError:
+            profile_config = {}
+        self.profile_rate = int(profile_config.get(
+            'rate', self.PROFILE_RATE))
+        self.profile_max_rate = int(profile_config.get(
+            'max_rate', self.PROFILE_MAX_RATE))
+        self.profile_max_seconds = float(profile_config.get(
+            'max_seconds', self.PROFILE_MAX_SECONDS))
+
+    def _reply_cached(self, cached_doc, content_type='application/json'):
+        body, etag, last_modified = cached_doc.get()
+        resp = Response()
+        resp.content_type = content_type
+        resp.charset = 'utf-8'
+        resp.status = 200
+        resp.body = body
+        resp.etag = etag
+        resp.last_modified = last_modified
+        resp.cache_control.max_age = int(cached_doc.max_age)
+        # This makes webob reply with a 304 (and no body) when the
+        # request has a matching If-None-Match (or If-Modified-Since).
+        resp.conditional_response = True
+        return resp
 
     def __call__(self, environ, start_response):
         req = Request(environ)
@@ -180,30 +451,70 @@ class StatusApplication(mixins.TemplateUser):
         except KeyError:
             pass
         try:
-            with open(log_file, 'rb') as fh:
-                if max_len > 0:
-                    _left_am, contents = utils.read_backwards_up_to(fh,
-                                                                    max_len)
-                elif max_len == 0:
-                    contents = ''
-                else:
-                    contents = fh.read()
+            follow = strutils.bool_from_string(req.params['follow'])
+        except KeyError:
+            follow = False
+        try:
+            fh = open(log_file, 'rb')
         except IOError as e:
             if e.errno == errno.ENOENT:
                 # Likely not made yet, just send back nothing...
-                contents = ''
+                resp = Response()
+                resp.status = 200
+                resp.content_type = 'text/plain'
+                resp.body = b''
+                return resp
             else:
                 raise
-        resp = Response()
-        resp.status = 200
-        resp.content_type = 'text/plain'
         try:
-            contents_nl = contents.index("\n")
-            resp.body = contents[contents_nl + 1:]
-        except ValueError:
-            resp.body = contents
+            log_stat = os.fstat(fh.fileno())
+            log_size = log_stat.st_size
+            if req.range is not None and not follow:
+                # Let webob pick out the requested range(s) and reply
+                # with a 206 (it will then seek into the file iterator).
+                resp = Response()
+                resp.status = 200
+                resp.content_type = 'text/plain'
+                resp.app_iter = static.FileIter(fh)
+                resp.content_length = log_size
+                resp.last_modified = log_stat.st_mtime
+                resp.etag = "%x-%x" % (log_stat.st_ino, log_size)
+                resp.accept_ranges = 'bytes'
+                resp.conditional_response = True
+                return resp
+            if max_len > 0:
+                start = utils.find_next_line_start(
+                    fh, max(0, log_size - max_len))
+            elif max_len == 0:
+                start = log_size
+            else:
+                start = 0
+            resp = Response()
+            resp.status = 200
+            resp.content_type = 'text/plain'
+            resp.accept_ranges = 'bytes'
+            if follow:
+                with self.log_followers_lock:
+                    if self.log_followers >= self.log_max_followers:
+                        raise exc.HTTPServiceUnavailable
+                    self.log_followers += 1
+                fh.seek(start)
+                resp.app_iter = FollowFileIter(
+                    log_file, fh, self.log_follow_timeout, self.bot.dead,
+                    on_close=self._on_log_follower_done)
+            else:
+                resp.app_iter = static.FileIter(fh).app_iter_range(
+                    seek=start, limit=log_size)
+                resp.content_length = log_size - start
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                fh.close()
         return resp
 
+    def _on_log_follower_done(self):
+        with self.log_followers_lock:
+            self.log_followers -= 1
+
     def reply_static(self, req, req_match):
         path = req_match.group(1)
         # Ensure that the path isn't trying to do wild things like
@@ -213,25 +524,73 @@ class StatusApplication(mixins.TemplateUser):
         if not path_m:
             raise exc.HTTPBadRequest
         static_path = os.path.join(self.statics_dir, path)
-        if not os.path.isfile(static_path):
+        asset = self.static_cache.get(static_path)
+        if asset is None:
             raise exc.HTTPNotFound
+        resp = Response()
+        resp.status = 200
+        resp.content_type = asset.content_type
+        # NOTE: only send gzip to clients that explicitly said they can
+        # take it (having no header at all technically allows anything).
+        if (asset.gzip_body is not None and req.accept_encoding and
+                'gzip' in req.accept_encoding):
+            resp.body = asset.gzip_body
+            resp.content_encoding = 'gzip'
+            resp.etag = asset.etag + "-gzip"
         else:
-            resp = Response()
-            resp.status = 200
-            with open(static_path, 'rb') as fh:
-                resp.body = fh.read()
-            _base, ext = os.path.splitext(static_path)
-            ext = ext.lower()
-            ext = ext.lstrip(".")
-            if ext == 'ico':
-                resp.content_type = 'image/x-icon'
-            elif ext == "png":
-                resp.content_type = 'image/png'
-            elif ext == "html":
-                resp.content_type = 'text/html'
-            else:
-                resp.content_type = 'application/binary'
-            return resp
+            resp.body = asset.body
+            resp.etag = asset.etag
+        resp.vary = ('Accept-Encoding',)
+        resp.last_modified = asset.mtime
+        resp.cache_control.public = True
+        resp.cache_control.max_age = self.static_max_age
+        resp.conditional_response = True
+        return resp
+
+    def _build_runtime_metrics(self):
+        queue_depth = metrics.Gauge(
+            "padre_executor_queue_depth",
+            "Work items waiting for an executor worker.", ('executor',))
+        workers = metrics.Gauge(
+            "padre_executor_workers",
+            "Executor workers (and how many are busy).",
+            ('executor', 'state'))
+        for name, executor in list(self.bot.executors.items()):
+            try:
+                queue_depth.set(executor.queue_size, executor=name)
+                num_workers = executor.num_workers
+                num_idle = executor.get_num_idle_workers()
+            except AttributeError:
+                continue
+            workers.set(num_workers - num_idle, executor=name,
+                        state='active')
+            workers.set(num_idle, executor=name, state='idle')
+        runtime_metrics = [queue_depth, workers]
+        scheduler = self.bot.scheduler
+        if scheduler is not None:
+            jobs = metrics.Gauge("padre_scheduler_jobs",
+                                 "Jobs known to the periodic scheduler.")
+            jobs.set(len(scheduler.get_jobs()))
+            runtime_metrics.append(jobs)
+        watcher_queues = metrics.Gauge(
+            "padre_watcher_queue_depth",
+            "Events queued by watchers (waiting to be processed).",
+            ('watcher',))
+        for w_name, w in list(self.bot.watchers.items()):
+            w_queue = getattr(w, 'queue', None)
+            if w_queue is not None:
+                watcher_queues.set(w_queue.depth, watcher=w_name)
+        runtime_metrics.append(watcher_queues)
+        return runtime_metrics
+
+    def reply_metrics(self, req, req_match):
+        resp = Response()
+        resp.status = 200
+        resp.content_type = 'text/plain'
+        resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+        resp.text = metrics.REGISTRY.render(
+            extra_metrics=self._build_runtime_metrics())
+        return resp
 
     @_check_accepts(['application/json'])
     def reply_periodics(self, req, req_match):
@@ -251,41 +610,166 @@ class StatusApplication(mixins.TemplateUser):
         resp.text = utils.dump_json(resp_body, pretty=True) + "\n"
         return resp
 
-    @_check_accepts(['text/html', 'application/xhtml+xml',
-                     'application/xml', 'text/xml'])
-    def reply_index(self, req, req_match):
+    def _build_index(self):
         me = pkg_resources.get_distribution('padre')
-        resp = Response()
-        resp.content_type = 'text/html'
-        resp.status = 200
         sys_table, sys_headers = _introspect_system()
         env_table, env_headers = _introspect_environment()
-        resp.text = self.render_template("index.html", {
+        return self.render_template("index.html", {
             'bot_app_version': me.version,
             'bot_app_name': me.key,
             'bot_name': self.bot.name,
             'sys_table': tabulate(sys_table, sys_headers, tablefmt='grid'),
             'env_table': tabulate(env_table, env_headers, tablefmt='grid'),
             'bot_config': self.bot.config,
-            'threads': _get_threadstacks(),
+            'stacks_interval': self.stacks_interval,
         })
+
+    @_check_accepts(['text/html', 'application/xhtml+xml',
+                     'application/xml', 'text/xml'])
+    def reply_index(self, req, req_match):
+        return self._reply_cached(self.index_doc, content_type='text/html')
+
+    def _build_stacks(self):
+        thread_names = dict((t.ident, t.name) for t in threading.enumerate())
+        lines = [
+            "Captured at %s (at most once every %s seconds)" % (
+                datetime.datetime.utcnow().isoformat(),
+                self.stacks_interval),
+            "",
+        ]
+        for t in _get_threadstacks():
+            lines.append("Thread #%s (%s):" % (
+                t['id'], thread_names.get(t['id'], '???')))
+            lines.append(t['traceback'])
+        return "\n".join(lines)
+
+    def reply_stacks(self, req, req_match):
+        # NOTE: capturing (and formatting) every threads stack is not
+        # cheap, so this only actually happens every so often (requests
+        # in between get the last captured dump).
+        return self._reply_cached(self.stacks_doc, content_type='text/plain')
+
+    def reply_profile(self, req, req_match):
+        try:
+            seconds = float(req.params.get('seconds', 10))
+            rate = int(req.params.get('rate', self.profile_rate))
+        except ValueError:
+            raise exc.HTTPBadRequest
+        if seconds <= 0 or rate <= 0:
+            raise exc.HTTPBadRequest
+        seconds = min(seconds, self.profile_max_seconds)
+        rate = min(rate, self.profile_max_rate)
+        # Only one profiling session is allowed at a time (others get told
+        # to come back later).
+        if not self.profile_lock.acquire(False):
+            raise exc.HTTPConflict
+        try:
+            profiler = profile_utils.SamplingProfiler(rate=rate)
+            collapsed = profiler.run(seconds, dead=self.bot.dead)
+        finally:
+            self.profile_lock.release()
+        resp = Response()
+        resp.status = 200
+        resp.content_type = 'text/plain'
+        resp.headers['X-Profile-Samples'] = str(profiler.samples)
+        resp.headers['X-Profile-Seconds'] = str(seconds)
+        resp.headers['X-Profile-Rate'] = str(rate)
+        resp.text = profiler.format_collapsed(collapsed)
         return resp
 
-    @_check_accepts(['application/json'])
-    def reply_config(self, req, req_match):
+    def _measure_structures(self):
+        sizes = {
+            'active_handlers': len(self.bot.active_handlers),
+            'prior_handlers': {},
+            'executor_queues': {},
+            'watcher_queues': {},
+            'caches': {},
+        }
+        with self.bot.locks.prior_handlers:
+            for c, ch_handlers in self.bot.prior_handlers.items():
+                sizes['prior_handlers'][c.name.lower()] = dict(
+                    (k, len(k_handlers))
+                    for k, k_handlers in ch_handlers.items())
+        for name, executor in list(self.bot.executors.items()):
+            try:
+                sizes['executor_queues'][name] = executor.queue_size
+            except AttributeError:
+                pass
+        for w_name, w in list(self.bot.watchers.items()):
+            w_queue = getattr(w, 'queue', None)
+            if w_queue is not None:
+                sizes['watcher_queues'][w_name] = w_queue.depth
+        for h_cls in list(self.bot.handlers):
+            h_cls_name = reflection.get_class_name(h_cls)
+            for attr_name, attr in list(vars(h_cls).items()):
+                if isinstance(attr, cachetools.Cache):
+                    sizes['caches']["%s.%s" % (h_cls_name, attr_name)] = {
+                        'items': len(attr),
+                        'size': attr.currsize,
+                        'max_size': attr.maxsize,
+                    }
+        return sizes
+
+    def _reply_json(self, resp_body):
         resp = Response()
-        resp.content_type = 'application/json'
         resp.status = 200
+        resp.content_type = 'application/json'
+        resp.text = utils.dump_json(resp_body, pretty=True) + "\n"
+        return resp
+
+    @_check_accepts(['application/json'])
+    def reply_memory(self, req, req_match):
+        try:
+            limit = int(req.params.get('limit', 25))
+        except ValueError:
+            raise exc.HTTPBadRequest
+        key_type = req.params.get('key_type', 'lineno')
+        if key_type not in ('lineno', 'filename', 'traceback'):
+            raise exc.HTTPBadRequest
+        tracer = self.memory_tracer
+        return self._reply_json({
+            'tracemalloc': tracer.summary(),
+            'structures': self._measure_structures(),
+            'top': tracer.top(limit=limit, key_type=key_type),
+            'diff': tracer.diff(limit=limit, key_type=key_type),
+        })
+
+    def reply_memory_action(self, req, req_match):
+        tracer = self.memory_tracer
+        if not tracer.is_supported():
+            raise exc.HTTPNotImplemented
+        action = req_match.group(1).lower()
+        if action == 'start':
+            try:
+                frames = int(req.params.get('frames', 1))
+            except ValueError:
+                raise exc.HTTPBadRequest
+            tracer.start(frames=max(1, min(frames, 64)))
+        elif action == 'stop':
+            tracer.stop()
+        else:
+            if not tracer.is_tracing():
+                raise exc.HTTPConflict
+            tracer.take_snapshot()
+        return self._reply_json(tracer.summary())
+
+    def _build_config(self):
         tmp_config = copy.deepcopy(self.bot.config)
         tmp_config = munch.unmunchify(tmp_config)
         tmp_config = utils.mask_dict_password(tmp_config)
-        resp_body = tmp_config
-        resp_body = utils.dump_json(resp_body, pretty=True)
-        resp.text = resp_body + "\n"
-        return resp
+        return utils.dump_json(tmp_config, pretty=True) + "\n"
+
+    @_check_accepts(['application/json'])
+    def reply_config(self, req, req_match):
+        return self._reply_cached(self.config_doc)
 
     @_check_accepts(['application/json'])
     def reply_status(self, req, req_match):
+        return self._reply_cached(self.status_doc)
+
+    def _build_status(self):
+        formatted = []
+
         def _format_handler(h):
             h_cls_name = reflection.get_class_name(h)
             h_elapsed = None
@@ -293,7 +777,7 @@ class StatusApplication(mixins.TemplateUser):
                 h_elapsed = h.watch.elapsed()
             except RuntimeError:
                 pass
-            return {
+            h_formatted = {
                 'class': h_cls_name,
                 'state': h.state,
                 'state_history': list(h.state_history),
@@ -301,9 +785,8 @@ class StatusApplication(mixins.TemplateUser):
                 'message': h.message.to_dict(),
                 'created_on': h.created_on,
             }
-        resp = Response()
-        resp.content_type = 'application/json'
-        resp.status = 200
+            formatted.append(h_formatted)
+            return h_formatted
         resp_body = {}
         started_at = self.bot.started_at
         if started_at is None:
@@ -345,17 +828,24 @@ class StatusApplication(mixins.TemplateUser):
             resp_body['clients'].append(client_name)
         resp_body['wsgi_servers'] = sorted(self.bot.wsgi_servers.keys())
         resp_body['watchers'] = sorted(self.bot.watchers.keys())
+        resp_body['queues'] = {}
+        for w_name, w in self.bot.watchers.items():
+            w_queue = getattr(w, 'queue', None)
+            if w_queue is not None:
+                resp_body['queues'][w_name] = w_queue.stats()
         with self.bot.locks.channel_stats:
             resp_body['channel_stats'] = {}
             for c, c_stats in self.bot.channel_stats.items():
                 tmp_c = c.name.lower()
                 resp_body['channel_stats'][tmp_c] = copy.deepcopy(c_stats)
-        resp_body = utils.dump_json(resp_body, pretty=True)
-        resp_text = resp_body + "\n"
-        if isinstance(resp_text, six.binary_type):
-            resp_text = resp_text.decode('utf-8')
-        resp.text = resp_text
-        return resp
+        body = utils.dump_json(resp_body, pretty=True) + "\n"
+        # NOTE: uptime (and how long handlers have been running) changes
+        # on every rebuild; so leave those out of what the etag is made
+        # from (or pollers would pretty much never get a 304).
+        resp_body.pop('uptime')
+        for h_formatted in formatted:
+            h_formatted.pop('elapsed')
+        return body, utils.dump_json(resp_body, pretty=True)
 
 
 def create_server(bot, max_workers):
@@ -372,4 +862,5 @@ def create_server(bot, max_workers):
     except AttributeError:
         exposed = False
     return wu.WSGIServerRunner(ssl_config, wsgi_app, wsgi_port,
-                               exposed=exposed, max_workers=max_workers)
+                               exposed=exposed, max_workers=max_workers,
+                               server_config=bot.config.get("wsgi_server"))
@@ -1,16 +1,29 @@
+import collections
+import errno
 import hashlib
 import hmac
 import logging
 import multiprocessing
+import os
+import selectors
+import socket
 import ssl
+import sys
 import threading
+import time
 
 import futurist
 import six
+from six.moves.urllib import parse as urlparse
+from wsgiref import handlers as wsgi_handlers
 from wsgiref import simple_server
 
+import munch
 from oslo_utils import reflection
 
+from padre import channel as c
+from padre import finishers
+from padre import message
 from padre import utils
 
 LOG = logging.getLogger(__name__)
@@ -28,39 +41,91 @@ class BadSignature(Exception):
     pass
 
 
+class BodyTooLarge(Exception):
+    pass
+
+
+#: Default size of the chunks request bodies are read in.
+BODY_CHUNK_SIZE = 65536
+
+_SIGNATURE_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha224': hashlib.sha224,
+    'sha256': hashlib.sha256,
+    'sha384': hashlib.sha384,
+    'sha512': hashlib.sha512,
+    'md5': hashlib.md5,
+}
+
+
+class SignatureChecker(object):
+    """Incrementally computes (and then checks) a body signature."""
+
+    def __init__(self, header, secret):
+        if not header:
+            raise NoSignature
+        try:
+            algo_name, signature = header.split('=', 1)
+            algo_name = algo_name.lower().strip()
+        except ValueError:
+            raise NoSignature
+        try:
+            digestmod = _SIGNATURE_ALGORITHMS[algo_name]
+        except KeyError:
+            tmp_algo_name = algo_name[0:10]
+            if len(algo_name) > 10:
+                tmp_algo_name += "..."
+            raise UnknownSignatureAlgorithm(
+                "Unknown algorithm '%s'" % tmp_algo_name)
+        if isinstance(secret, six.text_type):
+            secret = secret.encode("utf8")
+        self._mac = hmac.new(secret, digestmod=digestmod)
+        self._signature = signature
+
+    def update(self, blob):
+        self._mac.update(blob)
+
+    def verify(self):
+        expected_signature = self._mac.hexdigest()
+        ok = hmac.compare_digest(expected_signature, self._signature)
+        if not ok:
+            raise BadSignature
+
+
 def check_signature(header, blob, secret):
-    if not header:
-        raise NoSignature
-    try:
-        algo_name, signature = header.split('=', 1)
-        algo_name = algo_name.lower().strip()
-    except ValueError:
-        raise NoSignature
-    if isinstance(secret, six.text_type):
-        secret = secret.encode("utf8")
-    if algo_name == 'sha1':
-        mac = hmac.new(secret, digestmod=hashlib.sha1)
-    elif algo_name == 'sha224':
-        mac = hmac.new(secret, digestmod=hashlib.sha224)
-    elif algo_name == 'sha256':
-        mac = hmac.new(secret, digestmod=hashlib.sha256)
-    elif algo_name == 'sha384':
-        mac = hmac.new(secret, digestmod=hashlib.sha384)
-    elif algo_name == 'sha512':
-        mac = hmac.new(secret, digestmod=hashlib.sha512)
-    elif algo_name == 'md5':
-        mac = hmac.new(secret, digestmod=hashlib.md5)
-    else:
-        tmp_algo_name = algo_name[0:10]
-        if len(algo_name) > 10:
-            tmp_algo_name += "..."
-        raise UnknownSignatureAlgorithm(
-            "Unknown algorithm '%s'" % tmp_algo_name)
-    mac.update(blob)
-    expected_signature = mac.hexdigest()
-    ok = hmac.compare_digest(expected_signature, signature)
-    if not ok:
-        raise BadSignature
+    checker = SignatureChecker(header, secret)
+    checker.update(blob)
+    checker.verify()
+
+
+def read_body(body_file, data_len, max_bytes=None, checker=None,
+              chunk_size=BODY_CHUNK_SIZE):
+    """Reads a request body (in chunks) feeding it to a signature checker.
+
+    Bodies claiming to be larger than ``max_bytes`` are rejected before
+    any of the body is read.
+    """
+    if max_bytes is not None and data_len > max_bytes:
+        raise BodyTooLarge("Body of %s bytes is larger than the"
+                           " allowed %s bytes" % (data_len, max_bytes))
+    chunks = []
+    remaining = data_len
+    while remaining > 0:
+        wanted = min(remaining, chunk_size)
+        chunk = body_file.read(wanted)
+        if not chunk:
+            break
+        if checker is not None:
+            checker.update(chunk)
+        chunks.append(chunk)
+        remaining -= len(chunk)
+        if len(chunk) < wanted:
+            # Short read, the client has sent all it will send.
+            break
+    if len(chunks) == 1:
+        # Common case (small bodies), avoid copying it.
+        return chunks[0]
+    return b"".join(chunks)
 
 
 class WSGIServer(simple_server.WSGIServer):
@@ -94,6 +159,71 @@ class WSGIServer(simple_server.WSGIServer):
         fut.add_done_callback(_on_done)
 
 
+#: Kind of spool entries that hook applications write.
+SPOOL_KIND = 'hook/message'
+
+
+class _mark_spool_done(object):
+    """Marks a spool entry done once all of its futures are done."""
+
+    def __init__(self, spool, entry_id, waiting_on):
+        self.spool = spool
+        self.entry_id = entry_id
+        self.waiting_on = waiting_on
+        self.lock = threading.Lock()
+
+    def __call__(self, fut):
+        with self.lock:
+            self.waiting_on -= 1
+            if self.waiting_on:
+                return
+        self.spool.mark_done(self.entry_id)
+
+
+def dispatch_hook_message(bot, m, entry_id=None, log=None):
+    if log is None:
+        log = LOG
+    futs = [bot.submit_message(m, c.BROADCAST)]
+    fut = bot.submit_message(m, c.TARGETED)
+    fut.add_done_callback(finishers.log_on_fail(bot, m, log=log))
+    futs.append(fut)
+    if entry_id is not None:
+        mark_done = _mark_spool_done(bot.spool, entry_id, len(futs))
+        for fut in futs:
+            fut.add_done_callback(mark_done)
+
+
+def submit_hook_message(bot, m, log=None):
+    """Records (in the spool) and then submits a hook received message.
+
+    The spool entry is marked done once the message has been processed
+    (so that if the bot dies or is restarted before that it will get
+    replayed the next time it starts).
+    """
+    entry_id = None
+    if bot.spool is not None:
+        entry_id = bot.spool.append(SPOOL_KIND, m.to_dict())
+    dispatch_hook_message(bot, m, entry_id=entry_id, log=log)
+
+
+def replay_hook_messages(bot, entries, log=None):
+    """Re-submits hook received messages that were left in the spool."""
+    if log is None:
+        log = LOG
+    replayed = 0
+    for entry in entries:
+        if entry.kind != SPOOL_KIND:
+            continue
+        data = entry.data
+        m = message.Message("%s/%s" % (data['kind'], data['sub_kind']),
+                            data['headers'], munch.munchify(data['body']))
+        log.info("Replaying spooled %s/%s message (spool entry %s)",
+                 m.kind, m.sub_kind, entry.entry_id)
+        dispatch_hook_message(bot, m, entry_id=entry.entry_id, log=log)
+        replayed += 1
+    return replayed
+
+
 class WSGIRequestHandler(simple_server.WSGIRequestHandler):
     def log_request(self, code='-', size='-'):
         LOG.log(utils.TRACE,
@@ -104,10 +234,655 @@ class WSGIRequestHandler(simple_server.WSGIRequestHandler):
         LOG.warn(format, *args)
 
 
+class _HTTPError(Exception):
+    def __init__(self, status):
+        super(_HTTPError, self).__init__(status)
+        self.status = status
+
+
+def _parse_request_head(head):
+    lines = head.decode("iso-8859-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise _HTTPError("400 Bad Request")
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise _HTTPError("505 HTTP Version Not Supported")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line[0] in (" ", "\t") and headers:
+            # Obsolete line folding, just join it to the prior header.
+            name, value = headers[-1]
+            headers[-1] = (name, value + " " + line.strip())
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name or name != name.strip():
+            raise _HTTPError("400 Bad Request")
+        headers.append((name, value.strip()))
+    return method, target, version, headers
+
+
+def _find_header(headers, name, default=None):
+    name = name.lower()
+    for h_name, h_value in headers:
+        if h_name.lower() == name:
+            return h_value
+    return default
+
+
+def _find_header_tokens(headers, name):
+    value = _find_header(headers, name, default='')
+    return set(token.strip().lower() for token in value.split(","))
+
+
+class RequestBody(object):
+    """Request body (``wsgi.input``) read off its connection on demand.
+
+    Whatever of the body came in along with the request head is served
+    first, the rest is only read from the socket as the application asks
+    for it (so bodies never have to be held in memory by the server).
+    """
+
+    def __init__(self, sock, buffered, length, timeout, deadline,
+                 send_continue=False):
+        self.length = length
+        self._sock = sock
+        self._buffered = buffered
+        self._remaining = length - len(buffered)
+        self._timeout = timeout
+        self._deadline = deadline
+        self._send_continue = send_continue
+
+    @property
+    def fully_read(self):
+        return not self._buffered and self._remaining <= 0
+
+    def _recv(self, size):
+        if self._send_continue:
+            self._send_continue = False
+            self._sock.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+        timeout = self._deadline - time.time()
+        if timeout <= 0:
+            raise socket.timeout("Timed out reading request body")
+        self._sock.settimeout(timeout)
+        try:
+            data = self._sock.recv(min(size, self._remaining,
+                                       BODY_CHUNK_SIZE))
+        finally:
+            self._sock.settimeout(self._timeout)
+        if not data:
+            raise socket.error("Connection closed with %s bytes of the"
+                               " request body unread" % self._remaining)
+        self._remaining -= len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._buffered) + self._remaining
+        chunks = []
+        if self._buffered:
+            chunk = self._buffered[0:size]
+            self._buffered = self._buffered[len(chunk):]
+            chunks.append(chunk)
+            size -= len(chunk)
+        while size > 0 and self._remaining > 0:
+            chunk = self._recv(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._buffered) + self._remaining
+        while (b"\n" not in self._buffered and
+               len(self._buffered) < size and self._remaining > 0):
+            self._buffered += self._recv(size - len(self._buffered))
+        end = self._buffered.find(b"\n") + 1
+        if end <= 0 or end > size:
+            end = size
+        line = self._buffered[0:end]
+        self._buffered = self._buffered[len(line):]
+        return line
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+class HTTPConnection(object):
+    """State of a (possibly kept alive) connection to some http client."""
+
+    def __init__(self, sock, client_address, now, handshaking=False):
+        self.sock = sock
+        self.client_address = client_address
+        self.buffer = bytearray()
+        self.handshaking = handshaking
+        self.busy = False
+        self.requests_served = 0
+        self.last_active = now
+        if handshaking:
+            self.started_at = now
+        else:
+            self.started_at = None
+        self.selector_events = 0
+
+
+class KeepAliveWSGIServer(object):
+    """Selector driven (http/1.1, keep-alive supporting) wsgi server.
+
+    A single thread accepts connections and reads request heads off of
+    them; requests are then handed to the executor which runs the
+    application (which reads the body, see :class:`RequestBody`) and
+    writes the response, after which the connection comes back to be
+    waited on for the next request (or is closed).
+    """
+
+    SERVER_SOFTWARE = "padre-wsgi/1.0"
+
+    #: How often (at least) connections get checked for timeouts.
+    SWEEP_INTERVAL = 1.0
+
+    #: Statuses that never have a response body.
+    NO_BODY_STATUSES = frozenset(['204', '304'])
+
+    # Selector key data used to tell the non-connection sockets apart.
+    _ACCEPT = 'accept'
+    _WAKEUP = 'wakeup'
+
+    def __init__(self, server_address, app, executor, ssl_context=None,
+                 max_request_bytes=None,
+                 max_header_bytes=64 * 1024, request_timeout=30.0,
+                 keepalive_timeout=15.0, max_keepalive_requests=1000,
+                 listen_backlog=128):
+        self.app = app
+        self.executor = executor
+        self.ssl_context = ssl_context
+        if max_request_bytes is not None:
+            max_request_bytes = int(max_request_bytes)
+        self.max_request_bytes = max_request_bytes
+        self.max_header_bytes = int(max_header_bytes)
+        self.request_timeout = float(request_timeout)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.max_keepalive_requests = max(1, int(max_keepalive_requests))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(server_address)
+            sock.listen(listen_backlog)
+            sock.setblocking(False)
+        except socket.error:
+            sock.close()
+            raise
+        self.socket = sock
+        self.server_address = sock.getsockname()[0:2]
+        self.url_scheme = 'https' if ssl_context is not None else 'http'
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            os.set_blocking(fd, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ, self._ACCEPT)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ,
+                                self._WAKEUP)
+        self._conns = set()
+        self._returned = collections.deque()
+        self._returned_lock = threading.Lock()
+        self._dying = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"x")
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def _drain_wakeup(self):
+        while True:
+            try:
+                if not os.read(self._wakeup_r, 4096):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+    def _set_interest(self, conn, events):
+        if events == conn.selector_events:
+            return
+        if not events:
+            self._selector.unregister(conn.sock)
+        elif not conn.selector_events:
+            self._selector.register(conn.sock, events, conn)
+        else:
+            self._selector.modify(conn.sock, events, conn)
+        conn.selector_events = events
+
+    def _close(self, conn):
+        self._set_interest(conn, 0)
+        self._conns.discard(conn)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def _reject(self, conn, status):
+        # Best effort (the connection is closed right after).
+        body = status.encode("ascii")
+        try:
+            conn.sock.send(b"".join([
+                b"HTTP/1.1 ", body, b"\r\n",
+                b"Content-Type: text/plain\r\n",
+                b"Content-Length: ", str(len(body)).encode("ascii"),
+                b"\r\n", b"Connection: close\r\n\r\n", body]))
+        except (socket.error, ValueError):
+            pass
+        self._close(conn)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                LOG.warning("Failed accepting http connection",
+                            exc_info=True)
+                break
+            now = time.time()
+            if self.ssl_context is not None:
+                try:
+                    sock = self.ssl_context.wrap_socket(
+                        sock, server_side=True,
+                        do_handshake_on_connect=False)
+                except (ssl.SSLError, socket.error):
+                    sock.close()
+                    continue
+                conn = HTTPConnection(sock, client_address, now,
+                                      handshaking=True)
+            else:
+                conn = HTTPConnection(sock, client_address, now)
+            sock.setblocking(False)
+            self._conns.add(conn)
+            self._set_interest(conn, selectors.EVENT_READ)
+
+    def _handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._set_interest(conn, selectors.EVENT_READ)
+        except ssl.SSLWantWriteError:
+            self._set_interest(conn, selectors.EVENT_WRITE)
+        except (ssl.SSLError, socket.error):
+            self._close(conn)
+        else:
+            conn.handshaking = False
+            conn.started_at = None
+            self._set_interest(conn, selectors.EVENT_READ)
+
+    def _read(self, conn):
+        closed = False
+        while True:
+            try:
+                data = conn.sock.recv(64 * 1024)
+            except (BlockingIOError, InterruptedError,
+                    ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error:
+                closed = True
+                break
+            if not data:
+                closed = True
+                break
+            if conn.started_at is None:
+                conn.started_at = time.time()
+            conn.buffer += data
+            if len(conn.buffer) > self.max_header_bytes:
+                # Enough to find the head (or to know that it is too
+                # large); bodies get read later by whoever wants them.
+                break
+        conn.last_active = time.time()
+        if closed:
+            self._close(conn)
+        else:
+            self._process_buffer(conn)
+
+    def _process_buffer(self, conn):
+        if conn.buffer[0:1] in (b"\r", b"\n"):
+            conn.buffer = conn.buffer.lstrip(b"\r\n")
+        head_end = conn.buffer.find(b"\r\n\r\n")
+        if head_end == -1:
+            if len(conn.buffer) > self.max_header_bytes:
+                self._reject(conn, "431 Request Header Fields Too Large")
+            elif not conn.buffer:
+                conn.started_at = None
+            return
+        if head_end > self.max_header_bytes:
+            self._reject(conn, "431 Request Header Fields Too Large")
+            return
+        head = bytes(conn.buffer[0:head_end])
+        del conn.buffer[0:head_end + 4]
+        try:
+            method, target, version, headers = _parse_request_head(head)
+            # TODO: support chunked request bodies (until then this
+            # server is not the default one).
+            if _find_header(headers, 'transfer-encoding') is not None:
+                raise _HTTPError("411 Length Required")
+            try:
+                length = int(_find_header(headers, 'content-length', 0))
+            except ValueError:
+                raise _HTTPError("400 Bad Request")
+            if length < 0:
+                raise _HTTPError("400 Bad Request")
+            if (self.max_request_bytes is not None and
+                    length > self.max_request_bytes):
+                raise _HTTPError("413 Payload Too Large")
+        except _HTTPError as e:
+            self._reject(conn, e.status)
+            return
+        buffered = bytes(conn.buffer[0:length])
+        del conn.buffer[0:len(buffered)]
+        # NOTE: the 100 (continue) only goes out if the application
+        # actually reads the body (so ones that reject requests from
+        # their headers alone never have the body sent to them).
+        send_continue = (len(buffered) < length and
+                         version == 'HTTP/1.1' and
+                         '100-continue' in _find_header_tokens(headers,
+                                                               'expect'))
+        body = RequestBody(conn.sock, buffered, length,
+                           self.request_timeout,
+                           (conn.started_at or time.time()) +
+                           self.request_timeout,
+                           send_continue=send_continue)
+        request = (method, target, version, headers)
+        conn.busy = True
+        self._set_interest(conn, 0)
+        try:
+            self.executor.submit(self._handle, conn, request, body)
+        except RuntimeError:
+            # Executor is shutting down, nothing more to do...
+            self._close(conn)
+
+    def _make_environ(self, conn, method, target, version, headers, body):
+        path, _sep, query = target.partition("?")
+        if "://" in path:
+            path = urlparse.urlsplit(path).path
+        if six.PY3:
+            path = urlparse.unquote(path, 'iso-8859-1')
+        else:
+            path = urlparse.unquote(path)
+        host, port = self.server_address
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': version,
+            'SERVER_SOFTWARE': self.SERVER_SOFTWARE,
+            'REMOTE_ADDR': conn.client_address[0],
+            'CONTENT_LENGTH': str(body.length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': self.url_scheme,
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                if key == 'CONTENT_TYPE':
+                    environ[key] = value
+                continue
+            key = 'HTTP_' + key
+            if key in environ:
+                environ[key] += "," + value
+            else:
+                environ[key] = value
+        return environ
+
+    def _run_app(self, conn, method, version, environ, body, keep_alive):
+        sock = conn.sock
+        state = {
+            'status': None,
+            'headers': None,
+            'head': b"",
+            'head_sent': False,
+            'chunked': False,
+            'keep_alive': keep_alive,
+        }
+
+        def send_head():
+            status = state['status']
+            headers = list(state['headers'])
+            header_names = set(name.lower() for name, _value in headers)
+            has_body = (method != 'HEAD' and
+                        status[0:3] not in self.NO_BODY_STATUSES)
+            if has_body and 'content-length' not in header_names:
+                if version == 'HTTP/1.1':
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                    state['chunked'] = True
+                else:
+                    # Only way to tell the client where the body ends...
+                    state['keep_alive'] = False
+            if not body.fully_read:
+                # The rest of the body is still coming (and nobody wants
+                # it); the connection can't be reused past it.
+                state['keep_alive'] = False
+            if 'date' not in header_names:
+                headers.append(('Date', wsgi_handlers.format_date_time(
+                    time.time())))
+            if state['keep_alive']:
+                if version == 'HTTP/1.0':
+                    headers.append(('Connection', 'keep-alive'))
+            else:
+                headers.append(('Connection', 'close'))
+            lines = ["%s %s" % (version, status)]
+            lines.extend("%s: %s" % (name, value)
+                         for name, value in headers)
+            # NOTE: this gets sent along with the first piece of the
+            # body (to avoid the head going out in a tiny packet of its own
+            # that then ends up waiting on a delayed ack).
+            state['head'] = ("\r\n".join(lines) +
+                             "\r\n\r\n").encode("iso-8859-1")
+            state['head_sent'] = True
+            state['has_body'] = has_body
+
+        def write(data):
+            if state['status'] is None:
+                raise AssertionError("write() before start_response()")
+            if not state['head_sent']:
+                send_head()
+            if data and state['has_body']:
+                if state['chunked']:
+                    data = b"%x\r\n" % len(data) + data + b"\r\n"
+            else:
+                data = b""
+            if state['head']:
+                data = state['head'] + data
+                state['head'] = b""
+            if data:
+                sock.sendall(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if state['head_sent']:
+                        six.reraise(*exc_info)
+                finally:
+                    exc_info = None
+            elif state['status'] is not None:
+                raise AssertionError("Headers already set")
+            state['status'] = status
+            state['headers'] = headers
+            return write
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+                if not state['head_sent']:
+                    send_head()
+                tail = state['head']
+                if state['chunked']:
+                    tail += b"0\r\n\r\n"
+                if tail:
+                    sock.sendall(tail)
+            finally:
+                close_func = getattr(result, 'close', None)
+                if close_func is not None:
+                    close_func()
+        except socket.error:
+            # Client went away (or timed out); nothing to tell it.
+            return False
+        except Exception:
+            LOG.warning("Exception happened during processing of request"
+                        " from %s", conn.client_address, exc_info=True)
+            if state['head'] or not state['head_sent']:
+                body = b"500 Internal Server Error"
+                try:
+                    sock.sendall(b"".join([
+                        version.encode("ascii"), b" ", body, b"\r\n",
+                        b"Content-Type: text/plain\r\n",
+                        b"Content-Length: ", str(len(body)).encode("ascii"),
+                        b"\r\n", b"Connection: close\r\n\r\n", body]))
+                except (socket.error, ValueError):
+                    pass
+            return False
+        else:
+            LOG.log(utils.TRACE, 'Received http/https request: "%s %s %s"'
+                    ' %s', method, environ['PATH_INFO'], version,
+                    state['status'])
+            return state['keep_alive']
+
+    def _handle(self, conn, request, body):
+        method, target, version, headers = request
+        connection_tokens = _find_header_tokens(headers, 'connection')
+        if version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection_tokens
+        else:
+            keep_alive = 'keep-alive' in connection_tokens
+        if (self._dying or
+                conn.requests_served + 1 >= self.max_keepalive_requests):
+            keep_alive = False
+        try:
+            conn.sock.settimeout(self.request_timeout)
+            environ = self._make_environ(conn, method, target,
+                                         version, headers, body)
+            keep_alive = self._run_app(conn, method, version,
+                                       environ, body, keep_alive)
+        finally:
+            conn.requests_served += 1
+            with self._returned_lock:
+                self._returned.append((conn, keep_alive))
+            self._wakeup()
+
+    def _process_returned(self):
+        with self._returned_lock:
+            returned = list(self._returned)
+            self._returned.clear()
+        now = time.time()
+        for conn, keep_alive in returned:
+            conn.busy = False
+            if not keep_alive or self._dying:
+                self._close(conn)
+                continue
+            try:
+                conn.sock.setblocking(False)
+            except socket.error:
+                self._close(conn)
+                continue
+            conn.last_active = now
+            if conn.buffer:
+                # Pipelined (the next request already came in).
+                conn.started_at = now
+                self._process_buffer(conn)
+            else:
+                conn.started_at = None
+            if not conn.busy and conn in self._conns:
+                self._set_interest(conn, selectors.EVENT_READ)
+
+    def _sweep(self):
+        now = time.time()
+        for conn in list(self._conns):
+            if conn.busy:
+                continue
+            if conn.started_at is not None:
+                if now - conn.started_at > self.request_timeout:
+                    if conn.handshaking:
+                        self._close(conn)
+                    else:
+                        self._reject(conn, "408 Request Timeout")
+            elif now - conn.last_active > self.keepalive_timeout:
+                self._close(conn)
+
+    def serve_forever(self):
+        self._is_shut_down.clear()
+        try:
+            last_sweep = time.time()
+            while not self._dying:
+                events = self._selector.select(self.SWEEP_INTERVAL)
+                for key, mask in events:
+                    if key.data is self._WAKEUP:
+                        self._drain_wakeup()
+                    elif key.data is self._ACCEPT:
+                        self._accept()
+                    else:
+                        conn = key.data
+                        if conn.handshaking:
+                            self._handshake(conn)
+                        if not conn.handshaking and conn in self._conns:
+                            self._read(conn)
+                self._process_returned()
+                now = time.time()
+                if now - last_sweep >= self.SWEEP_INTERVAL:
+                    self._sweep()
+                    last_sweep = now
+        finally:
+            for conn in list(self._conns):
+                if not conn.busy:
+                    self._close(conn)
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._dying = True
+        self._wakeup()
+        self._is_shut_down.wait()
+        self._selector.close()
+        self.socket.close()
+        wakeup_r, wakeup_w = self._wakeup_r, self._wakeup_w
+        os.close(wakeup_w)
+        os.close(wakeup_r)
+
+
 class WSGIServerRunner(threading.Thread):
+    #: Server kind that is based on wsgiref (http/1.0 and no keep-alive).
+    SIMPLE = 'simple'
+
+    #: Server kind that uses the built-in keep-alive server.
+    KEEPALIVE = 'keepalive'
+
+    SERVER_KINDS = (SIMPLE, KEEPALIVE)
+
     def __init__(self, ssl_config, wsgi_app, port,
-                 exposed=False, max_workers=None):
+                 exposed=False, max_workers=None, server_config=None):
         super(WSGIServerRunner, self).__init__()
+        if not server_config:
+            server_config = {}
+        self.server_config = server_config
+        self.server_kind = server_config.get('kind', self.SIMPLE)
+        if self.server_kind not in self.SERVER_KINDS:
+            raise ValueError("Unknown wsgi server kind '%s' (expected"
+                             " one of %s)" % (self.server_kind,
+                                              self.SERVER_KINDS))
         self.ssl_config = ssl_config
         self.port = port
         self.exposed = exposed
@@ -137,8 +912,15 @@ class WSGIServerRunner(threading.Thread):
         except AttributeError:
             certfile = None
         executor = futurist.ThreadPoolExecutor(max_workers=self.max_workers)
-        server = make_server(bind_addr, bind_port, self.wsgi_app,
-                             executor, certfile=certfile, keyfile=keyfile)
+        if self.server_kind == self.KEEPALIVE:
+            server = make_keepalive_server(
+                bind_addr, bind_port, self.wsgi_app, executor,
+                certfile=certfile, keyfile=keyfile,
+                server_config=self.server_config)
+        else:
+            server = make_server(bind_addr, bind_port, self.wsgi_app,
+                                 executor, certfile=certfile,
+                                 keyfile=keyfile)
         if keyfile or certfile:
             server_base = 'https'
         else:
@@ -182,3 +964,21 @@ def make_server(host, port, wsgi_app, executor,
                                         certfile=certfile,
                                         keyfile=keyfile)
     return server
+
+
+def make_keepalive_server(host, port, wsgi_app, executor,
+                          certfile=None, keyfile=None, server_config=None):
+    if not server_config:
+        server_config = {}
+    ssl_context = None
+    if certfile or keyfile:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile, keyfile=keyfile)
+    kwargs = {}
+    for k in ('max_request_bytes', 'max_header_bytes',
+              'request_timeout', 'keepalive_timeout',
+              'max_keepalive_requests'):
+        if k in server_config:
+            kwargs[k] = server_config[k]
+    return KeepAliveWSGIServer((host, port), wsgi_app, executor,
+                               ssl_context=ssl_context, **kwargs)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""Benchmarks concurrent brain reads/writes for the available backends.
+
+Runs the same reader/writer mix (writers doing locked read-modify-write
+cycles, readers doing plain lookups) against a temporary file for each
+brain backend and prints the throughput of each.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import threading
+
+from oslo_utils import timeutils
+import sqlitedict
+
+from padre import brain_utils as bu
+from padre import utils
+
+
+def make_brain(backend, path, durability):
+    if backend == bu.WAL:
+        if durability == bu.SYNC:
+            synchronous = 'FULL'
+        else:
+            synchronous = 'NORMAL'
+        brain = bu.SqliteBrain(path, tablename='padre',
+                               synchronous=synchronous)
+    else:
+        codec = bu.RecordCodec()
+        brain = sqlitedict.SqliteDict(filename=path, tablename='padre',
+                                      autocommit=False, flag='c',
+                                      encode=codec.dumps,
+                                      decode=codec.loads)
+    brain = bu.WriteBehindBrain(brain, durability=durability)
+    brain.start()
+    return brain
+
+
+def run_bench(backend, path, args):
+    brain = make_brain(backend, path, args.durability)
+    for i in range(0, args.keys):
+        brain["user:%s" % i] = {'aliases': {}, 'count': 0}
+    brain.flush()
+
+    def writer(offset):
+        for i in range(0, args.writes):
+            key = "user:%s" % ((i + offset) % args.keys)
+            with brain.lock_for(key):
+                count = brain.get_field(key, 'count')
+                brain.set_field(key, 'count', count + 1)
+                brain.sync()
+
+    def reader(offset):
+        for i in range(0, args.reads):
+            key = "user:%s" % ((i + offset) % args.keys)
+            brain.get_field(key, 'aliases')
+
+    threads = []
+    for i in range(0, args.writers):
+        threads.append(threading.Thread(target=writer, args=(i,)))
+    for i in range(0, args.readers):
+        threads.append(threading.Thread(target=reader, args=(i,)))
+    with timeutils.StopWatch() as watch:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        brain.close()
+    elapsed = watch.elapsed()
+    total_writes = args.writers * args.writes
+    total_reads = args.readers * args.reads
+    print("%-10s %8.3fs %12.1f writes/s %12.1f reads/s" % (
+        backend, elapsed, total_writes / elapsed, total_reads / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--reads", type=int, default=2000,
+                        help="reads done by each reader")
+    parser.add_argument("--writes", type=int, default=500,
+                        help="writes done by each writer")
+    parser.add_argument("--keys", type=int, default=64)
+    parser.add_argument("--durability", default=bu.BATCHED,
+                        choices=bu.DURABILITIES)
+    parser.add_argument("--backend", action='append',
+                        choices=bu.BACKENDS,
+                        help="backend(s) to run (default all)")
+    args = parser.parse_args()
+    with utils.make_tmp_dir() as tmp_dir:
+        for backend in (args.backend or bu.BACKENDS):
+            path = os.path.join(tmp_dir, "%s.sqlite" % backend)
+            run_bench(backend, path, args)
+
+
+if __name__ == '__main__':
+    main()